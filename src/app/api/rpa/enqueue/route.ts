@@ -38,6 +38,10 @@ export async function POST(req: Request) {
       userUid: body.userUid,
       cfg: body.cfg || null,
       status: "queued",
+      // 公平スケジューリングの優先度（大きいほど先に実行。worker/scheduler.py）
+      priority: 0,
+      // 公平スケジューリングのユーザーキー（worker/scheduler.py job_user と同じ: userDocId || userUid）
+      fairKey: body.userUid || "",
       created_at: new Date().toISOString(),
     };
     await jobRef.set(job);
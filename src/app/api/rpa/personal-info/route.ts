@@ -2,8 +2,6 @@
 import { NextResponse } from "next/server";
 import { spawn } from "child_process";
 import path from "path";
-import fs from "fs";
-import os from "os";
 import { adminDb } from "../../../../lib/firebaseAdmin";
 
 // 关键：声明 Node 运行时，避免 Edge 环境不允许 child_process/fs
@@ -124,8 +122,12 @@ export async function POST(req: Request): Promise<Response> {
 
         const job = {
           status: "queued",
+          // 公平スケジューリングの優先度（大きいほど先に実行。worker/scheduler.py）
+          priority: 0,
           userUid: userUid || null,
           userDocId: resolvedDocId,
+          // 公平スケジューリングのユーザーキー（worker/scheduler.py job_user と同じ: userDocId || userUid）
+          fairKey: resolvedDocId || userUid || "",
           cfg: cfg || {},
           created_at: new Date().toISOString(),
           requested_at: new Date().toISOString(),
@@ -149,27 +151,19 @@ export async function POST(req: Request): Promise<Response> {
     const scriptPath = path.resolve(process.cwd(), "rpa_gmail_indeed_test.py");
     const pythonCmd = process.env.RPA_PYTHON_CMD || "python";
 
-    // 将 cfg 写到临时文件，并以 --cfg-file=path 传入
-    const cfgFile = path.join(
-      os.tmpdir(),
-      `rpa_cfg_${Date.now()}_${Math.floor(Math.random() * 10000)}.json`
-    );
-    try {
-      fs.writeFileSync(cfgFile, JSON.stringify({ config: cfg }), {
-        encoding: "utf8",
-      });
-    } catch (_) {
-      // ignore write failures; spawn may still run with passed config
-    }
+    // cfg（含凭据）经 stdin 管道传入（--cfg-stdin），不写临时文件
+    const cfgPayload = JSON.stringify({ config: cfg });
 
     // monitor 模式：后台 detached，立即返回 Response
     if (cfg && cfg.monitor) {
       try {
-        const child = spawn(pythonCmd, [scriptPath, `--cfg-file=${cfgFile}`], {
+        const child = spawn(pythonCmd, [scriptPath, "--cfg-stdin"], {
           detached: true,
-          stdio: "ignore",
+          stdio: ["pipe", "ignore", "ignore"],
           windowsHide: true,
         });
+        child.stdin?.on("error", () => {});
+        child.stdin?.end(cfgPayload);
         child.unref();
         return NextResponse.json({ success: true, message: "monitor_started" });
       } catch (e: any) {
@@ -181,7 +175,9 @@ export async function POST(req: Request): Promise<Response> {
     }
 
     // 前台执行，收集输出
-    const py = spawn(pythonCmd, [scriptPath, `--cfg-file=${cfgFile}`]);
+    const py = spawn(pythonCmd, [scriptPath, "--cfg-stdin"]);
+    py.stdin.on("error", () => {});
+    py.stdin.end(cfgPayload);
 
     const promise: Promise<Response> = new Promise((resolve) => {
       let output = "";
@@ -196,10 +192,6 @@ export async function POST(req: Request): Promise<Response> {
       });
 
       py.on("close", (code) => {
-        try {
-          if (fs.existsSync(cfgFile)) fs.unlinkSync(cfgFile);
-        } catch (_) {}
-
         if (code === 0) {
           // 尝试将 Python 标准输出解析为 JSON
           try {
@@ -224,9 +216,6 @@ export async function POST(req: Request): Promise<Response> {
         try {
           py.kill();
         } catch (_) {}
-        try {
-          if (fs.existsSync(cfgFile)) fs.unlinkSync(cfgFile);
-        } catch (_) {}
         resolve(
           NextResponse.json(
             { success: false, error: "脚本执行超时" },
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+user_configs/{uid} 的进程内缓存（worker.py 与 rpa_gmail_indeed_test.py 共用）。
+
+- 首次 get() 读取文档并注册 on_snapshot 监听，之后 Web UI 的修改几秒内推送到缓存
+- 监听不可用（依赖/权限/网络）时按 TTL 重新读取
+- 监听数量有上限，超出时按 LRU 注销最久未使用的 uid
+
+Env:
+- RPA_CONFIG_CACHE_TTL (default 60 秒; 无监听时的有效期)
+- RPA_CONFIG_LISTENER (default 1; 0 で監視を無効化し TTL のみ)
+"""
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+DEFAULT_TTL_S = float(os.environ.get("RPA_CONFIG_CACHE_TTL", "60"))
+# 有监听时也定期强制刷新，防止监听静默断开后永远读到旧值
+LISTENER_MAX_STALENESS_S = 600.0
+DEFAULT_MAX_LISTENERS = 100
+
+
+class _Entry:
+    __slots__ = ("data", "exists", "loaded_at", "watch")
+
+    def __init__(self, data, exists, loaded_at, watch=None):
+        self.data = data
+        self.exists = exists
+        self.loaded_at = loaded_at
+        self.watch = watch
+
+
+class ConfigCache:
+    def __init__(self, db_factory: Callable[[], object], collection: str = "user_configs",
+                 ttl_s: float = DEFAULT_TTL_S, use_listener: Optional[bool] = None,
+                 max_listeners: int = DEFAULT_MAX_LISTENERS):
+        self._db_factory = db_factory
+        self.collection = collection
+        self.ttl_s = float(ttl_s)
+        if use_listener is None:
+            use_listener = os.environ.get("RPA_CONFIG_LISTENER", "1") != "0"
+        self.use_listener = bool(use_listener)
+        self.max_listeners = max(0, int(max_listeners))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # doc_id -> _Entry
+        self.stats = {"hits": 0, "misses": 0, "reads": 0, "listener_updates": 0, "listeners": 0}
+
+    def _fresh(self, e: _Entry) -> bool:
+        age = time.monotonic() - e.loaded_at
+        if e.watch is not None:
+            return age < LISTENER_MAX_STALENESS_S
+        return age < self.ttl_s
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        """Return a copy of user_configs/{doc_id} (None when it does not exist or cannot be read)."""
+        doc_id = str(doc_id)
+        with self._lock:
+            e = self._entries.get(doc_id)
+            if e is not None and self._fresh(e):
+                self._entries.move_to_end(doc_id)
+                self.stats["hits"] += 1
+                return copy.deepcopy(e.data) if e.exists else None
+            self.stats["misses"] += 1
+
+        db = self._db_factory()
+        if db is None:
+            return None
+        ref = db.collection(self.collection).document(doc_id)
+        snap = ref.get()
+        self.stats["reads"] += 1
+        data = (snap.to_dict() or {}) if snap.exists else None
+        self._store(doc_id, data, snap.exists)
+        if self.use_listener:
+            self._ensure_listener(doc_id, ref)
+        return copy.deepcopy(data) if snap.exists else None
+
+    def put(self, doc_id: str, data: Optional[dict]):
+        """Seed the cache with an already-read document (e.g. from a field query)."""
+        self._store(str(doc_id), copy.deepcopy(data) if data is not None else None, data is not None)
+
+    def invalidate(self, doc_id: str):
+        with self._lock:
+            e = self._entries.pop(str(doc_id), None)
+        self._unsubscribe(e)
+
+    def close(self):
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), OrderedDict()
+        for e in entries:
+            self._unsubscribe(e)
+
+    # ----------------- internals -----------------
+    def _store(self, doc_id: str, data, exists: bool):
+        with self._lock:
+            e = self._entries.get(doc_id)
+            if e is None:
+                self._entries[doc_id] = _Entry(data, exists, time.monotonic())
+            else:
+                e.data, e.exists, e.loaded_at = data, exists, time.monotonic()
+                self._entries.move_to_end(doc_id)
+
+    def _ensure_listener(self, doc_id: str, ref):
+        with self._lock:
+            e = self._entries.get(doc_id)
+            if e is None or e.watch is not None:
+                return
+            evicted = self._evict_listener_locked() if self.stats["listeners"] >= self.max_listeners else None
+        self._unsubscribe(evicted)
+        if self.max_listeners == 0:
+            return
+
+        def _on_snapshot(docs, changes, read_time, _doc_id=doc_id):
+            try:
+                snap = docs[0] if docs else None
+                exists = bool(snap is not None and snap.exists)
+                self._store(_doc_id, (snap.to_dict() or {}) if exists else None, exists)
+                self.stats["listener_updates"] += 1
+            except Exception:
+                pass
+
+        try:
+            watch = ref.on_snapshot(_on_snapshot)
+        except Exception:
+            return  # 监听不可用 -> 仅使用 TTL
+        with self._lock:
+            e = self._entries.get(doc_id)
+            if e is None or e.watch is not None:
+                stale = watch
+            else:
+                e.watch, stale = watch, None
+                self.stats["listeners"] += 1
+        if stale is not None:
+            try:
+                stale.unsubscribe()
+            except Exception:
+                pass
+
+    def _evict_listener_locked(self) -> Optional[_Entry]:
+        for key, e in self._entries.items():
+            if e.watch is not None:
+                return self._entries.pop(key)
+        return None
+
+    def _unsubscribe(self, e: Optional[_Entry]):
+        if e is None or e.watch is None:
+            return
+        try:
+            e.watch.unsubscribe()
+        except Exception:
+            pass
+        e.watch = None
+        self.stats["listeners"] = max(0, self.stats["listeners"] - 1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内共享的 Firestore 客户端（worker.py 与 rpa_gmail_indeed_test.py 共用）。
+
+- 第一次 get_client() 时初始化，之后复用同一个 client（同一 gRPC channel）
+- 服务账号解析顺序与 worker 一致：--sa-file > GOOGLE_APPLICATION_CREDENTIALS > SERVICE_ACCOUNT_PATH
+- metrics() 返回初始化 / 复用次数，便于确认热路径没有重复建连
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Optional
+
+try:
+    from google.cloud import firestore
+except Exception:
+    firestore = None
+
+try:
+    from google.oauth2 import service_account as oauth_service_account
+except Exception:
+    oauth_service_account = None
+
+_lock = threading.Lock()
+_client = None
+_STATS = {"requests": 0, "inits": 0, "reuses": 0, "init_failures": 0, "init_ms": 0.0}
+
+
+def resolve_service_account_path(cli_path: Optional[str]) -> Optional[str]:
+    if cli_path and os.path.exists(cli_path):
+        return cli_path
+    for key in ("GOOGLE_APPLICATION_CREDENTIALS", "SERVICE_ACCOUNT_PATH"):
+        v = os.environ.get(key)
+        if v and os.path.exists(v):
+            return v
+    return None
+
+
+def _create_client(sa_path: Optional[str], allow_default: bool):
+    if oauth_service_account and sa_path:
+        try:
+            creds = oauth_service_account.Credentials.from_service_account_file(sa_path)
+            return firestore.Client(credentials=creds, project=creds.project_id)
+        except Exception as e:
+            print("Failed to init Firestore with SA credentials; fallback to default:", e, file=sys.stderr, flush=True)
+    if sa_path or allow_default:
+        return firestore.Client()
+    return None
+
+
+def get_client(sa_path: Optional[str] = None, allow_default: bool = True):
+    """Return the shared Firestore client, creating it on first use.
+
+    allow_default=False returns None instead of falling back to application
+    default credentials when no service account file can be resolved.
+    """
+    global _client
+    _STATS["requests"] += 1
+    if _client is not None:
+        _STATS["reuses"] += 1
+        return _client
+    if firestore is None:
+        return None
+    with _lock:
+        if _client is not None:
+            _STATS["reuses"] += 1
+            return _client
+        t0 = time.perf_counter()
+        try:
+            client = _create_client(resolve_service_account_path(sa_path), allow_default)
+        except Exception:
+            _STATS["init_failures"] += 1
+            raise
+        if client is not None:
+            _STATS["inits"] += 1
+            _STATS["init_ms"] += (time.perf_counter() - t0) * 1000
+            _client = client
+        return client
+
+
+def reset_client():
+    """Drop the shared client (e.g. in a forked child, where gRPC channels must not be reused)."""
+    global _client
+    with _lock:
+        _client = None
+
+
+def metrics() -> dict:
+    m = dict(_STATS)
+    m["init_ms"] = round(m["init_ms"], 1)
+    m["connected"] = _client is not None
+    return m
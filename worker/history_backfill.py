@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rpa_history/{uid}/entries を現在（または指定）の target_rules で再判定する what-if / backfill。
+
+- entries をドキュメント ID 順にページ単位で読み込む（メモリはページ 1 つ分 + サンプル ID のみ）
+- 判定は target_rules.CompiledRules（evaluate_sms_target と同じ三値ロジック）をページ単位で一括実行
+- 集計（件数・新たに対象になった / 対象外になった ID のサンプル）を
+  rpa_history/{uid}/backfill/{run_id} に保存し、最後に処理したドキュメント ID をカーソルとして残す
+- --apply 時は変化したエントリの is_sms_target を、カーソル更新と同じ WriteBatch でコミットする
+  （途中で止まっても、再実行すれば続きから再開できる）
+
+Usage:
+    python history_backfill.py --uid UID                 # what-if（書き込みは集計ドキュメントのみ）
+    python history_backfill.py --uid UID --apply         # is_sms_target も更新
+    python history_backfill.py --uid UID --rules-file rules.json --restart
+"""
+
+import sys
+import json
+import time
+import hashlib
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+import firestore_provider
+from target_rules import CompiledRules
+
+HISTORY_COLLECTION = "rpa_history"
+BACKFILL_COLLECTION = "backfill"
+# WriteBatch の上限 500 件のうち 1 件は集計ドキュメント用
+MAX_PAGE_SIZE = 499
+DEFAULT_PAGE_SIZE = 400
+DEFAULT_SAMPLES = 20
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def rules_hash(target_rules) -> str:
+    raw = json.dumps(target_rules or {}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def default_run_id(target_rules, apply: bool) -> str:
+    return f"{'apply' if apply else 'whatif'}-{rules_hash(target_rules)[:12]}"
+
+
+def _empty_counts() -> dict:
+    return {"scanned": 0, "targets": 0, "non_targets": 0, "undecided": 0,
+            "newly_targeted": 0, "no_longer_targeted": 0, "updated": 0}
+
+
+def run_backfill(db, uid: str, target_rules, apply: bool = False, page_size: int = DEFAULT_PAGE_SIZE,
+                 run_id: Optional[str] = None, restart: bool = False, max_pages: Optional[int] = None,
+                 samples: int = DEFAULT_SAMPLES, on_page: Optional[Callable[[dict], None]] = None) -> dict:
+    """Re-score the uid's history with target_rules; returns the summary document."""
+    page_size = max(1, min(MAX_PAGE_SIZE, int(page_size)))
+    run_id = run_id or default_run_id(target_rules, apply)
+    compiled = CompiledRules(target_rules)
+    user_doc = db.collection(HISTORY_COLLECTION).document(str(uid))
+    entries = user_doc.collection("entries")
+    summary_ref = user_doc.collection(BACKFILL_COLLECTION).document(run_id)
+
+    summary = None
+    if not restart:
+        snap = summary_ref.get()
+        if snap.exists:
+            summary = snap.to_dict() or {}
+            if summary.get("rules_hash") != rules_hash(target_rules):
+                raise ValueError(f"backfill {run_id} was started with different target_rules; use --restart")
+    if not summary:
+        summary = {
+            "uid": str(uid),
+            "mode": "apply" if apply else "whatif",
+            "rules_hash": rules_hash(target_rules),
+            "target_rules": target_rules or {},
+            "status": "running",
+            "cursor": None,
+            "counts": _empty_counts(),
+            "samples": {"newly_targeted": [], "no_longer_targeted": []},
+            "started_at": now_iso(),
+        }
+    if summary.get("status") == "done":
+        return summary
+    counts = {**_empty_counts(), **(summary.get("counts") or {})}
+    sample_ids = summary.get("samples") or {}
+    sample_ids.setdefault("newly_targeted", [])
+    sample_ids.setdefault("no_longer_targeted", [])
+
+    pages = 0
+    while True:
+        q = entries.order_by("__name__").limit(page_size)
+        if summary.get("cursor"):
+            q = q.start_after({"__name__": summary["cursor"]})
+        docs = list(q.stream())
+        if not docs:
+            summary["status"] = "done"
+            summary["finished_at"] = now_iso()
+            summary["counts"], summary["samples"] = counts, sample_ids
+            summary_ref.set(summary)
+            break
+
+        records = [d.to_dict() or {} for d in docs]
+        results = compiled.evaluate_records(records)
+        batch = db.batch()
+        for d, rec, r in zip(docs, records, results):
+            counts["scanned"] += 1
+            if r is None:
+                counts["undecided"] += 1
+            elif r:
+                counts["targets"] += 1
+            else:
+                counts["non_targets"] += 1
+            # 本番経路と同じく None は False として保存される
+            new_value = bool(r)
+            old_value = bool(rec.get("is_sms_target", False))
+            if new_value == old_value:
+                continue
+            key = "newly_targeted" if new_value else "no_longer_targeted"
+            counts[key] += 1
+            if len(sample_ids[key]) < samples:
+                sample_ids[key].append(d.id)
+            if apply:
+                batch.update(d.reference, {"is_sms_target": new_value})
+                counts["updated"] += 1
+        del records, results
+
+        summary["cursor"] = docs[-1].id
+        summary["counts"], summary["samples"] = counts, sample_ids
+        summary["updated_at"] = now_iso()
+        batch.set(summary_ref, summary)
+        batch.commit()
+        pages += 1
+        if on_page:
+            on_page(summary)
+        if len(docs) < page_size:
+            continue  # 次のループで空ページを確認して done にする
+        if max_pages and pages >= max_pages:
+            break
+    return summary
+
+
+def _load_rules(db, uid: str, rules_file: Optional[str]):
+    if rules_file:
+        with open(rules_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("target_rules", data) if isinstance(data, dict) else data
+    snap = db.collection("user_configs").document(str(uid)).get()
+    if not snap.exists:
+        raise SystemExit(f"user_configs/{uid} not found")
+    return (snap.to_dict() or {}).get("target_rules") or {}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Re-evaluate target_rules over rpa_history entries (what-if / backfill)")
+    p.add_argument("--uid", required=True, help="user_configs / rpa_history document id")
+    p.add_argument("--sa-file", help="Service account JSON (defaults to GOOGLE_APPLICATION_CREDENTIALS)")
+    p.add_argument("--rules-file", help="JSON file with target_rules (default: user_configs/{uid}.target_rules)")
+    p.add_argument("--apply", action="store_true", help="Write changed is_sms_target values")
+    p.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help=f"Entries per page (max {MAX_PAGE_SIZE})")
+    p.add_argument("--max-pages", type=int, default=0, help="Stop after N pages (resume later)")
+    p.add_argument("--run-id", help="Summary document id (default: <mode>-<rules hash>)")
+    p.add_argument("--restart", action="store_true", help="Ignore a saved cursor and start over")
+    p.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="Sample ids kept per change direction")
+    args = p.parse_args()
+
+    db = firestore_provider.get_client(args.sa_file)
+    if db is None:
+        raise SystemExit("Firestore is unavailable (google-cloud-firestore not installed?)")
+    rules = _load_rules(db, args.uid, args.rules_file)
+    t0 = time.perf_counter()
+
+    def _progress(s):
+        c = s["counts"]
+        rate = c["scanned"] / max(1e-9, time.perf_counter() - t0)
+        print(f"[{now_iso()}] cursor={s['cursor']} scanned={c['scanned']} targets={c['targets']} "
+              f"changed={c['newly_targeted'] + c['no_longer_targeted']} ({rate:.0f} entries/s)",
+              file=sys.stderr, flush=True)
+
+    result = run_backfill(db, args.uid, rules, apply=args.apply, page_size=args.page_size,
+                          run_id=args.run_id, restart=args.restart, max_pages=args.max_pages or None,
+                          samples=args.samples, on_page=_progress)
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str), flush=True)
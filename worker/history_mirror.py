@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rpa_history のローカル SQLite ミラー（オフライン集計用）。
+
+- RPA スクリプトが履歴を書くたびに同じエントリをここにも追記する（WAL モード）。既存の doc id は上書きしない
+  （Firestore の create() が重複として拒否するのと同じ）。変更は update_fields()、sync は Firestore の内容で上書き
+- 集計の「失敗」は実際に送信を試みた（sms_response がある）エントリのみ。対象外の応募者も sms_sent=False を持つため
+- (uid, createdAt) / (uid, 正規化電話番号) / (uid, 日付) にインデックス
+- sync: Firestore の rpa_history/{uid}/entries から取り込み（createdAt による差分 / --full で全件）
+- 集計: 日別件数、SMS 結果コード別の成功率（Firestore を読まずミリ秒で返す）
+
+Usage:
+    python history_mirror.py sync  --uid UID [--full] [--sa-file SA.json]
+    python history_mirror.py daily --uid UID [--days 30]
+    python history_mirror.py codes --uid UID [--days 30]
+
+Env:
+- RPA_STATE_DIR (default: worker/rpa_state)
+- RPA_HISTORY_MIRROR (default 1; 0 で RPA スクリプトからの追記を無効化)
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sms_ledger import STATE_DIR, normalize_phone
+from history_sink import history_day, sms_attempted, JST
+
+DEFAULT_DB_PATH = os.path.join(STATE_DIR, "history_mirror.sqlite3")
+SYNC_PAGE_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    uid TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    phone TEXT,
+    name TEXT,
+    source_url TEXT,
+    is_sms_target INTEGER NOT NULL DEFAULT 0,
+    sms_sent INTEGER,
+    sms_code TEXT,
+    deferred INTEGER NOT NULL DEFAULT 0,
+    sms_attempted INTEGER NOT NULL DEFAULT 0,
+    entry TEXT,
+    PRIMARY KEY (uid, doc_id)
+);
+CREATE INDEX IF NOT EXISTS idx_history_created ON history (uid, created_at);
+CREATE INDEX IF NOT EXISTS idx_history_phone ON history (uid, phone);
+"""
+# 集計クエリがテーブル本体を読まずに済むよう、集計列を含めた covering index（sms_attempted の移行後に作る）
+_DAY_INDEX = ("CREATE INDEX IF NOT EXISTS idx_history_day_v2 ON history"
+              " (uid, day, is_sms_target, sms_sent, sms_attempted, deferred, sms_code)")
+
+_INSERT = """
+INSERT INTO history (uid, doc_id, created_at, day, phone, name, source_url, is_sms_target, sms_sent, sms_code, deferred,
+                     sms_attempted, entry)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_UPSERT = _INSERT + """
+ON CONFLICT (uid, doc_id) DO UPDATE SET
+    created_at = excluded.created_at, day = excluded.day, phone = excluded.phone, name = excluded.name,
+    source_url = excluded.source_url, is_sms_target = excluded.is_sms_target, sms_sent = excluded.sms_sent,
+    sms_code = excluded.sms_code, deferred = excluded.deferred, sms_attempted = excluded.sms_attempted,
+    entry = excluded.entry
+"""
+_INSERT_NEW = _INSERT + " ON CONFLICT (uid, doc_id) DO NOTHING"
+
+
+def _sms_code(resp) -> Optional[str]:
+    if not isinstance(resp, dict):
+        return None
+    for k in ("code", "status"):
+        if resp.get(k) is not None:
+            return str(resp[k])
+    return None
+
+
+def _row(uid: str, doc_id: str, entry: dict) -> tuple:
+    try:
+        created_at = int(entry.get("createdAt") or 0)
+    except Exception:
+        created_at = 0
+    resp = entry.get("sms_response")
+    sent = entry.get("sms_sent")
+    return (
+        str(uid), str(doc_id), created_at, history_day(created_at or None),
+        normalize_phone(entry.get("phone")), str(entry.get("name") or ""), str(entry.get("source_url") or ""),
+        1 if entry.get("is_sms_target") else 0,
+        None if sent is None else (1 if sent else 0),
+        _sms_code(resp),
+        1 if isinstance(resp, dict) and resp.get("deferred") else 0,
+        1 if sms_attempted(entry) else 0,
+        json.dumps(entry, ensure_ascii=False, default=str),
+    )
+
+
+class HistoryMirror:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or DEFAULT_DB_PATH
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # 旧版のミラーには sms_attempted 列がない：entry の sms_response から埋めて集計インデックスを作り直す
+        cols = {r["name"] for r in self._conn.execute("PRAGMA table_info(history)").fetchall()}
+        if "sms_attempted" not in cols:
+            self._conn.execute("ALTER TABLE history ADD COLUMN sms_attempted INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE history SET sms_attempted = 1 WHERE json_type(entry, '$.sms_response') <> 'null'")
+        self._conn.execute("DROP INDEX IF EXISTS idx_history_day")
+        self._conn.execute(_DAY_INDEX)
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+    def upsert(self, uid: str, doc_id: str, entry: dict):
+        with self._lock:
+            self._conn.execute(_UPSERT, _row(uid, doc_id, entry))
+
+    def insert(self, uid: str, doc_id: str, entry: dict) -> bool:
+        """Add a new entry; an existing doc_id is left as is (False), like Firestore create()."""
+        with self._lock:
+            return self._conn.execute(_INSERT_NEW, _row(uid, doc_id, entry)).rowcount == 1
+
+    def upsert_many(self, uid: str, items) -> int:
+        """items: iterable of (doc_id, entry); written in one transaction."""
+        rows = [_row(uid, doc_id, entry) for doc_id, entry in items]
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(_UPSERT, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def update_fields(self, uid: str, doc_id: str, fields: dict):
+        """Apply a partial update (same shape as the Firestore update) to a mirrored entry."""
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM history WHERE uid = ? AND doc_id = ?", (str(uid), str(doc_id))).fetchone()
+        if row is None:
+            return False
+        try:
+            entry = json.loads(row["entry"] or "{}")
+        except Exception:
+            entry = {}
+        entry.update(fields or {})
+        self.upsert(uid, doc_id, entry)
+        return True
+
+    def max_created_at(self, uid: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(created_at) AS m FROM history WHERE uid = ?", (str(uid),)).fetchone()
+        return int(row["m"] or 0) if row else 0
+
+    def count(self, uid: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history WHERE uid = ?", (str(uid),)).fetchone()[0]
+
+    # ----------------- aggregates -----------------
+    def daily_volume(self, uid: str, since_day: Optional[str] = None) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, COUNT(*) AS processed, SUM(is_sms_target) AS targets,"
+                " SUM(CASE WHEN sms_sent = 1 THEN 1 ELSE 0 END) AS sms_sent,"
+                " SUM(CASE WHEN sms_sent = 0 AND sms_attempted = 1 AND deferred = 0 THEN 1 ELSE 0 END) AS sms_failed,"
+                " SUM(deferred) AS sms_deferred"
+                " FROM history WHERE uid = ? AND day >= ? GROUP BY day ORDER BY day",
+                (str(uid), since_day or ""),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def success_by_code(self, uid: str, since_day: Optional[str] = None) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT COALESCE(sms_code, '-') AS code, COUNT(*) AS attempts,"
+                " SUM(CASE WHEN sms_sent = 1 THEN 1 ELSE 0 END) AS sent"
+                " FROM history WHERE uid = ? AND day >= ? AND sms_attempted = 1 AND deferred = 0"
+                " GROUP BY code ORDER BY attempts DESC",
+                (str(uid), since_day or ""),
+            ).fetchall()
+        out = []
+        for r in rows:
+            d = dict(r)
+            d["success_rate"] = round(d["sent"] / d["attempts"], 4) if d["attempts"] else 0.0
+            out.append(d)
+        return out
+
+
+def sync_from_firestore(db, mirror: HistoryMirror, uid: str, full: bool = False,
+                        page_size: int = SYNC_PAGE_SIZE, on_page=None) -> int:
+    """Copy rpa_history/{uid}/entries into the mirror; incremental by createdAt unless full=True."""
+    coll = db.collection("rpa_history").document(str(uid)).collection("entries")
+    total = 0
+    if full:
+        cursor = None
+        while True:
+            q = coll.order_by("__name__").limit(page_size)
+            if cursor:
+                q = q.start_after({"__name__": cursor})
+            docs = list(q.stream())
+            if not docs:
+                break
+            total += mirror.upsert_many(uid, ((d.id, d.to_dict() or {}) for d in docs))
+            cursor = docs[-1].id
+            if on_page:
+                on_page(total)
+        return total
+
+    # 差分: ミラー内の最大 createdAt 以降（同一ミリ秒の取りこぼしを避けるため >=、upsert なので重複は無害）
+    since = mirror.max_created_at(uid)
+    last = None
+    while True:
+        q = coll.where(field_path="createdAt", op_string=">=", value=since).order_by("createdAt").limit(page_size)
+        if last is not None:
+            q = q.start_after(last)
+        docs = list(q.stream())
+        if not docs:
+            break
+        total += mirror.upsert_many(uid, ((d.id, d.to_dict() or {}) for d in docs))
+        last = docs[-1]
+        if on_page:
+            on_page(total)
+        if len(docs) < page_size:
+            break
+    return total
+
+
+def _since_day(days: int) -> Optional[str]:
+    if not days:
+        return None
+    return (datetime.now(JST) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Local SQLite mirror of rpa_history")
+    p.add_argument("command", choices=["sync", "daily", "codes"])
+    p.add_argument("--uid", required=True)
+    p.add_argument("--db", default=None, help=f"SQLite path (default {DEFAULT_DB_PATH})")
+    p.add_argument("--days", type=int, default=30, help="(daily/codes) last N days, 0 = all")
+    p.add_argument("--full", action="store_true", help="(sync) re-import every entry instead of only newer ones")
+    p.add_argument("--sa-file", help="(sync) service account JSON")
+    args = p.parse_args()
+
+    mirror = HistoryMirror(args.db)
+    t0 = time.perf_counter()
+    if args.command == "sync":
+        import firestore_provider
+
+        db = firestore_provider.get_client(args.sa_file)
+        if db is None:
+            raise SystemExit("Firestore is unavailable (google-cloud-firestore not installed?)")
+        n = sync_from_firestore(db, mirror, args.uid, full=args.full,
+                                on_page=lambda t: print(f"synced {t} entries...", file=sys.stderr, flush=True))
+        out = {"synced": n, "total": mirror.count(args.uid)}
+    elif args.command == "daily":
+        out = mirror.daily_volume(args.uid, _since_day(args.days))
+    else:
+        out = mirror.success_by_code(args.uid, _since_day(args.days))
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+    print(json.dumps(out, ensure_ascii=False, indent=2), flush=True)
+    print(f"({elapsed_ms:.1f} ms)", file=sys.stderr, flush=True)
+    mirror.close()
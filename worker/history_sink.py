@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rpa_history/{uid}/entries 的异步批量写入器。
+
+- enqueue() 只做缓冲并立即返回确定性的 doc id（不阻塞应募者处理）
+- 后台线程在满足以下任一条件时用 WriteBatch 一次提交：
+  缓冲条数 >= max_batch / 最早条目等待 >= max_age_s / flush() / close()
+- doc id 由内容决定（uid + 正規化電話番号 + 氏名 + source_url，不含时间），
+  用 create() 写入：同一应募者（同一应募链接）的重复条目无论隔多久都由服务端拒绝（ALREADY_EXISTS）；
+  电话与 source_url 都没有的条目无法识别应募者，改用 createdAt 区分（不做去重）
+- 进程内 LRU 记录最近写入的 doc id，命中时连 create() 都不发
+- 提交失败（重复以外的错误）时，未写入的条目放回缓冲头部按指数退避重试，最多 max_retries 次；
+  逐条 create 的回退中每条成功都立即计数并回调 on_written，单条失败只重试该条
+- 同一 WriteBatch 内用 Increment 更新 rpa_history/{uid}/daily/{YYYY-MM-DD}（JST）的日次集计
+  （processed / targets / sms_sent / sms_failed / sms_deferred），仪表盘每天只需读 1 个小文档
+"""
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+try:
+    from google.api_core.exceptions import AlreadyExists, Conflict
+    _DUPLICATE_ERRORS = (AlreadyExists, Conflict)
+except Exception:
+    _DUPLICATE_ERRORS = ()
+
+try:
+    from google.cloud.firestore import Increment
+except Exception:
+    Increment = None
+
+HISTORY_COLLECTION = "rpa_history"
+# Firestore WriteBatch 上限 500，这里保持较小以缩短等待
+DEFAULT_MAX_BATCH = 20
+DEFAULT_MAX_AGE_S = 2.0
+DEFAULT_LRU_SIZE = 1024
+# 提交失败时的重试次数与退避（RETRY_BASE_S * 2^(n-1)，上限 RETRY_MAX_S）
+DEFAULT_MAX_RETRIES = 3
+RETRY_BASE_S = 0.5
+RETRY_MAX_S = 8.0
+DAILY_COLLECTION = "daily"
+DAILY_COUNTERS = ("processed", "targets", "sms_sent", "sms_failed", "sms_deferred")
+JST = timezone(timedelta(hours=9))
+
+
+def history_doc_id(uid: str, entry: dict, normalize_phone: Callable[[Optional[str]], str]) -> str:
+    """Deterministic entry id: the same applicant (uid + phone + name + source_url) always maps to one doc.
+
+    No time component: createdAt is re-stamped on every poll, so a time bucket would let a
+    re-poll that crosses a bucket boundary (or comes minutes later) write a duplicate.
+    Entries with neither phone nor source_url cannot identify the applicant; they get
+    createdAt in the key instead, i.e. they are never merged.
+    """
+    phone = normalize_phone(entry.get("phone"))
+    source_url = str(entry.get("source_url") or "")
+    parts = [str(uid or ""), phone, str(entry.get("name") or "").strip(), source_url]
+    if not phone and not source_url:
+        parts.append(str(entry.get("createdAt") or ""))
+    raw = "\x1f".join(parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:28]
+
+
+def history_day(created_at_ms=None) -> str:
+    """JST calendar day (YYYY-MM-DD) of a createdAt value in epoch ms (now when missing)."""
+    try:
+        ts = int(created_at_ms) / 1000.0 if created_at_ms else time.time()
+    except Exception:
+        ts = time.time()
+    return datetime.fromtimestamp(ts, JST).strftime("%Y-%m-%d")
+
+
+def sms_attempted(entry: dict) -> bool:
+    """True when an SMS was actually attempted (or deferred) for the entry.
+
+    Non-targets also carry sms_sent=False, but with sms_response None; they are not failures.
+    """
+    return entry.get("sms_response") is not None
+
+
+def daily_deltas(entry: dict) -> dict:
+    """Counter increments contributed by one history entry."""
+    resp = entry.get("sms_response")
+    deferred = bool(isinstance(resp, dict) and resp.get("deferred"))
+    sent = entry.get("sms_sent")
+    return {
+        "processed": 1,
+        "targets": 1 if entry.get("is_sms_target") else 0,
+        "sms_sent": 1 if sent is True else 0,
+        "sms_failed": 1 if sent is False and sms_attempted(entry) and not deferred else 0,
+        "sms_deferred": 1 if deferred else 0,
+    }
+
+
+def merge_daily(per_day: dict, day: str, deltas: dict):
+    acc = per_day.setdefault(day, dict.fromkeys(DAILY_COUNTERS, 0))
+    for k, v in deltas.items():
+        acc[k] = acc.get(k, 0) + v
+
+
+def add_daily_writes(db, batch, uid: str, per_day: dict, collection: str = HISTORY_COLLECTION) -> int:
+    """Queue Increment updates of rpa_history/{uid}/daily/{day} into batch; returns the number of writes."""
+    if Increment is None:
+        return 0
+    n = 0
+    for day, deltas in per_day.items():
+        fields = {k: Increment(v) for k, v in deltas.items() if v}
+        if not fields:
+            continue
+        fields.update({"date": day, "uid": str(uid), "updated_at": int(time.time() * 1000)})
+        ref = db.collection(collection).document(str(uid)).collection(DAILY_COLLECTION).document(day)
+        batch.set(ref, fields, merge=True)
+        n += 1
+    return n
+
+
+def _is_duplicate_error(e: Exception) -> bool:
+    if _DUPLICATE_ERRORS and isinstance(e, _DUPLICATE_ERRORS):
+        return True
+    return type(e).__name__ in ("AlreadyExists", "Conflict")
+
+
+class HistorySink:
+    def __init__(self, db_factory: Callable[[], object], max_batch: int = DEFAULT_MAX_BATCH,
+                 max_age_s: float = DEFAULT_MAX_AGE_S, collection: str = HISTORY_COLLECTION,
+                 on_error: Optional[Callable[[str, Exception], None]] = None,
+                 on_duplicate: Optional[Callable[[str], None]] = None,
+                 lru_size: int = DEFAULT_LRU_SIZE, daily: bool = True, max_retries: int = DEFAULT_MAX_RETRIES):
+        """db_factory returns a Firestore client (or None when unavailable).
+
+        daily=True also maintains the per-day summary documents in the same commit.
+        Entries whose commit fails are retried up to max_retries times before on_error.
+        """
+        self._db_factory = db_factory
+        self.daily = daily
+        self._db = None
+        self.max_batch = max(1, int(max_batch))
+        self.max_age_s = float(max_age_s)
+        self.collection = collection
+        self._on_error = on_error
+        self._on_duplicate = on_duplicate
+        self._recent = OrderedDict()
+        self._lru_size = max(1, int(lru_size))
+        self._cond = threading.Condition()
+        self.max_retries = max(0, int(max_retries))
+        self._buf = []  # [(uid, doc_id, entry, on_written, enqueued_at, attempts)]
+        self._inflight = 0
+        self._closed = False
+        self.stats = {"enqueued": 0, "written": 0, "skipped": 0, "commits": 0, "retries": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="history-sink", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, uid: str, doc_id: str, entry: dict, on_written: Optional[Callable[[str], None]] = None) -> str:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("history sink is closed")
+            if doc_id in self._recent:
+                self._recent.move_to_end(doc_id)
+                self.stats["skipped"] += 1
+                duplicate = True
+            else:
+                self._remember(doc_id)
+                self._buf.append((str(uid), doc_id, entry, on_written, time.monotonic(), 0))
+                self.stats["enqueued"] += 1
+                self._cond.notify_all()
+                duplicate = False
+        if duplicate:
+            self._report_duplicate(doc_id)
+            if on_written:
+                try:
+                    on_written(doc_id)
+                except Exception:
+                    pass
+        return doc_id
+
+    def _remember(self, doc_id: str):
+        self._recent[doc_id] = True
+        if len(self._recent) > self._lru_size:
+            self._recent.popitem(last=False)
+
+    def _report_duplicate(self, doc_id: str):
+        if self._on_duplicate:
+            try:
+                self._on_duplicate(doc_id)
+            except Exception:
+                pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything enqueued so far has been committed (or failed)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._buf or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.5)
+        return True
+
+    def close(self, timeout: Optional[float] = 30.0):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # ----------------- background -----------------
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._buf:
+                    age = time.monotonic() - self._buf[0][4]
+                    if self._closed or len(self._buf) >= self.max_batch or age >= self.max_age_s:
+                        batch, self._buf = self._buf[:self.max_batch], self._buf[self.max_batch:]
+                        self._inflight += len(batch)
+                        return batch
+                    self._cond.wait(self.max_age_s - age)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            failed, error = [], None
+            try:
+                failed, error = self._commit(batch)
+            except Exception as e:
+                failed, error = batch, e
+            retry = [i[:5] + (i[5] + 1,) for i in failed if i[5] < self.max_retries]
+            given_up = [i for i in failed if i[5] >= self.max_retries]
+            with self._cond:
+                # 放回缓冲头部后才减 inflight，flush() 不会在重试前返回
+                self._buf[:0] = retry
+                self._inflight -= len(batch)
+                for i in given_up:
+                    self._recent.pop(i[1], None)
+                self._cond.notify_all()
+            if given_up:
+                self.stats["errors"] += 1
+                if self._on_error:
+                    try:
+                        self._on_error(",".join(i[1] for i in given_up), error)
+                    except Exception:
+                        pass
+            if retry:
+                self.stats["retries"] += len(retry)
+                # 后端故障时整个 sink 暂停（其余条目也会同样失败）
+                time.sleep(min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (retry[0][5] - 1)))
+
+    @staticmethod
+    def _written(doc_id: str, on_written):
+        if on_written:
+            try:
+                on_written(doc_id)
+            except Exception:
+                pass
+
+    def _commit(self, items):
+        """Commit one batch; returns (items not persisted, last error) for the caller to retry."""
+        if self._db is None:
+            self._db = self._db_factory()
+        db = self._db
+        if db is None:
+            return items, RuntimeError("firestore unavailable")
+        refs = [db.collection(self.collection).document(uid).collection("entries").document(doc_id)
+                for uid, doc_id, _, _, _, _ in items]
+        wb = db.batch()
+        per_uid_day = {}
+        for ref, (uid, _, entry, _, _, _) in zip(refs, items):
+            wb.create(ref, entry)
+            if self.daily:
+                merge_daily(per_uid_day.setdefault(uid, {}), history_day(entry.get("createdAt")), daily_deltas(entry))
+        for uid, per_day in per_uid_day.items():
+            add_daily_writes(db, wb, uid, per_day, self.collection)
+        try:
+            wb.commit()
+        except Exception as e:
+            if not _is_duplicate_error(e):
+                # WriteBatch 是原子的：一条都没有写入，整批重试
+                return items, e
+        else:
+            self.stats["commits"] += 1
+            self.stats["written"] += len(items)
+            for _, doc_id, _, on_written, _, _ in items:
+                self._written(doc_id, on_written)
+            return [], None
+
+        # 批次中有已存在的文档：整批被拒绝（日次集计也未生效），
+        # 逐条 create（+ 该条的日次 Increment）以写入其余条目；每条的结果立即记录
+        failed, error = [], None
+        for ref, item in zip(refs, items):
+            uid, doc_id, entry, on_written, _, _ = item
+            try:
+                if self.daily and Increment is not None:
+                    one = db.batch()
+                    one.create(ref, entry)
+                    per_day = {}
+                    merge_daily(per_day, history_day(entry.get("createdAt")), daily_deltas(entry))
+                    add_daily_writes(db, one, uid, per_day, self.collection)
+                    one.commit()
+                else:
+                    ref.create(entry)
+                self.stats["written"] += 1
+            except Exception as e2:
+                if not _is_duplicate_error(e2):
+                    failed.append(item)
+                    error = e2
+                    continue
+                # duplicates count as persisted too
+                self.stats["skipped"] += 1
+                self._report_duplicate(doc_id)
+            self._written(doc_id, on_written)
+        self.stats["commits"] += 1
+        return failed, error
@@ -9,7 +9,7 @@ os.environ.setdefault("GRPC_TRACE", "")
 os.environ.setdefault("GLOG_minloglevel", "2")
 
 import re, imaplib, email, time, datetime, urllib.parse, sys
-import json, signal, traceback
+import json, signal, traceback, threading
 from typing import Optional
 
 
@@ -109,6 +109,12 @@ from selenium.common.exceptions import TimeoutException, InvalidSessionIdExcepti
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 
+from sms_transport import post_sms, parse_retry_codes, is_valid_jp_phone, DEFAULT_TIMEOUT as SMS_POST_TIMEOUT
+import firestore_provider
+from config_cache import ConfigCache
+from target_rules import compiled_rules_for
+from history_sink import JST, history_day, merge_daily, add_daily_writes
+
 # 尝试把 stdout 设置为 utf-8（在某些 Windows 环境下需要）
 try:
     reconfig = getattr(sys.stdout, "reconfigure", None)
@@ -162,6 +168,59 @@ def emit(event_dict: dict, ja: Optional[str] = None, to_stdout: bool = False):
     except Exception:
         pass
 
+# ========= 事件通道 =========
+# worker 通过专用管道（RPA_EVENT_FD / Windows: RPA_EVENT_HANDLE）逐行读取 JSON 事件（NDJSON），
+# 每处理完一个应募者就能更新任务进度；常驻子进程模式下由 rpa_pool 通过 set_event_sink() 转发。
+_EVENT_SINK = None
+_EVENT_LOCK = threading.Lock()
+
+
+def set_event_sink(sink):
+    """sink(event_dict) を設定する（None で環境変数から開き直し、False で無効）。"""
+    global _EVENT_SINK
+    _EVENT_SINK = sink
+
+
+def _open_event_sink():
+    fd = None
+    try:
+        if os.environ.get('RPA_EVENT_FD'):
+            fd = int(os.environ['RPA_EVENT_FD'])
+        elif os.environ.get('RPA_EVENT_HANDLE') and sys.platform.startswith("win"):
+            import msvcrt
+            fd = msvcrt.open_osfhandle(int(os.environ['RPA_EVENT_HANDLE']), 0)
+    except Exception:
+        fd = None
+    if fd is None:
+        return False
+    try:
+        # chromedriver 等の孫プロセスには渡さない（渡すと worker 側の EOF が遅れる）
+        os.set_inheritable(fd, False)
+    except Exception:
+        pass
+    f = os.fdopen(fd, "w", encoding="utf-8", newline="\n")
+
+    def _write(evt):
+        f.write(json.dumps(evt, ensure_ascii=False, default=str) + "\n")
+        f.flush()
+    return _write
+
+
+def send_event(kind: str, **payload):
+    """Write one event line to the worker (no-op when no channel is open)."""
+    global _EVENT_SINK
+    with _EVENT_LOCK:
+        if _EVENT_SINK is None:
+            _EVENT_SINK = _open_event_sink()
+        if not _EVENT_SINK:
+            return
+        try:
+            _EVENT_SINK({"type": kind, "ts": int(time.time() * 1000), **payload})
+        except Exception:
+            # worker 側が閉じた（BrokenPipe 等）: 以降は送らない
+            _EVENT_SINK = False
+
+
 # ========= 配置 =========
 IMAP_HOST = "imap.gmail.com"
 # 不在源码中保存敏感凭据，默认留空。
@@ -175,61 +234,106 @@ SITE_PASS = os.environ.get('SITE_PASS', '')
 SUBJECT_KEYWORD = "【新しい応募者のお知らせ】"
 ALLOWED_DOMAINS = {"indeed.com", "jp.indeed.com", "indeedemail.com", "cts.indeed.com"}
 
-# 尝试从 stdin 读取 JSON 配置（由后端传入），格式: {"config": { ... }}
+_DEFAULT_SUBJECT_KEYWORD = SUBJECT_KEYWORD
+_DEFAULT_ALLOWED_DOMAINS = set(ALLOWED_DOMAINS)
+
+# 运行时配置：脚本启动时由 load_cfg_from_argv() 读取，作为库调用时由 run(cfg, uid) 设置
 cfg = {}
-# 支持通过命令行参数传入配置文件路径: --cfg-file=PATH
-try:
-    for a in sys.argv[1:]:
-        if a.startswith("--cfg-file="):
-            cfg_path = a.split("=", 1)[1]
-            try:
-                with open(cfg_path, 'r', encoding='utf-8') as f:
-                    payload = json.load(f)
-                    cfg = payload.get('config') or payload
-            except Exception:
-                cfg = {}
-            break
-except Exception:
-    cfg = {}
 
-# 如果没有 cfg-file，再尝试从 stdin 读取（保持兼容）
-try:
-    if not cfg and not sys.stdin.isatty():
-        raw = sys.stdin.read()
-        if raw:
-            try:
-                payload = json.loads(raw)
-                cfg = payload.get('config') or payload
-            except Exception:
-                cfg = {}
-except Exception:
-    cfg = cfg or {}
 
+def _parse_cfg_payload(raw) -> dict:
+    if not raw:
+        return {}
+    try:
+        payload = json.loads(raw)
+    except Exception:
+        return {}
+    if not isinstance(payload, dict):
+        return {}
+    if 'config' in payload:
+        return payload['config'] or {}
+    return payload
 
-def try_fetch_cfg_from_firestore_if_available(user_uid: Optional[str]):
-    """尝试使用 GOOGLE_APPLICATION_CREDENTIALS 拉取 Firestore 中的 user_configs/{user_uid} 文档。
-    若环境或依赖不可用则返回 None。
+
+def load_cfg_from_argv(argv=None) -> dict:
+    """读取配置（格式: {"config": {...}} 或配置本身）：
+
+    - --cfg-stdin: 从 stdin 管道读取（worker 使用的方式，不落盘）
+    - --cfg-file=PATH / --cfg-file PATH: 从 JSON 文件读取（手动调试用）
+    - 都没有时，stdin 不是 TTY 则从 stdin 读取（保持兼容）
     """
+    args = list(sys.argv[1:] if argv is None else argv)
     try:
-        import firebase_admin
-        from firebase_admin import credentials, firestore
+        if "--cfg-stdin" in args:
+            return _parse_cfg_payload(sys.stdin.read())
+        for i, a in enumerate(args):
+            cfg_path = None
+            if a.startswith("--cfg-file="):
+                cfg_path = a.split("=", 1)[1]
+            elif a == "--cfg-file" and i + 1 < len(args):
+                cfg_path = args[i + 1]
+            if cfg_path is not None:
+                with open(cfg_path, 'r', encoding='utf-8') as f:
+                    return _parse_cfg_payload(f.read())
+    except Exception:
+        return {}
+
+    # 如果没有 cfg-file，再尝试从 stdin 读取（保持兼容）
+    try:
+        if not sys.stdin.isatty():
+            return _parse_cfg_payload(sys.stdin.read())
+    except Exception:
+        pass
+    return {}
+
+
+def get_firestore_db():
+    """共享的 Firestore client（firestore_provider）；无服务账号或依赖时、或离线后端时返回 None。"""
+    if _offline_storage() is not None:
+        return None
+    try:
+        return firestore_provider.get_client(allow_default=False)
     except Exception:
         return None
 
+
+_OFFLINE_STORAGE = None
+
+
+def _offline_storage():
+    """RPA_STORAGE_BACKEND=sqlite 时与 worker 共用的本地存储（配置 / 履历）；否则 None。"""
+    global _OFFLINE_STORAGE
+    if _OFFLINE_STORAGE is None:
+        try:
+            import storage
+            _OFFLINE_STORAGE = storage.open_storage() if storage.backend_name() == "sqlite" else False
+        except Exception:
+            _OFFLINE_STORAGE = False
+    return _OFFLINE_STORAGE or None
+
+
+_CONFIG_CACHE = None
+
+
+def _get_config_cache() -> ConfigCache:
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = ConfigCache(get_firestore_db)
+    return _CONFIG_CACHE
+
+
+def try_fetch_cfg_from_firestore_if_available(user_uid: Optional[str]):
+    """尝试使用服务账号（GOOGLE_APPLICATION_CREDENTIALS / SERVICE_ACCOUNT_PATH）拉取 Firestore 中的 user_configs/{user_uid} 文档。
+    若环境或依赖不可用则返回 None。
+    经由 config_cache：首次读取后由 on_snapshot 监听保持最新，之后的调用不再访问 Firestore。
+    """
+    if not user_uid:
+        return None
     try:
-        # Initialize firebase_admin using service account path from env if not already
-        if not firebase_admin._apps:
-            cred_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-            if not cred_path or not os.path.exists(cred_path):
-                return None
-            cred = credentials.Certificate(cred_path)
-            firebase_admin.initialize_app(cred)
-
-        db = firestore.client()
-        doc = db.collection('user_configs').document(str(user_uid)).get()
-        if not doc.exists:
-            return None
-        return doc.to_dict()
+        store = _offline_storage()
+        if store is not None:
+            return store.configs.get(str(user_uid))
+        return _get_config_cache().get(str(user_uid))
     except Exception:
         return None
 
@@ -259,25 +363,87 @@ def _normalize_phone_for_compare(phone: Optional[str]) -> str:
     except Exception:
         return str(phone or "")
 
-def write_history_entry_to_firestore(user_uid: str, entry: dict):
-    """Single immediate history write with normalization and idempotency guard."""
-    try:
-        import firebase_admin
-        from firebase_admin import credentials, firestore
-    except Exception:
-        return False
+def _history_firestore_db():
+    """Firestore client for history writes (None when credentials are unavailable)."""
+    db = get_firestore_db()
+    if db is None:
+        emit({"event": "history_error", "error": "no_service_account"}, ja="サービスアカウントが見つかりません")
+    return db
+
+
+def _on_history_duplicate(doc_id: str):
+    emit({"event": "history_skip_duplicate", "doc": doc_id}, ja="直近の重複を検出し履歴をスキップしました")
+
+
+def _on_history_error(doc_ids: str, e: Exception):
+    emit({"event": "history_error", "docs": doc_ids, "error": str(e)[:1000]}, ja="履歴保存でエラーが発生しました")
+
+
+_HISTORY_SINK = None
 
-    try:
-        if not firebase_admin._apps:
-            cred_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-            if not cred_path or not os.path.exists(cred_path):
-                emit({"event": "history_error", "error": "no_service_account", "uid": str(user_uid)}, ja="サービスアカウントが見つかりません")
-                return False
-            cred = credentials.Certificate(cred_path)
-            firebase_admin.initialize_app(cred)
-        db = firestore.client()
-        coll = db.collection('rpa_history').document(str(user_uid)).collection('entries')
 
+def _get_history_sink():
+    global _HISTORY_SINK
+    if _HISTORY_SINK is None:
+        from history_sink import HistorySink
+        _HISTORY_SINK = HistorySink(
+            _history_firestore_db,
+            max_batch=int(os.environ.get("RPA_HISTORY_BATCH_SIZE", "20")),
+            max_age_s=float(os.environ.get("RPA_HISTORY_FLUSH_SECONDS", "2")),
+            on_error=_on_history_error,
+            on_duplicate=_on_history_duplicate,
+        )
+    return _HISTORY_SINK
+
+
+def flush_history(timeout: Optional[float] = 30.0) -> bool:
+    """Wait until buffered history entries are committed."""
+    if _HISTORY_SINK is None:
+        return True
+    return _HISTORY_SINK.flush(timeout)
+
+
+def close_history_sink():
+    global _HISTORY_SINK
+    if _HISTORY_SINK is not None:
+        try:
+            _HISTORY_SINK.close()
+            emit({"event": "history_sink_closed", **_HISTORY_SINK.stats}, ja=f"履歴を保存しました（{_HISTORY_SINK.stats.get('written', 0)} 件 / {_HISTORY_SINK.stats.get('commits', 0)} コミット）")
+        except Exception:
+            pass
+        _HISTORY_SINK = None
+
+
+_HISTORY_MIRROR = None
+
+
+def _get_history_mirror():
+    """Lazily open the local SQLite history mirror; None when disabled or unavailable."""
+    global _HISTORY_MIRROR
+    if _HISTORY_MIRROR is None:
+        if os.environ.get("RPA_HISTORY_MIRROR", "1") == "0":
+            _HISTORY_MIRROR = False
+        else:
+            try:
+                from history_mirror import HistoryMirror
+                _HISTORY_MIRROR = HistoryMirror()
+            except Exception as e:
+                try:
+                    emit({"event": "history_mirror_unavailable", "error": str(e)[:1000]}, ja="履歴のローカルミラーを開けませんでした（Firestore のみに保存します）")
+                except Exception:
+                    pass
+                _HISTORY_MIRROR = False
+    return _HISTORY_MIRROR or None
+
+
+def write_history_entry_to_firestore(user_uid: str, entry: dict, on_written=None):
+    """Normalize one history entry and hand it to the background batch writer.
+
+    Returns the deterministic document id immediately (the commit happens in
+    the background; on_written(doc_id) is called once it is persisted), or
+    False when the entry could not be queued.
+    """
+    try:
         # Normalize name/furigana and phone for uniform display and duplicate detection
         try:
             nm, fu = _normalize_name_and_furigana(entry.get("name") or entry.get("姓名（ふりがな）") or "")
@@ -293,89 +459,138 @@ def write_history_entry_to_firestore(user_uid: str, entry: dict):
         except Exception:
             pass
 
-        # Idempotency: skip if a very recent entry exists with same normalized name+phone
-        try:
-            norm_name = str(entry.get("name") or "").strip()
-            norm_phone_cmp = _normalize_phone_for_compare(entry.get("phone"))
-            # time window: last 2 minutes (120000 ms)
-            now_ms = int(time.time() * 1000)
-            window_ms = 120000
-            since_ms = now_ms - window_ms
-            # query limited recent entries to reduce cost
+        from history_sink import history_doc_id
+        doc_id = history_doc_id(str(user_uid), entry, _normalize_phone_for_compare)
+        mirror = _get_history_mirror()
+        if mirror:
             try:
-                from google.cloud import firestore as _gcf
-                _DESC = _gcf.Query.DESCENDING
+                # 既存の doc id（Firestore が重複として拒否する再処理分）は上書きしない
+                mirror.insert(str(user_uid), doc_id, entry)
             except Exception:
-                _DESC = "DESCENDING"
-            recent_q = coll.order_by("createdAt", direction=_DESC).limit(50)
-            recent_docs = list(recent_q.stream())
-            for d in recent_docs:
-                try:
-                    data = d.to_dict() or {}
-                    cat = int(data.get("createdAt") or 0)
-                    if cat and cat < since_ms:
-                        # older than window -> stop scanning
-                        break
-                    dn = str(data.get("name") or "").strip()
-                    dp = _normalize_phone_for_compare(data.get("phone"))
-                    if dn == norm_name and dp == norm_phone_cmp:
-                        # duplicate within time window
-                        emit({"event": "history_skip_duplicate", "uid": user_uid, "name": dn}, ja="直近の重複を検出し履歴をスキップしました")
-                        return True
-                except Exception:
-                    continue
+                pass
+        store = _offline_storage()
+        if store is not None:
+            store.history.append(str(user_uid), [entry])
+            if on_written:
+                on_written(doc_id)
+            return doc_id
+        return _get_history_sink().enqueue(str(user_uid), doc_id, entry, on_written=on_written)
+    except Exception as e:
+        try:
+            emit({"event": "history_error", "uid": str(user_uid), "error": str(e)[:1000]}, ja="履歴保存でエラーが発生しました")
         except Exception:
             pass
+        return False
 
-        coll.add(entry)
-        return True
+
+# 已确认存在计数器文档的 uid（避免重复做初始化检查）
+_SMS_TEMPLATE_SEQ_SEEDED = set()
+
+
+def _next_sms_template_seq(user_uid: str) -> Optional[int]:
+    """Return the current A/B alternation sequence for user_uid and advance it by one.
+
+    The counter lives in rpa_counters/{uid}.sms_template_seq and is bumped inside a
+    transaction, so concurrent workers never pick the same slot. On first use the
+    counter is seeded from an aggregation count() of the user's history entries so
+    the existing A/B order continues. Returns None when Firestore is unavailable.
+    """
+    firestore = firestore_provider.firestore
+    try:
+        db = get_firestore_db()
+        if db is None:
+            return None
+        counter_ref = db.collection('rpa_counters').document(str(user_uid))
+
+        seed = 0
+        if user_uid not in _SMS_TEMPLATE_SEQ_SEEDED:
+            try:
+                if not counter_ref.get().exists:
+                    agg = db.collection('rpa_history').document(str(user_uid)).collection('entries').count().get()
+                    seed = int(agg[0][0].value)
+            except Exception:
+                seed = 0
+
+        @firestore.transactional
+        def _bump(tx):
+            snap = counter_ref.get(transaction=tx)
+            data = (snap.to_dict() or {}) if snap.exists else {}
+            try:
+                cur = int(data.get('sms_template_seq', seed))
+            except Exception:
+                cur = seed
+            tx.set(counter_ref, {
+                'sms_template_seq': cur + 1,
+                'updatedAt': int(time.time() * 1000),
+            }, merge=True)
+            return cur
+
+        seq = _bump(db.transaction())
+        _SMS_TEMPLATE_SEQ_SEEDED.add(user_uid)
+        return seq
     except Exception as e:
         try:
-            emit({"event": "history_error", "uid": str(user_uid), "error": str(e)[:1000]}, ja="履歴保存でエラーが発生しました")
+            emit({"event": "sms_template_seq_error", "uid": str(user_uid), "error": str(e)[:1000]}, ja="テンプレート交替カウンタの取得に失敗しました")
         except Exception:
             pass
-        return False
+        return None
 
 
-# 应用配置到变量
-try:
-    if isinstance(cfg, dict):
-        IMAP_USER = cfg.get('email_config', {}).get('address') or cfg.get('IMAP_USER') or IMAP_USER
-        IMAP_PASS = cfg.get('email_config', {}).get('app_password') or cfg.get('IMAP_PASS') or IMAP_PASS
-        SITE_USER = cfg.get('email_config', {}).get('address') or SITE_USER
-        SITE_PASS = cfg.get('email_config', {}).get('site_password') or SITE_PASS
-        SUBJECT_KEYWORD = cfg.get('SUBJECT_KEYWORD') or SUBJECT_KEYWORD
-        domains = cfg.get('ALLOWED_DOMAINS')
-        if isinstance(domains, (list, tuple)):
-            ALLOWED_DOMAINS = set(domains)
-        elif isinstance(domains, str):
-            ALLOWED_DOMAINS = set(x.strip() for x in domains.split(','))
-
-    # 当没有从命令行/stdin 获得凭据时，尝试通过环境变量 USER_UID + 服务账号从 Firestore 读取
-    if (not cfg or not isinstance(cfg, dict) or not cfg.get('email_config')) and os.environ.get('USER_UID'):
-        fetched = try_fetch_cfg_from_firestore_if_available(os.environ.get('USER_UID'))
-        if fetched and isinstance(fetched, dict):
-            cfg = {**(fetched or {}), **(cfg or {})}
-            IMAP_USER = cfg.get('email_config', {}).get('address') or IMAP_USER
-            IMAP_PASS = cfg.get('email_config', {}).get('app_password') or IMAP_PASS
+def apply_cfg(new_cfg, user_uid: Optional[str] = None) -> bool:
+    """把配置应用到模块变量（IMAP / 站点凭据、主题关键字、允许的域名）。
+
+    每次都从默认值重新计算，同一进程连续处理不同用户时不会残留上一个用户的凭据。
+    返回是否具备 IMAP 凭据。
+    """
+    global cfg, IMAP_USER, IMAP_PASS, SITE_USER, SITE_PASS, SUBJECT_KEYWORD, ALLOWED_DOMAINS
+    cfg = dict(new_cfg) if isinstance(new_cfg, dict) else {}
+    IMAP_USER, IMAP_PASS = "", ""
+    SITE_USER = os.environ.get('SITE_USER', '')
+    SITE_PASS = os.environ.get('SITE_PASS', '')
+    SUBJECT_KEYWORD = _DEFAULT_SUBJECT_KEYWORD
+    ALLOWED_DOMAINS = set(_DEFAULT_ALLOWED_DOMAINS)
+    user_uid = user_uid or os.environ.get('USER_UID')
+    try:
+        if cfg:
+            IMAP_USER = cfg.get('email_config', {}).get('address') or cfg.get('IMAP_USER') or IMAP_USER
+            IMAP_PASS = cfg.get('email_config', {}).get('app_password') or cfg.get('IMAP_PASS') or IMAP_PASS
             SITE_USER = cfg.get('email_config', {}).get('address') or SITE_USER
             SITE_PASS = cfg.get('email_config', {}).get('site_password') or SITE_PASS
+            SUBJECT_KEYWORD = cfg.get('SUBJECT_KEYWORD') or SUBJECT_KEYWORD
+            domains = cfg.get('ALLOWED_DOMAINS')
+            if isinstance(domains, (list, tuple)):
+                ALLOWED_DOMAINS = set(domains)
+            elif isinstance(domains, str):
+                ALLOWED_DOMAINS = set(x.strip() for x in domains.split(','))
+
+        # 当没有从命令行/stdin 获得凭据时，尝试通过 USER_UID + 服务账号从 Firestore 读取
+        if not cfg.get('email_config') and user_uid:
+            fetched = try_fetch_cfg_from_firestore_if_available(user_uid)
+            if fetched and isinstance(fetched, dict):
+                cfg = {**(fetched or {}), **(cfg or {})}
+                IMAP_USER = cfg.get('email_config', {}).get('address') or IMAP_USER
+                IMAP_PASS = cfg.get('email_config', {}).get('app_password') or IMAP_PASS
+                SITE_USER = cfg.get('email_config', {}).get('address') or SITE_USER
+                SITE_PASS = cfg.get('email_config', {}).get('site_password') or SITE_PASS
+    except Exception:
+        pass
+    return bool(IMAP_USER and IMAP_PASS)
+
 
+def _exit_for_missing_credentials():
     # 安全策略：如果最终没有 IMAP_USER/IMAP_PASS，则停止并返回错误，避免回退到源码中可能的敏感值
-    if not IMAP_USER or not IMAP_PASS:
-        print("ERROR: IMAP の認証情報が設定されていません。--cfg-file または stdin の email_config、あるいは USER_UID と GOOGLE_APPLICATION_CREDENTIALS を設定してください。", file=sys.stderr)
-        # 如果希望保留进程用于调试，可设置 NO_SYS_EXIT=1 或 KEEP_BROWSER_OPEN=1
-        noexit = os.environ.get('NO_SYS_EXIT')
-        if noexit and noexit != '0':
-            try:
-                emit({"evt": "sys_exit_blocked", "reason": "no_imap_credentials"}, ja="IMAP認証情報が不足しています。プロセスを停止しません。")
-            except Exception:
-                pass
-            # do not exit so developer can inspect environment and browser
-        else:
-            sys.exit(2)
-except Exception:
-    pass
+    print("ERROR: IMAP の認証情報が設定されていません。--cfg-stdin（worker が stdin で渡す）/--cfg-file の email_config、あるいは USER_UID と GOOGLE_APPLICATION_CREDENTIALS を設定してください。", file=sys.stderr)
+    # 如果希望保留进程用于调试，可设置 NO_SYS_EXIT=1 或 KEEP_BROWSER_OPEN=1
+    noexit = os.environ.get('NO_SYS_EXIT')
+    if noexit and noexit != '0':
+        try:
+            emit({"evt": "sys_exit_blocked", "reason": "no_imap_credentials"}, ja="IMAP認証情報が不足しています。プロセスを停止しません。")
+        except Exception:
+            pass
+        # do not exit so developer can inspect environment and browser
+    else:
+        sys.exit(2)
+
 
 # ========= 工具 =========
 def decode_any(s, charset=None):
@@ -533,7 +748,9 @@ def make_driver():
     opts.add_argument("--no-sandbox")
     opts.add_argument("--disable-gpu")
     opts.add_argument("--window-size=1400,950")
-    user_data_dir = os.path.abspath("chrome_user_data")
+    # worker 并行执行时按槽位 × 用户分配（RPA_CHROME_PROFILE_DIR），Chrome 会锁定配置目录，不能共用
+    user_data_dir = os.environ.get('RPA_CHROME_PROFILE_DIR') or os.path.abspath("chrome_user_data")
+    os.makedirs(user_data_dir, exist_ok=True)
     opts.add_argument(f"--user-data-dir={user_data_dir}")
     # Create driver and emit a short, simple Japanese diagnostic line with path/version
     driver = uc.Chrome(options=opts)
@@ -875,8 +1092,6 @@ def format_candidate_card(result: dict, uid: Optional[str] = None) -> str:
 def send_sms_if_configured(phone, name=""):
     """发送SMS（如果配置了SMS API）"""
     try:
-        import requests
-
         # 优先使用前端的sms_config结构，兼容旧的sms_api结构
         sms_config = cfg.get("sms_config") if isinstance(cfg, dict) else {}
         sms_api = cfg.get("sms_api") if isinstance(cfg, dict) else {}
@@ -920,30 +1135,6 @@ def send_sms_if_configured(phone, name=""):
         # 自动转换为日本手机号格式（API要求：仅数字，无+号）
         phone_for_api = re.sub(r"[^0-9]", "", str(phone))
 
-        def is_valid_jp_phone(num):
-            """
-            严格按API要求校验手机号：
-            1. 仅数字。
-            2. 11位：020X, 060X, 070X, 080X, 090X（X为1-9）。
-            3. 14位：0200, 0600, 0700, 0800, 0900开头。
-            4. 8180, 8190开头的值：12位以内。
-            5. 0或81以外开头的值：6~20位。
-            """
-            if not num.isdigit():
-                return False
-            l = len(num)
-            if l == 11 and re.match(r"^(020[1-9]|060[1-9]|070[1-9]|080[1-9]|090[1-9])", num):
-                return True
-            if l == 14 and re.match(r"^(0200|0600|0700|0800|0900)", num):
-                return True
-            if re.match(r"^(8180|8190)", num) and l <= 12:
-                return True
-            # 兜底规则：只要是 6~20 位数字就接受（覆盖各种区号/国际码情况），
-            # 以减少因本地/国际前缀判断不一致导致的拒绝（出现560错误）的情况。
-            if 6 <= l <= 20:
-                return True
-            return False
-
         if not is_valid_jp_phone(phone_for_api):
             return {"success": False, "error": f"電話番号の形式が API の要件に合いません: {phone_for_api}"}
 
@@ -959,7 +1150,7 @@ def send_sms_if_configured(phone, name=""):
         chosen_source = None
         message = None
         # 当用户同时勾选 template1 和 template2 时，按先后顺序交替发送：A, B, A, B...
-        # 优先策略：如果有 USER_UID 并且能够访问 Firestore，则根据历史记录条目数的奇偶决定使用哪个模板；
+        # 优先策略：如果有 USER_UID 并且能够访问 Firestore，则根据 rpa_counters/{uid} 计数器的奇偶决定使用哪个模板；
         # 如果无法访问 Firestore，则在进程内使用简单的切换器（非持久化）。
         alternate_choice = None
         try:
@@ -985,23 +1176,8 @@ def send_sms_if_configured(phone, name=""):
                         uid = os.environ.get("USER_UID")
                         count = None
                         if uid:
-                            try:
-                                import firebase_admin
-                                from firebase_admin import credentials, firestore
-                                if not firebase_admin._apps:
-                                    cred_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-                                    if cred_path and os.path.exists(cred_path):
-                                        cred = credentials.Certificate(cred_path)
-                                        firebase_admin.initialize_app(cred)
-                                db = firestore.client()
-                                # 尝试统计历史条目数（如大量文档此操作可优化）
-                                try:
-                                    docs = list(db.collection('rpa_history').document(str(uid)).collection('entries').stream())
-                                    count = len(docs)
-                                except Exception:
-                                    count = None
-                            except Exception:
-                                count = None
+                            # 每用户一个交替计数器（事务递增），不再拉取全部历史
+                            count = _next_sms_template_seq(uid)
 
                         if count is not None:
                             # 如果 count 为偶数则使用 template1 (A)，奇数使用 template2 (B)
@@ -1058,346 +1234,332 @@ def send_sms_if_configured(phone, name=""):
         except Exception:
             pass
 
-        data = {"mobilenumber": phone_for_api, "smstext": message.replace("&", "＆")}
-        # 构建 Basic Auth header
-        import base64
-        auth_str = f"{api_id}:{api_password}"
-        auth_b64 = base64.b64encode(auth_str.encode("utf-8")).decode("ascii")
-        headers = {
-            "Authorization": f"Basic {auth_b64}",
-            "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-            "User-Agent": "python-fetch/1.0",
-            "Connection": "close",
-        }
-        # 决定重试状态码，从 sms_config 中读取，默认 [560]
-        retry_codes_raw = []
-        try:
-            if isinstance(sms_config, dict):
-                retry_codes_raw = sms_config.get("retry_status_codes") or sms_config.get("retry_on_status") or [560]
-        except Exception:
-            retry_codes_raw = [560]
-        retry_codes = []
-        if isinstance(retry_codes_raw, (list, tuple)):
-            for v in retry_codes_raw:
-                try:
-                    retry_codes.append(int(v))
-                except Exception:
-                    continue
-        else:
+        def _on_attempt(attempt, mobile, status):
             try:
-                retry_codes = [int(retry_codes_raw)]
+                if attempt == "local":
+                    emit({"evt": "sms_attempt", "attempt": attempt, "mobile": mobile, "status": status}, ja=f"SMS送信試行: {mobile} ステータス {status}")
+                else:
+                    emit({"evt": "sms_retry", "attempt": attempt, "mobile": mobile, "status": status}, ja=f"SMS再試行: {mobile} ステータス {status}")
             except Exception:
-                retry_codes = [560]
-
-        def to_local(num: str) -> str:
-            # 若以 81 开头，转换为 0 + rest；若以 0 开头则返回原值；否则直接返回
-            if num.startswith("81"):
-                return "0" + num[2:]
-            return num
-
-        def to_81(num: str) -> str:
-            if num.startswith("0"):
-                return "81" + num[1:]
-            if num.startswith("81"):
-                return num
-            return num
-
-        def post_once(mobile: str):
-            body = {"mobilenumber": mobile, "smstext": data.get("smstext")}
-            try:
-                r = requests.post(api_url, data=body, headers=headers, timeout=30)
-                return r.status_code, (r.text if isinstance(r.text, str) else json.dumps(r.text))
-            except Exception as e:
-                return 0, str(e)
-
-        # 先尝试本地格式，再根据重试码决定是否使用 81 格式重试
-        local_num = to_local(phone_for_api)
-        alt_81 = to_81(local_num)
+                pass
 
-        status1, text1 = post_once(local_num)
+        # HTTP 发送 / 81 格式重试 / code 归一化（sms_transport）
+        result = post_sms(api_url, api_id, api_password, phone_for_api, message,
+                          retry_codes=parse_retry_codes(sms_config), on_attempt=_on_attempt)
+        final_status, code, level = result.get("status"), result.get("code"), result.get("level")
         try:
-            emit({"evt": "sms_attempt", "attempt": "local", "mobile": local_num, "status": status1}, ja=f"SMS送信試行: {local_num} ステータス {status1}")
+            emit({"event": "sms_result_normalized", "status": final_status, "code": code, "level": level}, ja=(f"SMS結果: {level} コード {code}" if code else "SMS結果: 解析できませんでした"))
         except Exception:
             pass
+        return result
+    except Exception as e:
+        return {"success": False, "error": str(e)}
 
-        final_status, final_text = status1, text1
-        retry_attempted = False
-        if status1 in retry_codes:
-            retry_attempted = True
-            status2, text2 = post_once(alt_81)
-            try:
-                emit({"evt": "sms_retry", "attempt": "alt_81", "mobile": alt_81, "status": status2}, ja=f"SMS再試行: {alt_81} ステータス {status2}")
-            except Exception:
-                pass
-            final_status, final_text = status2, text2
-
-        # 映射供应商返回到统一的 code/message/level（参考 src/lib/smsCodes.ts）
-        SMS_CONSOLE = {
-            "200": ("success", "Success / 送信成功"),
-            "401": ("failed", "Authorization Required / 認証エラー"),
-            "402": ("failed", "Overlimit / 送信上限超過（Failed to send due to Overlimit）"),
-            "405": ("failed", "Method not allowed / メソッドが許可されていない"),
-            "414": ("failed", "URL が長過ぎる（GET では 8190 bytes 超）"),
-            "500": ("error",  "Internal Server Error / 内部サーバーエラー"),
-            "502": ("error",  "Bad gateway / サービス障害"),
-            "503": ("error",  "Temporary unavailable / 秒間リクエスト上限(80 req/sec) 到達"),
-            "550": ("failed", "Failure / 失敗"),
-            "555": ("failed", "IP アドレスがブロックされている（認証エラー連続で発生）"),
-            "557": ("failed", "禁止された IP アドレス"),
-            "560": ("failed", "携帯番号（mobilenumber）が不正"),
-            "562": ("failed", "SMS 送信日時（startdate）が無効"),
-            "568": ("failed", "au 向けタイトル（autitle）が不正"),
-            "569": ("failed", "SoftBank 向けタイトル（softbanktitle）が不正"),
-            "570": ("failed", "SMS テキスト ID（smstextid）が不正"),
-            "571": ("failed", "再送信回数（sendingattempts）が不正"),
-            "572": ("failed", "再送間隔（resendinginterval）が不正"),
-            "573": ("failed", "status の値が不正"),
-            "574": ("failed", "SMS ID（smsid）が不正"),
-            "575": ("failed", "docomo の値が不正"),
-            "576": ("failed", "au の値が不正"),
-            "577": ("failed", "SoftBank の値が不正"),
-            "578": ("failed", "SIM の値が不正"),
-            "579": ("failed", "gateway の値が不正"),
-            "580": ("failed", "SMS タイトル（smstitle）が不正"),
-            "585": ("failed", "SMS テキスト（smstext）が不正"),
-            "587": ("failed", "SMS ID が一意ではない（重複）"),
-            "590": ("failed", "Original URL（originalurl）が不正"),
-            "591": ("failed", "SMS テキストタイプが無効（smstext type disabled）"),
-            "592": ("failed", "送信許可時間外（Time is disabled）"),
-            "598": ("failed", "Docomo 向けタイトル（docomotitle）が不正"),
-            "599": ("failed", "再送信機能が無効（有料オプション未契約）"),
-            "601": ("failed", "送信元番号選択機能が OFF（サポートへ連絡）"),
-            "605": ("failed", "type の値が不正（Invalid type）"),
-            "606": ("failed", "この API は無効（This API is disabled）"),
-            "608": ("failed", "登録日（registrationdate）が無効（最大24ヶ月前まで）"),
-            "610": ("failed", "キャリア判定機能（HLR）が無効"),
-            "615": ("failed", "JSON 形式が不正"),
-            "624": ("failed", "重複 SMSID（30日以内の同一 smsid）"),
-            "631": ("failed", "再送信パラメータ変更不可（権限画面で編集可を ON）"),
-            "632": ("failed", "楽天向けタイトルが無効"),
-            "633": ("failed", "楽天向け SMS 本文が無効"),
-            "634": ("failed", "楽天向け SMS 本文が上限超過"),
-            "639": ("failed", "短縮URL アクセス機能が無効"),
-            "664": ("failed", "テンプレートと本文の必須パラメータに過不足あり"),
-            "666": ("failed", "IP ブロック直前（認証エラー累積 9 回目）"),
-        }
-
-        def extract_code(text, http_status):
-            # 尝试解析 JSON 字段
-            try:
-                obj = json.loads(text)
-                for k in ("code", "status", "result", "result_code", "error_code", "ErrorCode"):
-                    if k in obj and obj[k] is not None:
-                        return str(obj[k]).upper()
-                if isinstance(obj.get("error"), dict) and obj.get("error").get("code"):
-                    return str(obj.get("error").get("code")).upper()
-            except Exception:
-                pass
-            # 简单 XML / KV / 数字提取
-            try:
-                m = re.search(r"<\s*(?:Code|Status|Result)\s*>\s*([^<\s]+)\s*<\\s*(?:Code|Status|Result)\s*>", text, re.I)
-                if m:
-                    return m.group(1).upper()
-            except Exception:
-                pass
-            try:
-                m = re.search(r"\b(?:code|status|result)\s*[:=]\s*[\"']?([A-Za-z0-9_-]{2,})", text, re.I)
-                if m:
-                    return m.group(1).upper()
-            except Exception:
-                pass
+_SMS_LEDGER = None
+
+
+def _get_sms_ledger():
+    """Lazily open the local SMS ledger; returns None if it cannot be opened."""
+    global _SMS_LEDGER
+    if _SMS_LEDGER is None:
+        try:
+            from sms_ledger import SmsLedger
+            _SMS_LEDGER = SmsLedger()
+        except Exception as e:
             try:
-                m = re.search(r"\b([1-9][0-9]{2})\b", text)
-                if m:
-                    return m.group(1)
+                emit({"event": "sms_ledger_unavailable", "error": str(e)[:1000]}, ja="SMS 送信台帳を開けませんでした（重複防止なしで続行）")
             except Exception:
                 pass
-            return str(http_status) if http_status else None
+            _SMS_LEDGER = False
+    return _SMS_LEDGER or None
 
-        raw_code = extract_code(final_text or "", final_status)
-        # 规范化 code：去空白、去引号，保留字母数字下划线和短横线；大写化
-        code = None
+
+def send_sms_for_entry(ent: dict) -> Optional[str]:
+    """Send the SMS for one extracted applicant at most once and fill sms_sent / sms_response.
+
+    The ledger (user + normalized phone + source_url) is consulted first: an earlier
+    'sent' or still 'pending' send is replayed instead of posting again.
+    Returns the ledger key (None when no SMS applies or the ledger is unavailable).
+    """
+    if not (ent.get("should_send_sms") and ent.get("phone")):
+        ent["sms_sent"] = False
+        ent["sms_response"] = None
+        return None
+
+    ledger = _get_sms_ledger()
+    key = None
+    if ledger:
         try:
-            if raw_code is not None:
-                cstr = str(raw_code).strip()
-                # 去除外层引号
-                if (cstr.startswith('"') and cstr.endswith('"')) or (cstr.startswith("'") and cstr.endswith("'")):
-                    cstr = cstr[1:-1]
-                # 仅保留常见安全字符
-                cstr = re.sub(r"[^A-Za-z0-9_\-]", "", cstr)
-                cstr = cstr.upper()
-                if cstr:
-                    code = cstr
-        except Exception:
-            code = None
+            from sms_ledger import ledger_key
+            key = ledger_key(os.environ.get("USER_UID") or "", ent.get("phone"), ent.get("source_url"))
+            existing = ledger.begin(key, os.environ.get("USER_UID") or "", ent.get("phone"), ent.get("source_url"))
+        except Exception as e:
+            emit({"event": "sms_ledger_error", "error": str(e)[:1000]}, ja="SMS 送信台帳の確認に失敗しました")
+            key, existing = None, None
+        if existing:
+            prev = existing.get("result") if isinstance(existing.get("result"), dict) else None
+            ent["sms_sent"] = existing.get("state") == "sent"
+            if existing.get("state") == "unknown":
+                # 中断した送信（結果不明）で再送しない設定: 履歴に unknown として残す
+                prev = {"success": False, "error": "send_outcome_unknown", "level": "unknown", "ledger_state": "unknown"}
+            ent["sms_response"] = prev or {"success": False, "error": "duplicate_pending", "ledger_state": existing.get("state")}
+            emit({"event": "sms_skip_duplicate", "state": existing.get("state")}, ja="この応募者には送信済み（または送信中）のため SMS をスキップしました")
+            return key
+
+    # 送信許可時間外（quiet hours）なら API を呼ばずに保留キューへ
+    if ledger and key:
+        due_at = _sms_quiet_hours_end()
+        if due_at:
+            _defer_sms_send(ledger, key, ent, due_at, reason="quiet_hours")
+            return key
 
-        # 如果没有解析到 code，但 HTTP 状态是 200，则把 code 设为 '200' 以便映射
+    try:
+        sms_result = send_sms_if_configured(ent["phone"], ent["name"])
+        ent["sms_sent"] = sms_result.get("success", False)
+        ent["sms_response"] = sms_result
+    except Exception as e:
+        emit({"event": "sms_send_failed", "error": str(e)}, ja="SMS送信に失敗しました")
+        ent["sms_sent"] = False
+        ent["sms_response"] = {"success": False, "error": str(e)}
+
+    if ledger and key:
+        if str((ent.get("sms_response") or {}).get("code") or "") == SMS_CODE_TIME_DISABLED:
+            _defer_sms_send(ledger, key, ent, _sms_retry_due_at(), reason="provider_592")
+            return key
         try:
-            if not code and final_status == 200:
-                code = "200"
-        except Exception:
-            pass
+            ledger.complete(key, ent["sms_response"], bool(ent["sms_sent"]))
+        except Exception as e:
+            emit({"event": "sms_ledger_error", "error": str(e)[:1000]}, ja="SMS 送信台帳の更新に失敗しました")
+    return key
 
-        level = None
-        message = None
-        if code and code in SMS_CONSOLE:
-            level, message = SMS_CONSOLE[code]
-            message = f"コード {code}: {message}"
-        elif code:
-            level = "failed"
-            message = f"コード {code}: 未定義のコード"
-        else:
-            level = "error"
-            message = "コードを取得できませんでした"
-
-        result = {
-            "success": final_status == 200,
-            "provider": "sms-api",
-            "status": final_status,
-            "code": code,
-            "level": level,
-            "message": message,
-            "output": final_text,
-            "retry_attempted": retry_attempted,
-        }
+
+# 供应商返回“送信許可時間外（Time is disabled）”
+SMS_CODE_TIME_DISABLED = "592"
+# 每次 flush 最多处理的保留件数（避免阻塞邮件轮询）。每条最多 2 次 × DEFAULT_TIMEOUT 秒，
+# 取得的件数必须在 claim_due() 的租约（DEFER_LEASE_SECONDS）内发完
+SMS_SEND_MAX_SECONDS = 2 * SMS_POST_TIMEOUT + 10
+SMS_DEFER_FLUSH_BATCH = 20
+
+
+def _sms_quiet_hours():
+    from sms_ledger import parse_quiet_hours
+    sms_config = cfg.get("sms_config") if isinstance(cfg, dict) else None
+    spec = (sms_config or {}).get("quiet_hours") if isinstance(sms_config, dict) else None
+    return parse_quiet_hours(spec or os.environ.get("RPA_SMS_QUIET_HOURS"))
+
+
+def _sms_quiet_hours_end() -> Optional[int]:
+    try:
+        from sms_ledger import quiet_hours_end
+        return quiet_hours_end(_sms_quiet_hours())
+    except Exception:
+        return None
+
+
+def _sms_retry_due_at() -> int:
+    """Next attempt after a 592: end of the configured quiet window, else a fixed delay."""
+    from sms_ledger import DEFER_RETRY_MINUTES
+    quiet = _sms_quiet_hours()
+    if quiet:
+        # 592 说明供应商侧仍在禁止时段；以配置窗口结束为准，若当前不在窗口内则用固定间隔
         try:
-            emit({"event": "sms_result_normalized", "status": final_status, "code": code, "level": level}, ja=(f"SMS結果: {level} コード {code}" if code else "SMS結果: 解析できませんでした"))
+            from sms_ledger import quiet_hours_end
+            end = quiet_hours_end(quiet)
+            if end:
+                return end
         except Exception:
             pass
-        # If HTTP status is 200 treat as success-level by default to match terminal indication
+    return int(time.time() * 1000) + DEFER_RETRY_MINUTES * 60 * 1000
+
+
+def _defer_sms_send(ledger, key: str, ent: dict, due_at: int, reason: str):
+    response = {
+        "success": False,
+        "deferred": True,
+        "level": "deferred",
+        "reason": reason,
+        "due_at": int(due_at),
+        "message": "送信許可時間外のため送信を保留しました",
+    }
+    try:
+        ledger.defer(key, os.environ.get("USER_UID") or "", ent.get("phone"), ent.get("name"), ent.get("source_url"), due_at)
+        ledger.complete(key, response, False, state="deferred")
+    except Exception as e:
+        emit({"event": "sms_ledger_error", "error": str(e)[:1000]}, ja="SMS 保留キューへの登録に失敗しました")
+        return
+    ent["sms_sent"] = False
+    ent["sms_response"] = response
+    emit({"event": "sms_deferred", "reason": reason, "due_at": int(due_at)},
+         ja=f"SMS を保留しました（{datetime.datetime.fromtimestamp(due_at / 1000, JST).strftime('%m/%d %H:%M')} JST 以降に送信）")
+
+
+def flush_deferred_sms(ledger):
+    """Send deferred SMS whose due time has passed, one bounded batch per call.
+
+    Rows are taken with ledger.claim_due() (only as many as can be sent within its lease), and
+    each one goes through ledger.begin(deferred=True) right before its POST: a row that another
+    flush (the worker's flush_sms or a job for the same uid) is sending is skipped, and a crash
+    mid-send leaves it 'pending' for the usual pending -> unknown recovery instead of resending it.
+    History documents written at deferral time are updated in a single batched commit.
+    """
+    uid_env = os.environ.get('USER_UID')
+    if not ledger or not uid_env:
+        return 0
+    recover_stale_sms_sends(ledger)
+    if _sms_quiet_hours_end():
+        return 0
+    from sms_ledger import DEFER_LEASE_SECONDS, RETRY_UNKNOWN
+    limit = max(1, min(SMS_DEFER_FLUSH_BATCH, DEFER_LEASE_SECONDS // SMS_SEND_MAX_SECONDS))
+    try:
+        rows = ledger.claim_due(uid_env, limit=limit)
+    except Exception:
+        return 0
+    if not rows:
+        return 0
+
+    emit({"event": "sms_deferred_flush", "count": len(rows)}, ja=f"保留中の SMS を送信します: {len(rows)} 件")
+    history_updates = {}
+    daily = {}
+    sent = 0
+    for i, row in enumerate(rows):
+        key = row["key"]
         try:
-            if result.get("status") == 200 and result.get("level") != "success":
-                result["level"] = "success"
-                # keep existing message but ensure there is some note
-                if not result.get("message"):
-                    result["message"] = "HTTP 200: treated as success"
+            existing = ledger.begin(key, uid_env, row["phone"], row.get("source_url"), deferred=True)
+        except Exception as e:
+            emit({"event": "sms_ledger_error", "error": str(e)[:1000]}, ja="SMS 送信台帳の確認に失敗しました")
+            continue
+        if existing:
+            state = existing.get("state")
+            if state == "pending":
+                # 他の flush が送信中：完了した側が保留行を削除する
+                continue
+            ledger.remove_deferred(key)
+            if state == "unknown" and not RETRY_UNKNOWN and row.get("history_doc_id"):
+                # 送信途中で中断（結果不明）し、再送しない設定：履歴を unknown に更新する
+                unknown = {"success": False, "error": "send_outcome_unknown", "level": "unknown", "ledger_state": "unknown"}
+                history_updates[row["history_doc_id"]] = {"sms_sent": False, "sms_response": unknown}
+                entry = existing.get("entry") if isinstance(existing.get("entry"), dict) else {}
+                merge_daily(daily, history_day(entry.get("createdAt")), {"sms_deferred": -1, "sms_failed": 1})
+            # sent: 既に別の送信（再ポーリングした任務など）が結果を記録済み
+            continue
+        try:
+            sms_result = send_sms_if_configured(row["phone"], row.get("name") or "")
+        except Exception as e:
+            sms_result = {"success": False, "error": str(e)}
+        if str(sms_result.get("code") or "") == SMS_CODE_TIME_DISABLED:
+            # 仍在供应商禁止时段：整批停止，本条与剩余条目一起改到下次可发送的时间
+            retry_at = _sms_retry_due_at()
+            ledger.complete(key, {**sms_result, "deferred": True, "level": "deferred", "due_at": retry_at}, False,
+                            state="deferred")
+            for rest in rows[i:]:
+                ledger.defer(rest["key"], uid_env, rest["phone"], rest.get("name"), rest.get("source_url"), retry_at)
+            break
+        ok = bool(sms_result.get("success", False))
+        ledger.complete(key, sms_result, ok)
+        ledger.remove_deferred(key)
+        sent += 1 if ok else 0
+        if row.get("history_doc_id"):
+            history_updates[row["history_doc_id"]] = {"sms_sent": ok, "sms_response": sms_result}
+            # 日次集計: 保留 -> 送信済み / 失敗 に振り替える（履歴の createdAt の日付で）。
+            # ここは実際に送信した行だけなので daily_deltas の「送信を試みた場合のみ失敗」と一致する
+            try:
+                created_at = ((ledger.get(key) or {}).get("entry") or {}).get("createdAt")
+            except Exception:
+                created_at = None
+            merge_daily(daily, history_day(created_at), {"sms_deferred": -1, "sms_sent" if ok else "sms_failed": 1})
+
+    if history_updates:
+        flush_history()
+        update_history_entries(uid_env, history_updates, daily=daily)
+    return sent
+
+
+def update_history_entries(user_uid: str, updates: dict, daily: Optional[dict] = None):
+    """Apply {doc_id: fields} to rpa_history/{uid}/entries in one batched commit.
+
+    daily ({day: {counter: delta}}) adjusts the per-day summary documents in the same commit.
+    """
+    try:
+        db = get_firestore_db()
+        if db is None:
+            return False
+        coll = db.collection('rpa_history').document(str(user_uid)).collection('entries')
+        batch = db.batch()
+        for doc_id, fields in updates.items():
+            batch.update(coll.document(str(doc_id)), fields)
+        if daily:
+            add_daily_writes(db, batch, str(user_uid), daily)
+        batch.commit()
+        mirror = _get_history_mirror()
+        if mirror:
+            for doc_id, fields in updates.items():
+                try:
+                    mirror.update_fields(str(user_uid), str(doc_id), fields)
+                except Exception:
+                    pass
+        return True
+    except Exception as e:
+        try:
+            emit({"event": "history_error", "uid": str(user_uid), "error": str(e)[:1000]}, ja="履歴の更新でエラーが発生しました")
         except Exception:
             pass
+        return False
 
-        return result
+
+def recover_stale_sms_sends(ledger):
+    """Surface sends left 'pending' by a crashed process (now 'unknown'; begin() retries them)."""
+    if not ledger:
+        return []
+    try:
+        rows = ledger.expire_pending()
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        emit({"event": "sms_ledger_error", "error": str(e)[:1000]}, ja="SMS 送信台帳の pending 確認に失敗しました")
+        return []
+    from sms_ledger import RETRY_UNKNOWN
+    for row in rows:
+        emit({"event": "sms_send_unknown", "uid": row.get("uid"), "key": row.get("key"),
+              "source_url": row.get("source_url"), "pending_at": row.get("pending_at"), "will_retry": RETRY_UNKNOWN},
+             ja="送信途中で中断した SMS があります（送信結果不明）" + ("。次回の処理で再送します" if RETRY_UNKNOWN else "。手動で確認してください"))
+    return rows
+
+
+def reconcile_sms_ledger_history(ledger):
+    """Write history for sends that completed but never got their history entry written."""
+    uid_env = os.environ.get('USER_UID')
+    if not ledger or not uid_env:
+        return
+    try:
+        rows = ledger.unreconciled(uid_env)
+    except Exception:
+        return
+    for row in rows:
+        entry = row.get("entry")
+        if isinstance(entry, dict):
+            write_history_entry_to_firestore(uid_env, dict(entry), on_written=(lambda _doc_id, _k=row["key"]: ledger.mark_history_written(_k)))
+            emit({"event": "history_reconciled", "uid": uid_env, "name": entry.get("name")}, ja="未保存だった履歴を補完しました")
+
 
 def evaluate_sms_target(driver, info):
     """
     基于用户配置的target_rules判断是否应该发送短信。
     需要姓名、性别、年龄全部条件都符合才返回True。
     参考 /src/app/api/rpa/personal-info/route.ts 的逻辑
+    规则经 target_rules.compiled_rules_for 编译一次并复用（配置未变化时不再重新解析）。
     """
     try:
-        # 获取用户的target_rules配置
         target_rules = cfg.get("target_rules") if isinstance(cfg, dict) else {}
-        if not target_rules:
-            # 如果没有配置规则，使用默认简单规则
-            phone = (info.get("__標準_電話番号__") or 
-                    info.get("電話番号") or 
-                    info.get("phone") or "")
-            pd = re.sub(r"[^0-9]", "", str(phone))
-            if not pd or len(pd) < 7:
-                return False
-            
-            age = None
-            a = (info.get("__標準_年齢__") or 
-                 info.get("age") or 
-                 info.get("年齢"))
-            try:
-                age = int(str(a)) if a else None
-            except Exception:
-                age = None
-            return age is None or age >= 18
-
-        # 1. 检查姓名条件（去除括号内容，仅用主名部分判断类型）
-        raw_name = info.get("姓名（ふりがな）") or info.get("name") or ""
-        # 去除全角/半角括号及其中内容
-        name = re.sub(r"[（(][^）)]*[）)]", "", raw_name).strip()
-        name_checks = target_rules.get("nameChecks", {})
-        name_configured = any([
-            name_checks.get("kanji"),
-            name_checks.get("katakana"),
-            name_checks.get("hiragana"),
-            name_checks.get("alphabet")
-        ])
-        name_pass = False
-        if name_configured:
-            # 只要满足任一勾选条件即可
-            if name_checks.get("kanji") and re.search(r'[\u4e00-\u9fff]', name):
-                name_pass = True
-            if name_checks.get("katakana") and re.search(r'[\u30a0-\u30ff]', name):
-                name_pass = True
-            if name_checks.get("hiragana") and re.search(r'[\u3040-\u309f]', name):
-                name_pass = True
-            if name_checks.get("alphabet") and re.search(r'[A-Za-z]', name):
-                name_pass = True
-
-        # 2. 检查性别和年龄条件
-        gender_raw = info.get("性別") or info.get("gender") or ""
-        gender = None
-        if "男" in gender_raw or "male" in gender_raw.lower():
-            gender = "male"
-        elif "女" in gender_raw or "female" in gender_raw.lower():
-            gender = "female"
-
-        age = None
-        a = (info.get("__標準_年齢__") or 
-             info.get("age") or 
-             info.get("年齢"))
-        try:
-            age = int(str(a)) if a else None
-        except Exception:
-            age = None
-
-        gender_pass = True
-        age_rules = target_rules.get("age", {})
-        if gender and age_rules.get(gender):
-            gender_rule = age_rules[gender]
-            gender_configured = bool(
-                isinstance(gender_rule.get("include"), bool) or
-                isinstance(gender_rule.get("skip"), bool) or
-                gender_rule.get("min") is not None or
-                gender_rule.get("max") is not None
-            )
-            
-            if gender_configured:
-                # 检查include/skip标志
-                include_flag = None
-                if isinstance(gender_rule.get("include"), bool):
-                    include_flag = gender_rule["include"]
-                elif isinstance(gender_rule.get("skip"), bool):
-                    include_flag = not gender_rule["skip"]
-                
-                if include_flag is False:
-                    gender_pass = False
-                
-                # 检查年龄范围
-                min_age = gender_rule.get("min")
-                max_age = gender_rule.get("max")
-                if min_age is not None or max_age is not None:
-                    if age is None:
-                        gender_pass = False
-                    elif min_age is not None and age < min_age:
-                        gender_pass = False
-                    elif max_age is not None and age > max_age:
-                        gender_pass = False
-
-        # 3. 所有配置的条件都必须通过
-        any_rule_configured = name_configured or (gender and age_rules.get(gender))
-        if not any_rule_configured:
-            return None  # 没有配置规则，返回None让后端决定
-        
-        # 需要所有配置的组都通过
-        if not name_pass:
-            return False
-        if not gender_pass:
-            return False
-            
-        return True
-        
+        return compiled_rules_for(target_rules).evaluate(info)
     except Exception as e:
         print(f"evaluate_sms_target error: {e}", file=sys.stderr)
         return False
 
 # ========= 主流程 =========
-def main():
+def main(keep_warm: bool = False):
+    """运行一次（或监控模式下持续）收件箱处理；返回最后一批的结果 {"success", "timestamp", "results"}。
+
+    keep_warm=True 时（run() / 常驻子进程）保留 Firestore client 与设置缓存供下一个任务复用。
+    """
+    last_out = None
     # 支持监控模式：如果 stdin config 指定 monitor=True，则持续运行并按 poll_interval (秒) 检查新邮件
     results_batch = []
     # 读取配置（已在模块顶部处理），允许从 cfg 里取 monitor / poll_interval
@@ -1431,12 +1593,26 @@ def main():
         stop_requested = True
         print(json.dumps({"event": "shutdown", "timestamp": int(time.time() * 1000)}), file=sys.stderr, flush=True)
 
-    signal.signal(signal.SIGINT, _handle_sig)
-    signal.signal(signal.SIGTERM, _handle_sig)
+    try:
+        signal.signal(signal.SIGINT, _handle_sig)
+        signal.signal(signal.SIGTERM, _handle_sig)
+    except ValueError:
+        pass  # 非主线程中调用（作为库使用）时无法注册信号
+
+    # 上次进程在 begin() 与发送之间中断的 pending -> unknown（上报并重发），再补写“已发送 SMS、未写历史”的条目
+    ledger = _get_sms_ledger()
+    recover_stale_sms_sends(ledger)
+    reconcile_sms_ledger_history(ledger)
 
     driver = None
     try:
         while not stop_requested:
+            # 期限が来た保留 SMS を先に送信（1 回あたり上限件数のみ）
+            try:
+                flush_deferred_sms(ledger)
+            except Exception as e:
+                emit({"event": "sms_deferred_flush_error", "error": str(e)[:1000]}, ja="保留 SMS の送信処理でエラーが発生しました")
+
             # indicate we are about to poll the mailbox
             try:
                 emit({"event": "polling_mailbox", "poll_interval": poll_interval}, ja="メールボックスを確認しています...")
@@ -1470,6 +1646,7 @@ def main():
                 emit({"event": "found_unread_count", "count": total}, ja=f"未読メールが見つかりました: {total} 件")
             except Exception:
                 pass
+            send_event("found", count=total)
 
             # ensure browser driver
             if driver is None:
@@ -1500,10 +1677,13 @@ def main():
                     except Exception:
                         pass
                     remaining -= 1
+                    send_event("item", index=idx, total=total, ok=False, reason="no_target_url")
                     continue
 
                 processed_ok = False
                 ent = None
+                ledger_key_for_ent = None
+                history_id = None
                 try:
                     site_login_and_open(driver, target_url, SITE_USER, SITE_PASS)
                     ensure_in_latest_tab(driver)
@@ -1515,19 +1695,8 @@ def main():
                     except Exception:
                         ent["should_send_sms"] = False
 
-                    # send SMS if configured
-                    if ent.get("should_send_sms") and ent.get("phone"):
-                        try:
-                            sms_result = send_sms_if_configured(ent["phone"], ent["name"])
-                            ent["sms_sent"] = sms_result.get("success", False)
-                            ent["sms_response"] = sms_result
-                        except Exception as e:
-                            emit({"event": "sms_send_failed", "error": str(e)}, ja="SMS送信に失敗しました")
-                            ent["sms_sent"] = False
-                            ent["sms_response"] = {"success": False, "error": str(e)}
-                    else:
-                        ent["sms_sent"] = False
-                        ent["sms_response"] = None
+                    # send SMS if configured (ledger guarantees one send per applicant)
+                    ledger_key_for_ent = send_sms_for_entry(ent)
 
                     results_batch.append(ent)
                     processed_ok = True
@@ -1556,18 +1725,7 @@ def main():
                                 except Exception:
                                     ent["should_send_sms"] = False
 
-                                if ent.get("should_send_sms") and ent.get("phone"):
-                                    try:
-                                        sms_result = send_sms_if_configured(ent["phone"], ent["name"])
-                                        ent["sms_sent"] = sms_result.get("success", False)
-                                        ent["sms_response"] = sms_result
-                                    except Exception as e2:
-                                        emit({"event": "sms_send_failed", "error": str(e2)}, ja="SMS送信に失敗しました")
-                                        ent["sms_sent"] = False
-                                        ent["sms_response"] = {"success": False, "error": str(e2)}
-                                else:
-                                    ent["sms_sent"] = False
-                                    ent["sms_response"] = None
+                                ledger_key_for_ent = send_sms_for_entry(ent)
 
                                 results_batch.append(ent)
                                 processed_ok = True
@@ -1622,7 +1780,16 @@ def main():
                                 # Normalize name/furigana and phone before write happens inside writer
                                 try:
                                     emit({"event": "about_to_write_history", "uid": uid_env, "name": history_entry.get("name")}, ja="履歴を保存します...")
-                                    write_history_entry_to_firestore(uid_env, history_entry)
+                                    if ledger and ledger_key_for_ent:
+                                        ledger.attach_entry(ledger_key_for_ent, history_entry)
+                                    on_written = None
+                                    if ledger and ledger_key_for_ent:
+                                        on_written = (lambda _doc_id, _k=ledger_key_for_ent: ledger.mark_history_written(_k))
+                                    written = write_history_entry_to_firestore(uid_env, history_entry, on_written=on_written)
+                                    history_id = written or None
+                                    # 保留中の SMS は送信後にこの履歴を更新する
+                                    if written and ledger and ledger_key_for_ent and (ent.get("sms_response") or {}).get("deferred"):
+                                        ledger.attach_history(ledger_key_for_ent, written)
                                 except Exception:
                                     emit({"event": "about_to_write_history_failed", "uid": uid_env}, ja="履歴の保存処理でエラーが発生しました。")
                         except Exception:
@@ -1635,10 +1802,14 @@ def main():
                     emit({"event": "processing_done", "index": idx, "total": total, "remaining_after": remaining}, ja=f"処理完了: {idx}/{total}")
                 except Exception:
                     pass
+                send_event("item", index=idx, total=total, ok=bool(processed_ok and ent),
+                           entry=ent if processed_ok else None, history_id=history_id)
 
             # output batch as JSON line
             try:
                 out = {"success": True, "timestamp": int(time.time() * 1000), "results": results_batch}
+                last_out = out
+                send_event("batch", success=True, count=len(results_batch))
                 # Print human-friendly candidate cards to stderr before emitting JSON
                 try:
                     for r in (results_batch or []):
@@ -1658,7 +1829,7 @@ def main():
             # Note: batch-level history write removed to avoid duplicate entries.
 
             if not monitor:
-                return
+                return last_out
 
             # after processing, countdown again before next poll (per-second visibility)
             for sec in range(poll_interval, 0, -1):
@@ -1677,9 +1848,99 @@ def main():
                 safe_quit(driver, reason='final_cleanup')
         except:
             pass
+        # 缓冲中的履历在退出前全部提交
+        close_history_sink()
+        try:
+            emit({"event": "firestore_client_metrics", **firestore_provider.metrics()}, ja="Firestore 接続の統計を出力しました")
+        except Exception:
+            pass
+        if _CONFIG_CACHE is not None:
+            try:
+                emit({"event": "config_cache_stats", **_CONFIG_CACHE.stats}, ja="設定キャッシュの統計を出力しました")
+                if not keep_warm:
+                    _CONFIG_CACHE.close()
+            except Exception:
+                pass
+    return last_out
+
+
+def _flush_only() -> bool:
+    return os.environ.get('RPA_SMS_FLUSH_ONLY', '0') not in ('', '0')
+
+
+# flush_sms() 一次最多处理的批数（quiet hours 中 / 592 时不会前进，避免空转）
+SMS_FLUSH_MAX_ROUNDS = 50
+
+
+def flush_sms() -> dict:
+    """只发送期限已到的保留 SMS（不连接邮箱、不启动浏览器），返回与 main() 同形的结果。
+
+    worker 的 SmsFlusher 发现该用户有到期的保留时用 RPA_SMS_FLUSH_ONLY=1 启动（与邮件任务无关）；不需要 IMAP 凭据。
+    """
+    uid_env = os.environ.get('USER_UID')
+    ledger = _get_sms_ledger()
+    sent = 0
+    try:
+        recover_stale_sms_sends(ledger)
+        reconcile_sms_ledger_history(ledger)
+        for _ in range(SMS_FLUSH_MAX_ROUNDS):
+            due = ledger.next_due_at(uid_env) if (ledger and uid_env) else None
+            if due is None or due > int(time.time() * 1000) or _sms_quiet_hours_end():
+                break
+            sent += flush_deferred_sms(ledger)
+    except Exception as e:
+        emit({"event": "sms_deferred_flush_error", "error": str(e)[:1000]}, ja="保留 SMS の送信処理でエラーが発生しました")
+    finally:
+        flush_history()
+    out = {"success": True, "timestamp": int(time.time() * 1000), "results": [], "sms_flushed": sent}
+    send_event("batch", success=True, count=0)
+    print(json.dumps(out, ensure_ascii=False), flush=True)
+    return out
+
+
+def run(job_cfg: Optional[dict] = None, uid: Optional[str] = None) -> dict:
+    """库入口：处理一个任务并返回结果（与脚本 stdout 的 JSON 同形）。
+
+    凭据不足时返回 {"success": False, "exit_code": 2, ...}（与脚本的退出码 2 相同，worker 视为 needs_setup）。
+    RPA_SMS_FLUSH_ONLY=1 时只执行 flush_sms()。
+    """
+    if uid:
+        # 履历写入 / SMS 模板序号等处通过 USER_UID 取得用户
+        os.environ['USER_UID'] = str(uid)
+    else:
+        os.environ.pop('USER_UID', None)
+    if _flush_only():
+        apply_cfg(job_cfg or {}, uid)
+        return flush_sms()
+    if not apply_cfg(job_cfg or {}, uid):
+        return {"success": False, "exit_code": 2, "error": "missing_imap_credentials"}
+    out = main(keep_warm=True)
+    return out or {"success": True, "timestamp": int(time.time() * 1000), "results": []}
+
+
+def shutdown():
+    """常驻子进程退出前释放缓存与 Firestore client。"""
+    global _CONFIG_CACHE
+    close_history_sink()
+    if _CONFIG_CACHE is not None:
+        try:
+            _CONFIG_CACHE.close()
+        except Exception:
+            pass
+        _CONFIG_CACHE = None
+    firestore_provider.reset_client()
+
 
 if __name__ == "__main__":
     if sys.platform.startswith("win"): os.environ['PYTHONIOENCODING'] = 'utf-8'
+    if _flush_only():
+        # 保留 SMS の送信のみ（IMAP 認証情報は不要）
+        apply_cfg(load_cfg_from_argv())
+        flush_sms()
+        close_history_sink()
+        sys.exit(0)
+    if not apply_cfg(load_cfg_from_argv()):
+        _exit_for_missing_credentials()
     try:
         main()
     except Exception:
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RPA スクリプトを常駐の子プロセスで実行するプール（ジョブごとの Python 起動を省く）。
+
+- 子プロセスは起動時に RPA モジュール（selenium / bs4 / undetected_chromedriver / firebase）を import して待機し、
+  ジョブごとに rpa_gmail_indeed_test.run(cfg, uid) を呼ぶ（設定キャッシュと Firestore client はジョブ間で再利用）
+- 各子プロセスは max_tasks 件処理したら終了し、新しいプロセスに入れ替える（メモリ / ブラウザ資源のリーク対策）
+- 子プロセスは自分のプロセスグループを作る（chromedriver / Chrome も同じグループ）。タイムアウト・入れ替え時は
+  グループごと kill するので、孤児になったブラウザがプロファイルのロックを握り続けない
+- 子プロセスごとに Chrome のプロファイル（RPA_STATE_DIR/chrome_profiles/warm<n>/<uid>）を割り当てる。
+  worker が RPA_CHROME_PROFILE_DIR を渡した場合はそちらを使う
+- POSIX では forkserver（親の gRPC スレッドを引き継がない）、Windows では spawn で起動する
+
+WarmRunner は worker.run_rpa_script と同じ呼び出し形式なので execute_job の runner にそのまま渡せる。
+
+Usage:
+    python worker.py --runner pool --concurrency 4
+    python rpa_pool.py --bench 5      # cold（サブプロセス）と warm（プール）の起動時間を比較
+
+Env:
+- RPA_WORKER_RUNNER (subprocess | pool; default subprocess)
+- RPA_POOL_MAX_TASKS (default 50; 子プロセス 1 つあたりの最大ジョブ数)
+"""
+
+import os
+import sys
+import time
+import json
+import queue
+import signal
+import hashlib
+import threading
+import importlib.util
+import multiprocessing
+from typing import Optional
+
+from sms_ledger import STATE_DIR
+
+DEFAULT_MAX_TASKS = int(os.environ.get("RPA_POOL_MAX_TASKS", "50"))
+# 子プロセス起動（import 完了）待ちの上限（秒）
+READY_TIMEOUT = 120
+# Chrome の --user-data-dir（同時に動くブラウザ同士・ユーザー同士で共有しない）
+CHROME_PROFILE_ROOT = os.path.join(STATE_DIR, "chrome_profiles")
+
+
+def chrome_profile_dir(slot: str, user_uid: Optional[str]) -> str:
+    """Chrome profile for `user_uid` in an exclusive slot (a JobPool slot or a warm child).
+
+    Concurrent browsers never share a profile (Chrome locks it), and users never share one
+    (cookies / logged-in sessions); a user keeps their profile within the slot.
+    """
+    key = hashlib.sha1(str(user_uid or "").encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CHROME_PROFILE_ROOT, str(slot), key)
+
+
+def _mp_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _load_rpa_module(rpa_script: str):
+    here = os.path.dirname(os.path.abspath(rpa_script))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    name = os.path.splitext(os.path.basename(rpa_script))[0]
+    spec = importlib.util.spec_from_file_location(name, rpa_script)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def _apply_env(extra_env: Optional[dict], base_env: dict):
+    # ジョブごとに環境変数を起動時の状態へ戻してから extra_env を適用する
+    for k in list(os.environ):
+        if k not in base_env:
+            os.environ.pop(k, None)
+    os.environ.update(base_env)
+    for k, v in (extra_env or {}).items():
+        if v is None:
+            os.environ.pop(str(k), None)
+        else:
+            os.environ[str(k)] = str(v)
+
+
+def _child_main(conn, rpa_script: str, max_tasks: int, profile_slot: str = "warm0"):
+    """常駐子プロセス: (cfg, uid, extra_env) を受け取り (ok, result) を返す。max_tasks 件で終了。"""
+    # 自分をリーダーとするプロセスグループを作る（親は killpg で chromedriver / Chrome ごと止める）
+    if hasattr(os, "setpgid"):
+        try:
+            os.setpgid(0, 0)
+        except OSError:
+            pass
+    # コンソールの Ctrl+C は親が制御する（ジョブ中は RPA 側のハンドラが優先される）
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    except Exception:
+        pass
+    try:
+        import firestore_provider
+        # fork で親の client を引き継いだ場合に備え、子では必ず作り直す
+        firestore_provider.reset_client()
+    except Exception:
+        firestore_provider = None
+    try:
+        rpa = _load_rpa_module(rpa_script)
+    except BaseException as e:
+        conn.send(("error", f"import failed: {e}"))
+        return
+    # 事件はジョブの完了を待たずに同じパイプで親へ転送する
+    try:
+        rpa.set_event_sink(lambda evt: conn.send(("event", evt)))
+    except Exception:
+        pass
+    base_env = dict(os.environ)
+    conn.send(("ready", os.getpid()))
+    done = 0
+    try:
+        while done < max_tasks:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg is None:
+                break
+            job_cfg, uid, extra_env = msg
+            _apply_env(extra_env, base_env)
+            if not os.environ.get("RPA_CHROME_PROFILE_DIR"):
+                os.environ["RPA_CHROME_PROFILE_DIR"] = chrome_profile_dir(profile_slot, uid)
+            try:
+                result = rpa.run(job_cfg, uid)
+                ok = bool(isinstance(result, dict) and result.get("success", True))
+            except SystemExit as e:
+                result, ok = {"success": False, "exit_code": e.code if isinstance(e.code, int) else 1}, False
+            except BaseException as e:
+                result, ok = {"success": False, "error": str(e)[:1000], "exit_code": 1}, False
+            done += 1
+            try:
+                conn.send(("done", (ok, result)))
+            except Exception:
+                conn.send(("done", (ok, json.loads(json.dumps(result, default=str)))))
+    finally:
+        try:
+            rpa.shutdown()
+        except Exception:
+            pass
+
+
+class _Slot:
+    def __init__(self, ctx, rpa_script: str, max_tasks: int, index: int = 0):
+        self.index = index
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_child_main, args=(child_conn, rpa_script, max_tasks, f"warm{index}"),
+                                name=f"rpa-warm-{index}", daemon=True)
+        self.proc.start()
+        child_conn.close()
+        self.max_tasks = max_tasks
+        self.tasks = 0
+        self.ready = False
+
+    def wait_ready(self, timeout: float = READY_TIMEOUT):
+        if self.ready:
+            return
+        if not self.conn.poll(timeout):
+            raise RuntimeError("warm RPA child did not start in time")
+        kind, payload = self.conn.recv()
+        if kind != "ready":
+            raise RuntimeError(f"warm RPA child failed: {payload}")
+        self.ready = True
+
+    def usable(self) -> bool:
+        return self.proc.is_alive() and self.tasks < self.max_tasks
+
+    def _kill_group(self) -> bool:
+        # 子のプロセスグループ（pgid = 子の pid）ごと SIGKILL。子が setpgid する前なら False
+        pid = self.proc.pid
+        if not pid or not hasattr(os, "killpg"):
+            return False
+        try:
+            if os.getpgid(pid) != pid:
+                return False
+        except OSError:
+            # 子は既に終了: グループに残ったブラウザだけを止める（居なければ ESRCH）
+            pass
+        try:
+            os.killpg(pid, signal.SIGKILL)
+            return True
+        except OSError:
+            return False
+
+    def kill(self):
+        if not self._kill_group():
+            try:
+                self.proc.kill()
+            except Exception:
+                pass
+        self.proc.join(timeout=5)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.proc.join(timeout=10)
+        if self.proc.is_alive():
+            self.kill()
+        else:
+            # 正常終了でも quit されずに残ったブラウザがいればプロファイルを解放する
+            self._kill_group()
+
+
+class WarmRunner:
+    """Run jobs in `size` long-lived pre-warmed child processes.
+
+    Callable with the run_rpa_script signature:
+    runner(rpa_script, cfg, log_stdout, extra_env, timeout_seconds) -> (ok, result).
+    """
+
+    def __init__(self, rpa_script: str, size: int = 1, max_tasks: int = DEFAULT_MAX_TASKS):
+        self.rpa_script = os.path.abspath(rpa_script)
+        self.size = max(1, int(size))
+        self.max_tasks = max(1, int(max_tasks))
+        self._ctx = _mp_context()
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._all = set()
+        self._closed = False
+        self.stats = {"jobs": 0, "spawned": 0, "recycled": 0, "timeouts": 0, "crashed": 0}
+        for i in range(self.size):
+            self._idle.put(self._spawn(i))
+
+    def _spawn(self, index: int) -> _Slot:
+        # 入れ替え後の子は同じ番号（= 同じプロファイル群）を引き継ぐ
+        slot = _Slot(self._ctx, self.rpa_script, self.max_tasks, index)
+        with self._lock:
+            self._all.add(slot)
+            self.stats["spawned"] += 1
+        return slot
+
+    def _retire(self, slot: _Slot, kill: bool = False):
+        with self._lock:
+            self._all.discard(slot)
+        slot.kill() if kill else slot.close()
+
+    def _checkout(self) -> _Slot:
+        slot = self._idle.get()
+        if not slot.usable():
+            # max_tasks に達した / 落ちた子は入れ替える
+            self.stats["recycled"] += 1
+            self._retire(slot, kill=not slot.proc.is_alive())
+            slot = self._spawn(slot.index)
+        try:
+            slot.wait_ready()
+        except Exception:
+            self._retire(slot, kill=True)
+            # 同じ番号の子を補充してからエラーを返す
+            self._idle.put(self._spawn(slot.index))
+            raise
+        return slot
+
+    def __call__(self, rpa_script, cfg, log_stdout=False, extra_env: Optional[dict] = None,
+                 timeout_seconds: Optional[int] = 60 * 10, on_event=None):
+        if self._closed:
+            return False, {"success": False, "error": "runner closed"}
+        try:
+            slot = self._checkout()
+        except Exception as e:
+            return False, {"success": False, "error": str(e)[:1000]}
+        uid = (extra_env or {}).get("USER_UID")
+        self.stats["jobs"] += 1
+        try:
+            slot.conn.send((cfg, uid, extra_env))
+            slot.tasks += 1
+            deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+            while True:
+                wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not slot.conn.poll(wait):
+                    self.stats["timeouts"] += 1
+                    self._retire(slot, kill=True)
+                    slot = self._spawn(slot.index)
+                    return False, {"success": False, "timeout": True, "timeout_seconds": timeout_seconds}
+                kind, payload = slot.conn.recv()
+                if kind == "event":
+                    if on_event:
+                        try:
+                            on_event(payload)
+                        except Exception:
+                            pass
+                    continue
+                return payload
+        except (EOFError, OSError) as e:
+            self.stats["crashed"] += 1
+            self._retire(slot, kill=True)
+            exit_code = slot.proc.exitcode
+            slot = self._spawn(slot.index)
+            return False, {"success": False, "error": f"warm RPA child exited: {e}", "exit_code": exit_code}
+        finally:
+            self._idle.put(slot)
+
+    def terminate(self):
+        """Kill every child (second SIGINT/SIGTERM)."""
+        with self._lock:
+            slots = list(self._all)
+        for slot in slots:
+            slot.kill()
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            slots = list(self._all)
+            self._all.clear()
+        for slot in slots:
+            slot.close()
+
+
+def _bench(n: int, rpa_script: str):
+    """Compare per-job startup: cold interpreter importing the RPA module vs a warm child."""
+    import subprocess
+
+    cmd = [sys.executable, "-c", f"import importlib.util,sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(rpa_script))!r});"
+           f" s=importlib.util.spec_from_file_location('m', {os.path.abspath(rpa_script)!r});"
+           " m=importlib.util.module_from_spec(s); s.loader.exec_module(m)"]
+    t0 = time.perf_counter()
+    for _ in range(n):
+        subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
+    cold = (time.perf_counter() - t0) / n
+
+    runner = WarmRunner(rpa_script, size=1, max_tasks=n + 1)
+    t0 = time.perf_counter()
+    slot = runner._checkout()
+    runner._idle.put(slot)
+    spawn = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        # 認証情報なしのジョブ: import 済みの子で run() が即座に exit_code 2 を返すまでの往復
+        runner(rpa_script, {}, extra_env={"USER_UID": None, "GOOGLE_APPLICATION_CREDENTIALS": None}, timeout_seconds=60)
+    warm = (time.perf_counter() - t0) / n
+    runner.close()
+    print(json.dumps({"jobs": n, "cold_start_ms": round(cold * 1000, 1), "warm_spawn_ms": round(spawn * 1000, 1),
+                      "warm_job_ms": round(warm * 1000, 1)}, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Pre-warmed RPA child process pool")
+    p.add_argument("--bench", type=int, default=5, metavar="N", help="Jobs per mode")
+    p.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpa_gmail_indeed_test.py"))
+    args = p.parse_args()
+    _bench(args.bench, args.script)
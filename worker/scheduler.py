@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rpa_jobs の公平スケジューリング（ユーザー間の deficit round-robin + 任意の priority）。
+
+- priority（整数、既定 0）が大きいジョブを常に先に取る（厳格な優先度）
+- 同じ priority の中ではユーザー（fairKey = userDocId / userUid、enqueue 時に保存）ごとのキューを deficit round-robin で回す
+  - 1 巡ごとに各ユーザーの deficit に weight（ジョブの weight フィールド、既定 1）を加え、1 ジョブ = コスト 1
+  - 直近に取ったユーザーほど後回し（状態はプロセス内で保持し、バッチをまたいで巡回を続ける）
+- 1 人が大量に投入しても、他のユーザーのジョブは次の巡回で取られる
+
+候補は JobQueue.candidates(scan, per_user)（ユーザーごとの先頭ジョブを優先的に集めた queued の一部）から選ぶ。
+Firestore で必要な複合インデックスはリポジトリ直下の firestore.indexes.json を参照。
+
+Usage:
+    python scheduler.py --simulate                       # 偏った負荷での FIFO / fair の待ち時間 p95 を比較
+    python scheduler.py --simulate --heavy-jobs 500 --workers 4
+
+Env:
+- RPA_SCHEDULER (fair | fifo; default fair)
+"""
+
+import os
+import json
+import heapq
+import random
+from typing import Dict, List, Optional, Tuple
+
+Job = Tuple[str, dict]  # (job_id, data)
+
+DEFAULT_POLICY = os.environ.get("RPA_SCHEDULER", "fair").strip().lower()
+POLICIES = ("fair", "fifo")
+
+
+def job_user(data: dict) -> str:
+    """Fair-share key of a job: the fairKey stored at enqueue (userDocId, else userUid)."""
+    return str(data.get("fairKey") or data.get("userDocId") or data.get("userUid") or "")
+
+
+def job_priority(data: dict) -> int:
+    try:
+        return int(data.get("priority") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def job_weight(data: dict) -> float:
+    try:
+        return max(0.1, float(data.get("weight") or 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class FairScheduler:
+    """Deficit round-robin across users, within strict priority tiers.
+
+    pick(candidates, k) returns up to k jobs in the order they should be claimed.
+    Candidates are expected oldest-first per user (as JobQueue.candidates returns them).
+    """
+
+    def __init__(self):
+        self._deficit: Dict[str, float] = {}
+        self._served: Dict[str, int] = {}
+        self._tick = 0
+
+    def pick(self, candidates: List[Job], k: int) -> List[Job]:
+        tiers: Dict[int, Dict[str, List[Job]]] = {}
+        first_seen: Dict[str, int] = {}
+        for i, job in enumerate(candidates):
+            user = job_user(job[1])
+            first_seen.setdefault(user, i)
+            tiers.setdefault(job_priority(job[1]), {}).setdefault(user, []).append(job)
+
+        out: List[Job] = []
+        for prio in sorted(tiers, reverse=True):
+            queues = tiers[prio]
+            while queues and len(out) < k:
+                # 未処理のユーザー → 最後に取ってから長いユーザーの順（同点は先頭ジョブが古い順）
+                order = sorted(queues, key=lambda u: (self._served.get(u, -1), first_seen[u]))
+                for user in order:
+                    q = queues[user]
+                    self._deficit[user] = self._deficit.get(user, 0.0) + job_weight(q[0][1])
+                    while q and self._deficit[user] >= 1 and len(out) < k:
+                        out.append(q.pop(0))
+                        self._deficit[user] -= 1
+                        self._tick += 1
+                        self._served[user] = self._tick
+                    if not q:
+                        # 空になったキューは deficit を持ち越さない（DRR の規則）
+                        del queues[user]
+                        self._deficit[user] = 0.0
+                    if len(out) >= k:
+                        break
+            if len(out) >= k:
+                break
+        return out
+
+
+def make_picker(policy: Optional[str] = None):
+    """Return a picker(candidates, k) for claim_batch, or None for plain FIFO."""
+    policy = (policy or DEFAULT_POLICY).strip().lower()
+    if policy not in POLICIES:
+        raise ValueError(f"unknown RPA_SCHEDULER {policy!r} (expected one of {', '.join(POLICIES)})")
+    if policy == "fifo":
+        return None
+    return FairScheduler().pick
+
+
+# ----------------- simulation -----------------
+def _percentile(xs: List[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * (len(xs) - 1)))]
+
+
+def simulate(policy: str, workers: int = 4, heavy_jobs: int = 300, light_users: int = 9,
+             light_jobs: int = 20, light_interval: float = 120.0, service_s: float = 20.0,
+             scan: int = 50, seed: int = 1) -> dict:
+    """Virtual-time simulation of `workers` slots draining a skewed queue.
+
+    One heavy user enqueues heavy_jobs at t=0; each light user enqueues one job every
+    light_interval seconds. Service time is exponential with mean service_s.
+    Returns per-user {jobs, p50_wait_s, p95_wait_s, max_wait_s}.
+    """
+    rng = random.Random(seed)
+    arrivals = [(0.0, f"j-heavy-{i}", "heavy") for i in range(heavy_jobs)]
+    for u in range(light_users):
+        t0 = rng.uniform(0, light_interval)
+        arrivals += [(t0 + i * light_interval, f"j-light{u}-{i}", f"light{u}") for i in range(light_jobs)]
+    arrivals.sort()
+
+    picker = make_picker(policy)
+    queued: List[Tuple[float, str, dict]] = []  # (created_at, id, data) in arrival order
+    busy: List[float] = []  # heap of finish times
+    waits: Dict[str, List[float]] = {}
+    now, ai = 0.0, 0
+    while True:
+        while busy and busy[0] <= now:
+            heapq.heappop(busy)
+        while ai < len(arrivals) and arrivals[ai][0] <= now:
+            t, jid, user = arrivals[ai]
+            queued.append((t, jid, {"userUid": user, "created_at": t}))
+            ai += 1
+        free = workers - len(busy)
+        if free > 0 and queued:
+            # worker と同じく queued の先頭 scan 件（1 ユーザー最大 free 件）を候補にする
+            per_user: Dict[str, int] = {}
+            cands = []
+            for t, jid, data in queued:
+                u = data["userUid"]
+                if per_user.get(u, 0) < free:
+                    per_user[u] = per_user.get(u, 0) + 1
+                    cands.append((jid, data))
+                    if len(cands) >= scan:
+                        break
+            chosen = picker(cands, free) if picker else cands[:free]
+            chosen_ids = {jid for jid, _ in chosen}
+            for t, jid, data in queued:
+                if jid in chosen_ids:
+                    waits.setdefault(data["userUid"], []).append(now - t)
+                    heapq.heappush(busy, now + rng.expovariate(1.0 / service_s))
+            queued = [q for q in queued if q[1] not in chosen_ids]
+            continue
+        # 次のイベント（到着 / ジョブ完了）まで時間を進める
+        nxt = []
+        if ai < len(arrivals):
+            nxt.append(arrivals[ai][0])
+        if busy:
+            nxt.append(busy[0])
+        if not nxt:
+            break
+        now = max(now, min(nxt))
+
+    out = {}
+    for user in sorted(waits, key=lambda u: (u != "heavy", u)):
+        w = waits[user]
+        out[user] = {"jobs": len(w), "p50_wait_s": round(_percentile(w, 0.5), 1),
+                     "p95_wait_s": round(_percentile(w, 0.95), 1), "max_wait_s": round(max(w), 1)}
+    return out
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Fair-share scheduler for rpa_jobs")
+    p.add_argument("--simulate", action="store_true", help="Compare FIFO and fair p95 queue wait under skewed load")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--heavy-jobs", type=int, default=300)
+    p.add_argument("--light-users", type=int, default=9)
+    p.add_argument("--light-jobs", type=int, default=20)
+    p.add_argument("--light-interval", type=float, default=120.0, help="Seconds between a light user's jobs")
+    p.add_argument("--service", type=float, default=20.0, help="Mean job duration in seconds")
+    args = p.parse_args()
+    if not args.simulate:
+        p.error("nothing to do (use --simulate)")
+
+    results = {}
+    for policy in POLICIES:
+        results[policy] = simulate(policy, workers=args.workers, heavy_jobs=args.heavy_jobs,
+                                   light_users=args.light_users, light_jobs=args.light_jobs,
+                                   light_interval=args.light_interval, service_s=args.service)
+    print(f"{'user':<10} {'jobs':>5} | {'fifo p50':>9} {'fifo p95':>9} | {'fair p50':>9} {'fair p95':>9}")
+    for user, r in results["fifo"].items():
+        f = results["fair"].get(user, {})
+        print(f"{user:<10} {r['jobs']:>5} | {r['p50_wait_s']:>9} {r['p95_wait_s']:>9} | "
+              f"{f.get('p50_wait_s', '-'):>9} {f.get('p95_wait_s', '-'):>9}")
+    light = lambda res: [v["p95_wait_s"] for u, v in res.items() if u != "heavy"]
+    print(json.dumps({p_: {"light_users_p95_max_s": max(light(r) or [0]),
+                           "heavy_p95_s": r.get("heavy", {}).get("p95_wait_s")} for p_, r in results.items()}))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 SMS 发送台账（SQLite write-ahead ledger）。
+
+目的：同一用户 + 同一手机号 + 同一应募链接只发送一次 SMS。
+- 发送前 begin()：写入 pending 行（pending_at = 当前时间）；已有 sent/pending/deferred 行时直接返回该行（调用方跳过发送）
+- 发送后 complete()：记录 sent / failed 与结果
+- pending 超过 PENDING_TIMEOUT_SECONDS 仍未完成（进程在 begin() 与发送之间中断）时改为 unknown：
+  expire_pending() 在启动 / flush 时统一处理并返回这些行供上报；begin() 默认接管 unknown 行重新发送
+  （RPA_SMS_RETRY_UNKNOWN=0 时不重发，只上报）
+- 历史写入后 mark_history_written()；进程重启时 unreconciled() 返回
+  已结束（sent / failed / deferred / unknown）但尚未写入历史的条目，供补写
+- 送信許可時間外（quiet hours / 592）の送信は sms_deferred に保留し、
+  claim_due() で期限到来分をまとめて取り出して再送する（取り出した行は DEFER_LEASE_SECONDS だけ
+  due_at を先送りする）。送信直前に begin(deferred=True) で pending にするので、並行する flush は
+  送信中の行をスキップし、送信途中の中断は通常の送信と同じく pending -> unknown の回復に乗る
+- quiet hours は常に JST で判定する（サーバのローカルタイムゾーンに依存しない）
+- worker は due_uids() / next_due_at() で期限到来の保留がある uid を見つけ、メール処理の任務が
+  無くても flush 専用の子プロセス（RPA_SMS_FLUSH_ONLY=1）を起動する（see worker.py SmsFlusher）
+
+Env:
+- RPA_STATE_DIR (default: worker/rpa_state)
+- RPA_SMS_QUIET_HOURS (例 "21:00-08:00"、JST; sms_config.quiet_hours が優先)
+- RPA_SMS_DEFER_RETRY_MINUTES (default 30; quiet hours 未設定で 592 が返った場合の再送間隔)
+- RPA_SMS_PENDING_TIMEOUT_SECONDS (default 300; pending を unknown とみなすまでの時間。送信リクエストの最大所要時間より長く)
+- RPA_SMS_RETRY_UNKNOWN (default 1; 0 = unknown 行を再送せず上報のみ)
+- RPA_SMS_DEFER_LEASE_SECONDS (default 600; claim_due() で取り出した行の再取得までの猶予)
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import datetime
+from typing import Optional
+
+STATE_DIR = os.environ.get("RPA_STATE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpa_state")
+DEFAULT_DB_PATH = os.path.join(STATE_DIR, "sms_ledger.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sms_sends (
+    key TEXT PRIMARY KEY,
+    uid TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    source_url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    result TEXT,
+    entry TEXT,
+    history_written INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    pending_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_sms_sends_unreconciled ON sms_sends (uid, history_written);
+CREATE TABLE IF NOT EXISTS sms_deferred (
+    key TEXT PRIMARY KEY,
+    uid TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    name TEXT,
+    source_url TEXT,
+    due_at INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    history_doc_id TEXT,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sms_deferred_due ON sms_deferred (uid, due_at);
+"""
+
+DEFER_RETRY_MINUTES = int(os.environ.get("RPA_SMS_DEFER_RETRY_MINUTES", "30"))
+# post_sms は最大 2 回 × 30 秒。これより古い pending は送信途中で中断したものとみなす
+PENDING_TIMEOUT_SECONDS = int(os.environ.get("RPA_SMS_PENDING_TIMEOUT_SECONDS", "300"))
+RETRY_UNKNOWN = os.environ.get("RPA_SMS_RETRY_UNKNOWN", "1") != "0"
+# claim_due() で取り出した行の due_at を先送りする時間（flush が中断した行はこの後に再取得される）
+DEFER_LEASE_SECONDS = int(os.environ.get("RPA_SMS_DEFER_LEASE_SECONDS", "600"))
+# 送信許可時間（quiet hours）は日本時間で判定する（history_sink.JST と同じ）
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def normalize_phone(phone: Optional[str]) -> str:
+    """数字のみ + 先頭 81 を 0 に統一（比較用）。"""
+    digits = re.sub(r"[^0-9]", "", str(phone or ""))
+    if digits.startswith("81") and len(digits) >= 10:
+        digits = "0" + digits[2:]
+    return digits
+
+
+def _parse_hhmm(v) -> Optional[int]:
+    m = re.match(r"^\s*(\d{1,2}):(\d{2})\s*$", str(v or ""))
+    if not m:
+        return None
+    h, mi = int(m.group(1)), int(m.group(2))
+    if h > 24 or mi > 59:
+        return None
+    return (h * 60 + mi) % (24 * 60)
+
+
+def parse_quiet_hours(spec) -> Optional[tuple]:
+    """Accept {"start": "21:00", "end": "08:00"} or "21:00-08:00"; return (start_min, end_min)."""
+    if isinstance(spec, dict):
+        start, end = _parse_hhmm(spec.get("start")), _parse_hhmm(spec.get("end"))
+    elif isinstance(spec, str) and "-" in spec:
+        a, b = spec.split("-", 1)
+        start, end = _parse_hhmm(a), _parse_hhmm(b)
+    else:
+        return None
+    if start is None or end is None or start == end:
+        return None
+    return start, end
+
+
+def quiet_hours_end(quiet: Optional[tuple], now: Optional[datetime.datetime] = None) -> Optional[int]:
+    """If now (JST) is inside the quiet window, return the epoch ms when it ends; else None."""
+    if not quiet:
+        return None
+    now = (now or datetime.datetime.now(JST)).astimezone(JST)
+    start, end = quiet
+    cur = now.hour * 60 + now.minute
+    inside = (start <= cur < end) if start < end else (cur >= start or cur < end)
+    if not inside:
+        return None
+    ends = now.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+    if ends <= now:
+        ends += datetime.timedelta(days=1)
+    return int(ends.timestamp() * 1000)
+
+
+def ledger_key(uid: str, phone: Optional[str], source_url: Optional[str]) -> str:
+    raw = "\x1f".join([str(uid or ""), normalize_phone(phone), str(source_url or "")])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class SmsLedger:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or DEFAULT_DB_PATH
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # 旧版の台帳には pending_at 列がない（既存の pending 行は updated_at を pending 時刻とみなす）
+        cols = {r["name"] for r in self._conn.execute("PRAGMA table_info(sms_sends)")}
+        if "pending_at" not in cols:
+            self._conn.execute("ALTER TABLE sms_sends ADD COLUMN pending_at INTEGER")
+            self._conn.execute("UPDATE sms_sends SET pending_at = updated_at WHERE state = 'pending'")
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _row_to_dict(row) -> Optional[dict]:
+        if row is None:
+            return None
+        d = dict(row)
+        for k in ("result", "entry"):
+            if d.get(k):
+                try:
+                    d[k] = json.loads(d[k])
+                except Exception:
+                    pass
+        return d
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM sms_sends WHERE key = ?", (key,)).fetchone()
+        return self._row_to_dict(row)
+
+    def begin(self, key: str, uid: str, phone: str, source_url: str,
+              retry_unknown: Optional[bool] = None, deferred: bool = False) -> Optional[dict]:
+        """Reserve key for sending.
+
+        Returns None when the caller owns the send, otherwise the existing row
+        (state 'sent', 'pending' or 'deferred' -> do not send again). A previous 'failed'
+        row is taken over so failed sends can be retried; so is an 'unknown' row (a stale
+        'pending' whose outcome was never recorded) unless retry_unknown is False.
+        deferred=True (the deferred-queue flush) also takes over a 'deferred' row, so the
+        send is 'pending' while the request is in flight like any other send.
+        """
+        now = _now_ms()
+        retry_unknown = RETRY_UNKNOWN if retry_unknown is None else retry_unknown
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                row = cur.execute("SELECT * FROM sms_sends WHERE key = ?", (key,)).fetchone()
+                if row is not None and row["state"] == "pending" and self._is_stale(row, now):
+                    cur.execute("UPDATE sms_sends SET state = 'unknown', updated_at = ? WHERE key = ?", (now, key))
+                    row = cur.execute("SELECT * FROM sms_sends WHERE key = ?", (key,)).fetchone()
+                takeover = row is None or row["state"] == "failed" or (row["state"] == "unknown" and retry_unknown) \
+                    or (deferred and row["state"] == "deferred")
+                if not takeover:
+                    cur.execute("COMMIT")
+                    return self._row_to_dict(row)
+                cur.execute(
+                    "INSERT INTO sms_sends (key, uid, phone, source_url, state, created_at, updated_at, pending_at) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = 'pending', result = NULL,"
+                    " updated_at = excluded.updated_at, pending_at = excluded.pending_at",
+                    (key, str(uid or ""), normalize_phone(phone), str(source_url or ""), now, now, now),
+                )
+                cur.execute("COMMIT")
+                return None
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _is_stale(row, now: int) -> bool:
+        started = row["pending_at"] or row["updated_at"] or 0
+        return now - int(started) >= PENDING_TIMEOUT_SECONDS * 1000
+
+    def expire_pending(self, timeout_seconds: Optional[int] = None) -> list:
+        """Mark 'pending' rows older than the timeout as 'unknown' and return them.
+
+        Such a row means the process died between begin() and complete(): the provider
+        may or may not have received the request, so it must be surfaced (and retried by
+        begin() unless RPA_SMS_RETRY_UNKNOWN=0) instead of being skipped forever.
+        """
+        timeout = PENDING_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+        now = _now_ms()
+        cutoff = now - int(timeout) * 1000
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                rows = cur.execute(
+                    "SELECT * FROM sms_sends WHERE state = 'pending' AND COALESCE(pending_at, updated_at) <= ?",
+                    (cutoff,),
+                ).fetchall()
+                cur.executemany("UPDATE sms_sends SET state = 'unknown', updated_at = ? WHERE key = ?",
+                                [(now, r["key"]) for r in rows])
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        out = []
+        for r in rows:
+            d = self._row_to_dict(r)
+            d["state"] = "unknown"
+            out.append(d)
+        return out
+
+    def complete(self, key: str, result: Optional[dict], sent: bool, state: Optional[str] = None):
+        """Record the outcome; state overrides sent/failed (e.g. 'deferred')."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE sms_sends SET state = ?, result = ?, updated_at = ? WHERE key = ?",
+                (state or ("sent" if sent else "failed"), json.dumps(result, ensure_ascii=False, default=str), _now_ms(), key),
+            )
+
+    def attach_entry(self, key: str, entry: dict):
+        """Store the history entry that will be written for this send (used for reconciliation)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE sms_sends SET entry = ?, updated_at = ? WHERE key = ?",
+                (json.dumps(entry, ensure_ascii=False, default=str), _now_ms(), key),
+            )
+
+    def mark_history_written(self, key: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE sms_sends SET history_written = 1, updated_at = ? WHERE key = ?",
+                (_now_ms(), key),
+            )
+
+    def unreconciled(self, uid: str, limit: int = 500) -> list:
+        """Sends that are no longer in flight (sent / failed / deferred / unknown) but whose
+        history entry was never confirmed as written."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM sms_sends WHERE uid = ? AND history_written = 0 AND entry IS NOT NULL "
+                "AND state IN ('sent', 'failed', 'deferred', 'unknown') ORDER BY created_at LIMIT ?",
+                (str(uid or ""), int(limit)),
+            ).fetchall()
+        return [self._row_to_dict(r) for r in rows]
+
+    # ----------------- deferred queue -----------------
+    def defer(self, key: str, uid: str, phone: str, name: str, source_url: str, due_at: int):
+        """Park a send until due_at (epoch ms). Re-deferring moves due_at and bumps attempts."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sms_deferred (key, uid, phone, name, source_url, due_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET due_at = excluded.due_at, attempts = attempts + 1",
+                (key, str(uid or ""), str(phone or ""), str(name or ""), str(source_url or ""), int(due_at), _now_ms()),
+            )
+
+    def attach_history(self, key: str, history_doc_id: str):
+        """Remember the history document to update once the deferred send goes out."""
+        with self._lock:
+            self._conn.execute("UPDATE sms_deferred SET history_doc_id = ? WHERE key = ?", (str(history_doc_id), key))
+
+    def due_rows(self, uid: str, now_ms: Optional[int] = None, limit: int = 50) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM sms_deferred WHERE uid = ? AND due_at <= ? ORDER BY due_at LIMIT ?",
+                (str(uid or ""), int(now_ms or _now_ms()), int(limit)),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def claim_due(self, uid: str, now_ms: Optional[int] = None, limit: int = 50,
+                  lease_seconds: Optional[int] = None) -> list:
+        """Like due_rows(), but pushes the returned rows' due_at forward by the lease in the same
+        transaction, so a concurrent flush (job child + worker flush) does not send them twice.
+        Rows the caller never completes / re-defers come due again when the lease runs out."""
+        now_ms = int(now_ms or _now_ms())
+        lease_ms = int(DEFER_LEASE_SECONDS if lease_seconds is None else lease_seconds) * 1000
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT * FROM sms_deferred WHERE uid = ? AND due_at <= ? ORDER BY due_at LIMIT ?",
+                    (str(uid or ""), now_ms, int(limit)),
+                ).fetchall()
+                self._conn.executemany("UPDATE sms_deferred SET due_at = ? WHERE key = ?",
+                                       [(now_ms + lease_ms, r["key"]) for r in rows])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [dict(r) for r in rows]
+
+    def next_due_at(self, uid: Optional[str] = None) -> Optional[int]:
+        """Earliest due_at of the uid's deferred sends (all uids when uid is None)."""
+        with self._lock:
+            if uid is None:
+                row = self._conn.execute("SELECT MIN(due_at) AS d FROM sms_deferred").fetchone()
+            else:
+                row = self._conn.execute("SELECT MIN(due_at) AS d FROM sms_deferred WHERE uid = ?", (str(uid),)).fetchone()
+        return row["d"] if row and row["d"] is not None else None
+
+    def due_uids(self, now_ms: Optional[int] = None) -> list:
+        """uids with at least one deferred send whose due time has passed."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT uid, MIN(due_at) AS d FROM sms_deferred WHERE due_at <= ? GROUP BY uid ORDER BY d",
+                (int(now_ms or _now_ms()),),
+            ).fetchall()
+        return [r["uid"] for r in rows]
+
+    def remove_deferred(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sms_deferred WHERE key = ?", (key,))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMS 发送负载测试（sms_transport.post_sms を目標レートで駆動）。
+
+Usage:
+    # 内蔵のモックサーバーに対して 40 req/s を 30 秒
+    python sms_loadtest.py --mock --rate 40 --duration 30 --concurrency 16
+    # 既存のエンドポイント（sms_mock_server.py など）に対して
+    python sms_loadtest.py --url http://127.0.0.1:8765/sms --api-id mock --api-password mock --session
+
+出力: p50/p95/p99 レイテンシ、達成スループット、81 形式での再試行回数、コード分布
+"""
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from sms_transport import post_sms, DEFAULT_RETRY_CODES
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def run_load(url: str, api_id: str, api_password: str, rate: float, duration: float, concurrency: int,
+             use_session: bool = False, phone: str = "09012345678", text: str = "負荷テスト {n}",
+             retry_codes=None, timeout: float = 30) -> dict:
+    """Issue requests at `rate` per second for `duration` seconds; return a summary dict."""
+    local = threading.local()
+
+    def _session():
+        if not use_session:
+            return None
+        s = getattr(local, "session", None)
+        if s is None:
+            import requests
+            s = requests.Session()
+            local.session = s
+        return s
+
+    lock = threading.Lock()
+    latencies, codes = [], {}
+    retries = 0
+
+    def one(n: int):
+        nonlocal retries
+        t0 = time.perf_counter()
+        res = post_sms(url, api_id, api_password, phone, text.format(n=n),
+                       retry_codes=DEFAULT_RETRY_CODES if retry_codes is None else retry_codes,
+                       session=_session(), timeout=timeout)
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+            key = str(res.get("code") or res.get("status"))
+            codes[key] = codes.get(key, 0) + 1
+            if res.get("retry_attempted"):
+                retries += 1
+
+    total = int(rate * duration)
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for n in range(total):
+            # open-loop schedule: request n is due at start + n * interval
+            wait = start + n * interval - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(one, n)
+    elapsed = time.perf_counter() - start
+
+    lat = sorted(latencies)
+    return {
+        "requests": len(lat),
+        "target_rate": rate,
+        "achieved_rate": round(len(lat) / elapsed, 2) if elapsed > 0 else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "p50_ms": round(percentile(lat, 50) * 1000, 1),
+        "p95_ms": round(percentile(lat, 95) * 1000, 1),
+        "p99_ms": round(percentile(lat, 99) * 1000, 1),
+        "max_ms": round((lat[-1] if lat else 0) * 1000, 1),
+        "retries": retries,
+        "codes": dict(sorted(codes.items())),
+        "session": use_session,
+        "concurrency": concurrency,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="SMS sender load generator")
+    p.add_argument("--url", help="SMS API endpoint (omit with --mock)")
+    p.add_argument("--api-id", default="mock")
+    p.add_argument("--api-password", default="mock")
+    p.add_argument("--mock", action="store_true", help="Start an in-process sms_mock_server")
+    p.add_argument("--latency-ms", type=float, default=50, help="(--mock) base latency")
+    p.add_argument("--jitter-ms", type=float, default=20, help="(--mock) latency jitter")
+    p.add_argument("--error-mix", default="503:0.01,560:0.02,592:0.01", help="(--mock) code:rate,...")
+    p.add_argument("--max-rps", type=int, default=80, help="(--mock) 503 above this rate")
+    p.add_argument("--rate", type=float, default=20, help="Target requests per second")
+    p.add_argument("--duration", type=float, default=10, help="Seconds")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--session", action="store_true", help="Reuse a pooled requests.Session per thread")
+    p.add_argument("--timeout", type=float, default=30)
+    args = p.parse_args()
+
+    server = None
+    url: Optional[str] = args.url
+    if args.mock:
+        from sms_mock_server import start_server, parse_error_mix
+        server, _state, url = start_server(
+            api_id=args.api_id, api_password=args.api_password, latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms, error_mix=parse_error_mix(args.error_mix), max_rps=args.max_rps,
+        )
+    if not url:
+        p.error("--url or --mock is required")
+
+    try:
+        summary = run_load(url, args.api_id, args.api_password, args.rate, args.duration, args.concurrency,
+                           use_session=args.session, timeout=args.timeout)
+        if server is not None:
+            summary["server"] = _state.snapshot()
+        print(json.dumps(summary, ensure_ascii=False, indent=2), flush=True)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
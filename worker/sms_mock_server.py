@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 SMS API 替身服务器（负载测试 / 离线调试用）。
+
+行为与正式 SMS API 对齐：
+- POST application/x-www-form-urlencoded（mobilenumber, smstext）
+- Basic Auth 校验失败 -> 401
+- HTTP 状态码即结果码，正文为 {"code": "..."} JSON
+- 超过 --max-rps 时返回 503（正式环境为 80 req/sec）
+
+Usage:
+    python sms_mock_server.py --port 8765 --latency-ms 80 --jitter-ms 40 \\
+        --error-mix 503:0.02,560:0.05,592:0.01
+    GET /stats で集計（JSON）を確認できる
+
+Env:
+- SMS_MOCK_API_ID / SMS_MOCK_API_PASSWORD (default mock / mock)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import base64
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+def parse_error_mix(spec: Optional[str]) -> list:
+    """'503:0.02,560:0.05' -> [(503, 0.02), (560, 0.05)]"""
+    mix = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        code, _, rate = part.partition(":")
+        try:
+            mix.append((int(code), float(rate or 0)))
+        except ValueError:
+            raise ValueError(f"invalid --error-mix entry: {part!r}")
+    return mix
+
+
+class MockSmsState:
+    def __init__(self, api_id: str, api_password: str, latency_ms: float = 0, jitter_ms: float = 0,
+                 error_mix=None, max_rps: int = 0, seed: Optional[int] = None):
+        self.expected_auth = "Basic " + base64.b64encode(f"{api_id}:{api_password}".encode("utf-8")).decode("ascii")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_mix = list(error_mix or [])
+        self.max_rps = max_rps
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.counts = {}
+        self.total = 0
+
+    def _over_rate(self) -> bool:
+        if self.max_rps <= 0:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            self._window_start, self._window_count = now, 0
+        self._window_count += 1
+        return self._window_count > self.max_rps
+
+    def decide(self, auth: str, mobile: str) -> int:
+        with self._lock:
+            self.total += 1
+            if auth != self.expected_auth:
+                code = 401
+            elif self._over_rate():
+                code = 503
+            elif not mobile.isdigit():
+                code = 560
+            else:
+                code = 200
+                r = self._rng.random()
+                acc = 0.0
+                for c, rate in self.error_mix:
+                    acc += rate
+                    if r < acc:
+                        code = c
+                        break
+                # 560 只模拟本地格式被拒绝，81 格式重试会成功
+                if code == 560 and mobile.startswith("81"):
+                    code = 200
+            self.counts[code] = self.counts.get(code, 0) + 1
+            return code
+
+    def delay(self) -> float:
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(0.0, (self.latency_ms + jitter) / 1000.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"total": self.total, "codes": {str(k): v for k, v in sorted(self.counts.items())}}
+
+
+def make_handler(state: MockSmsState, quiet: bool = True):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            if not quiet:
+                sys.stderr.write("[mock-sms] " + (fmt % args) + "\n")
+
+        def _reply(self, status: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                self._reply(200, state.snapshot())
+            else:
+                self._reply(405, {"code": "405"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length).decode("utf-8", errors="replace") if length else ""
+            form = urllib.parse.parse_qs(raw)
+            mobile = (form.get("mobilenumber") or [""])[0]
+            code = state.decide(self.headers.get("Authorization") or "", mobile)
+            time.sleep(state.delay())
+            self._reply(code, {"code": str(code)})
+
+    return Handler
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **state_kwargs):
+    """Start the mock in a background thread; returns (server, state, url)."""
+    state = MockSmsState(**state_kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-sms", daemon=True).start()
+    url = f"http://{server.server_address[0]}:{server.server_address[1]}/sms"
+    return server, state, url
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Mock SMS API server")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--api-id", default=os.environ.get("SMS_MOCK_API_ID", "mock"))
+    p.add_argument("--api-password", default=os.environ.get("SMS_MOCK_API_PASSWORD", "mock"))
+    p.add_argument("--latency-ms", type=float, default=50)
+    p.add_argument("--jitter-ms", type=float, default=20)
+    p.add_argument("--error-mix", default="503:0.01,560:0.02,592:0.01", help="code:rate,... (rates are fractions)")
+    p.add_argument("--max-rps", type=int, default=80, help="503 above this many requests/sec (0 = unlimited)")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--verbose", action="store_true")
+    args = p.parse_args()
+
+    state = MockSmsState(args.api_id, args.api_password, args.latency_ms, args.jitter_ms,
+                         parse_error_mix(args.error_mix), args.max_rps, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state, quiet=not args.verbose))
+    server.daemon_threads = True
+    print(f"mock SMS API: http://{args.host}:{args.port}/sms (stats: /stats)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.snapshot(), ensure_ascii=False), flush=True)
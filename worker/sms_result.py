@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMS API 返回值的统一解析（code / level / message）。
+
+- コード表は sms_codes.json（src/lib/smsCodes.ts と共有）から一度だけ読み込む
+- 正規表現はモジュール読み込み時にコンパイル済み
+- Content-Type が分かる場合は JSON / XML の解析だけを行う（fast path）
+
+Usage:
+    from sms_result import resolve_sms_result
+    info = resolve_sms_result(status, text, content_type)
+
+Benchmark / fuzz:
+    python sms_result.py --bench [--iterations 20000]
+"""
+
+import os
+import re
+import json
+from typing import Optional
+
+CODES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sms_codes.json")
+DEFAULT_PROVIDER = "sms-console"
+
+_JSON_KEYS = ("code", "status", "result", "result_code", "error_code", "ErrorCode")
+_XML_RE = re.compile(r"<\s*(?:Code|Status|Result)\s*>\s*([^<\s]+)\s*<\s*/\s*(?:Code|Status|Result)\s*>", re.I)
+_KV_RE = re.compile(r"\b(?:code|status|result)\s*[:=]\s*[\"']?([A-Za-z0-9_-]{2,})", re.I)
+_NUM_RE = re.compile(r"\b([1-9][0-9]{2})\b")
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_\-]")
+
+
+def _load_codebook(path: str = CODES_PATH) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except Exception:
+        return {}
+    book = {}
+    for provider, table in (raw or {}).items():
+        if isinstance(table, dict):
+            book[provider] = {
+                str(code): (d.get("level") or "failed", d.get("text") or "")
+                for code, d in table.items() if isinstance(d, dict)
+            }
+    return book
+
+
+# provider -> { code: (level, text) }
+CODEBOOK = _load_codebook()
+
+
+def _code_from_json_obj(obj) -> Optional[str]:
+    if not isinstance(obj, dict):
+        return None
+    for k in _JSON_KEYS:
+        if obj.get(k) is not None:
+            return str(obj[k]).upper()
+    err = obj.get("error")
+    if isinstance(err, dict) and err.get("code"):
+        return str(err.get("code")).upper()
+    return None
+
+
+def _code_from_json_text(text: str) -> Optional[str]:
+    try:
+        return _code_from_json_obj(json.loads(text))
+    except Exception:
+        return None
+
+
+def _code_from_xml(text: str) -> Optional[str]:
+    m = _XML_RE.search(text)
+    return m.group(1).upper() if m else None
+
+
+def _code_from_plain(text: str) -> Optional[str]:
+    m = _KV_RE.search(text)
+    if m:
+        return m.group(1).upper()
+    m = _NUM_RE.search(text)
+    return m.group(1) if m else None
+
+
+def extract_code(text, http_status=None, content_type: Optional[str] = None) -> Optional[str]:
+    """从响应正文中尽力抽出 code；都失败时退回 HTTP 状态码。"""
+    text = text if isinstance(text, str) else ("" if text is None else str(text))
+    ctype = (content_type or "").lower()
+    code = None
+    if "json" in ctype:
+        code = _code_from_json_text(text)
+    elif "xml" in ctype:
+        code = _code_from_xml(text)
+    else:
+        stripped = text.lstrip()
+        if stripped[:1] in ("{", "["):
+            code = _code_from_json_text(stripped)
+        if code is None and "<" in text:
+            code = _code_from_xml(text)
+    if code is None and text:
+        code = _code_from_plain(text)
+    if code is None and http_status:
+        code = str(http_status)
+    return code
+
+
+def normalize_code(raw_code) -> Optional[str]:
+    """去空白、去外层引号，仅保留字母数字下划线和短横线并大写化。"""
+    if raw_code is None:
+        return None
+    cstr = str(raw_code).strip()
+    if len(cstr) >= 2 and cstr[0] == cstr[-1] and cstr[0] in ("'", '"'):
+        cstr = cstr[1:-1]
+    cstr = _UNSAFE_RE.sub("", cstr).upper()
+    return cstr or None
+
+
+def resolve_sms_result(http_status, text, content_type: Optional[str] = None, provider: str = DEFAULT_PROVIDER) -> dict:
+    """Return {"code", "level", "message"} for a provider response."""
+    code = normalize_code(extract_code(text or "", http_status, content_type))
+    if not code and http_status == 200:
+        code = "200"
+
+    book = CODEBOOK.get(provider) or CODEBOOK.get("default") or {}
+    if code and code in book:
+        level, text_ja = book[code]
+        message = f"コード {code}: {text_ja}"
+    elif code:
+        level = "failed"
+        message = f"コード {code}: 未定義のコード"
+    else:
+        level = "error"
+        message = "コードを取得できませんでした"
+    return {"code": code, "level": level, "message": message}
+
+
+# ----------------- benchmark / fuzz -----------------
+SAMPLE_RESPONSES = [
+    (200, '{"code": 200, "message": "OK"}', "application/json"),
+    (200, '{"result": "200", "smsid": "REQ1700000000000"}', "application/json; charset=utf-8"),
+    (560, '{"error": {"code": "560", "message": "Invalid mobilenumber"}}', "application/json"),
+    (200, "<Response><Code>200</Code></Response>", "text/xml"),
+    (592, "<Result>592</Result>", "application/xml"),
+    (503, "status=503 Temporary unavailable", "text/plain"),
+    (401, "Authorization Required", "text/html"),
+    (200, "", ""),
+    (0, "HTTPSConnectionPool(host='example.invalid', port=443): Read timed out.", None),
+]
+
+
+def _fuzz_inputs(rng, n):
+    alphabet = '{}[]<>/:="\' abcCODEstatusResult0123456789\n'
+    for _ in range(n):
+        base_status, base_text, base_ctype = rng.choice(SAMPLE_RESPONSES)
+        mutated = list(base_text)
+        for _ in range(rng.randint(0, 4)):
+            pos = rng.randint(0, len(mutated)) if mutated else 0
+            op = rng.random()
+            if op < 0.4 and mutated and pos < len(mutated):
+                del mutated[pos]
+            else:
+                mutated.insert(pos, rng.choice(alphabet))
+        yield rng.choice([base_status, 0, 200, 560]), "".join(mutated), rng.choice([base_ctype, None, "text/plain"])
+
+
+def _bench(iterations: int):
+    import random
+    import time
+
+    rng = random.Random(1234)
+    for status, text, ctype in _fuzz_inputs(rng, iterations):
+        info = resolve_sms_result(status, text, ctype)
+        assert info["level"] in ("success", "failed", "error"), info
+        assert info["code"] is None or _UNSAFE_RE.search(info["code"]) is None, info
+
+    cases = [SAMPLE_RESPONSES[i % len(SAMPLE_RESPONSES)] for i in range(iterations)]
+    for label, use_ctype in (("with content-type", True), ("without content-type", False)):
+        t0 = time.perf_counter()
+        for status, text, ctype in cases:
+            resolve_sms_result(status, text, ctype if use_ctype else None)
+        dt = time.perf_counter() - t0
+        print(f"{label:22s}: {iterations} responses in {dt * 1000:.1f} ms ({dt / iterations * 1e6:.2f} us/op)")
+    print(f"fuzz: {iterations} mutated responses parsed without error")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="SMS result parser benchmark / fuzz")
+    p.add_argument("--bench", action="store_true", help="Run fuzz + micro benchmark over sample responses")
+    p.add_argument("--iterations", type=int, default=20000)
+    args = p.parse_args()
+    if args.bench:
+        _bench(args.iterations)
+    else:
+        p.print_help()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SMS API 的 HTTP 发送部分（与模板选择 / 配置读取无关）。
+
+rpa_gmail_indeed_test.send_sms_if_configured 与 sms_loadtest.py 共用：
+- 手机号校验 / 本地格式与 81 格式转换
+- Basic Auth 表单 POST，遇到 retry_codes 时用 81 格式重试一次
+- 结果通过 sms_result 统一为 code / level / message
+"""
+
+import re
+import json
+import base64
+from typing import Callable, Optional
+
+from sms_result import resolve_sms_result
+
+DEFAULT_RETRY_CODES = [560]
+DEFAULT_TIMEOUT = 30
+
+
+def is_valid_jp_phone(num: str) -> bool:
+    """
+    严格按API要求校验手机号：
+    1. 仅数字。
+    2. 11位：020X, 060X, 070X, 080X, 090X（X为1-9）。
+    3. 14位：0200, 0600, 0700, 0800, 0900开头。
+    4. 8180, 8190开头的值：12位以内。
+    5. 0或81以外开头的值：6~20位。
+    """
+    if not num.isdigit():
+        return False
+    l = len(num)
+    if l == 11 and re.match(r"^(020[1-9]|060[1-9]|070[1-9]|080[1-9]|090[1-9])", num):
+        return True
+    if l == 14 and re.match(r"^(0200|0600|0700|0800|0900)", num):
+        return True
+    if re.match(r"^(8180|8190)", num) and l <= 12:
+        return True
+    # 兜底规则：只要是 6~20 位数字就接受（覆盖各种区号/国际码情况），
+    # 以减少因本地/国际前缀判断不一致导致的拒绝（出现560错误）的情况。
+    if 6 <= l <= 20:
+        return True
+    return False
+
+
+def to_local(num: str) -> str:
+    # 若以 81 开头，转换为 0 + rest；若以 0 开头则返回原值；否则直接返回
+    if num.startswith("81"):
+        return "0" + num[2:]
+    return num
+
+
+def to_81(num: str) -> str:
+    if num.startswith("0"):
+        return "81" + num[1:]
+    return num
+
+
+def parse_retry_codes(sms_config) -> list:
+    """sms_config.retry_status_codes / retry_on_status（单值或列表），默认 [560]。"""
+    raw = DEFAULT_RETRY_CODES
+    try:
+        if isinstance(sms_config, dict):
+            raw = sms_config.get("retry_status_codes") or sms_config.get("retry_on_status") or DEFAULT_RETRY_CODES
+    except Exception:
+        raw = DEFAULT_RETRY_CODES
+    codes = []
+    if isinstance(raw, (list, tuple)):
+        for v in raw:
+            try:
+                codes.append(int(v))
+            except Exception:
+                continue
+    else:
+        try:
+            codes = [int(raw)]
+        except Exception:
+            codes = list(DEFAULT_RETRY_CODES)
+    return codes
+
+
+def build_headers(api_id: str, api_password: str) -> dict:
+    auth_b64 = base64.b64encode(f"{api_id}:{api_password}".encode("utf-8")).decode("ascii")
+    return {
+        "Authorization": f"Basic {auth_b64}",
+        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+        "User-Agent": "python-fetch/1.0",
+        "Connection": "close",
+    }
+
+
+def post_sms(api_url: str, api_id: str, api_password: str, phone_for_api: str, smstext: str,
+             retry_codes=None, session=None, timeout: float = DEFAULT_TIMEOUT,
+             on_attempt: Optional[Callable[[str, str, int], None]] = None) -> dict:
+    """POST one SMS (local format first, 81 format once on retry_codes) and normalize the result.
+
+    session: optional requests.Session (or anything with .post) for connection reuse.
+    on_attempt(attempt, mobile, status) is called after every HTTP attempt.
+    """
+    headers = build_headers(api_id, api_password)
+    if session is None:
+        import requests
+        session = requests
+    else:
+        # keep-alive is only useful with a pooled session
+        headers.pop("Connection", None)
+    retry_codes = DEFAULT_RETRY_CODES if retry_codes is None else retry_codes
+    smstext = smstext.replace("&", "＆")
+
+    def post_once(mobile: str):
+        body = {"mobilenumber": mobile, "smstext": smstext}
+        try:
+            r = session.post(api_url, data=body, headers=headers, timeout=timeout)
+            return r.status_code, (r.text if isinstance(r.text, str) else json.dumps(r.text)), r.headers.get("Content-Type")
+        except Exception as e:
+            return 0, str(e), None
+
+    # 先尝试本地格式，再根据重试码决定是否使用 81 格式重试
+    local_num = to_local(phone_for_api)
+    alt_81 = to_81(local_num)
+
+    final_status, final_text, final_ctype = post_once(local_num)
+    if on_attempt:
+        on_attempt("local", local_num, final_status)
+
+    retry_attempted = False
+    if final_status in retry_codes:
+        retry_attempted = True
+        final_status, final_text, final_ctype = post_once(alt_81)
+        if on_attempt:
+            on_attempt("alt_81", alt_81, final_status)
+
+    normalized = resolve_sms_result(final_status, final_text or "", final_ctype)
+    result = {
+        "success": final_status == 200,
+        "provider": "sms-api",
+        "status": final_status,
+        "code": normalized.get("code"),
+        "level": normalized.get("level"),
+        "message": normalized.get("message"),
+        "output": final_text,
+        "retry_attempted": retry_attempted,
+    }
+    # If HTTP status is 200 treat as success-level by default to match terminal indication
+    if result["status"] == 200 and result["level"] != "success":
+        result["level"] = "success"
+        if not result.get("message"):
+            result["message"] = "HTTP 200: treated as success"
+    return result
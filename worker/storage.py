@@ -0,0 +1,1072 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+worker のストレージ抽象（ジョブキュー / ユーザー設定 / 履歴）。
+
+- firestore: 本番（rpa_jobs / user_configs / rpa_history）。FIRESTORE_EMULATOR_HOST を設定すれば
+  google-cloud-firestore がそのままエミュレータに接続する
+- sqlite:    ローカルの 1 ファイル（WAL）。worker と子プロセスで共有でき、ネットワーク不要
+- memory:    プロセス内 dict（ベンチマーク / 単一プロセスのテスト用）
+
+Env:
+- RPA_STORAGE_BACKEND (firestore | sqlite | memory; default firestore)
+- RPA_STORAGE_PATH    (sqlite のファイル; default RPA_STATE_DIR/storage.sqlite3)
+- RPA_LEASE_SECONDS   (claim のリース期間; default 120。worker の heartbeat が期限を延長する)
+  claim ごとに claim_token を発行し、heartbeat と完了書き込み（finish）は claimed_by + claim_token が
+  一致する running ジョブにだけトランザクション内で書く（リース切れで再 claim されたジョブは上書きしない）
+- RPA_MAX_ATTEMPTS    (リース切れで再キューする上限; default 3、超えたら failed)
+- RPA_RETRY_BACKOFF_SECONDS (再キュー前の待ち時間の基数; default 30、attempts ごとに倍)
+- RPA_JOB_TTL_SECONDS (done / failed ジョブの保持期間; default 86400。expires_at に書く)
+- RPA_GC_PAGE_SIZE    (期限切れジョブ削除の 1 ページの件数; default 500)
+
+expires_at は Firestore ではネイティブの Timestamp として書くので、TTL ポリシーをそのまま使える:
+    gcloud firestore fields ttls update expires_at --collection-group=rpa_jobs --enable-ttl
+（firestore.indexes.json の fieldOverrides にも同じ設定がある。旧形式の ISO 文字列の expires_at も削除対象）
+"""
+
+import os
+import sys
+import json
+import heapq
+import sqlite3
+import threading
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+try:
+    from google.cloud import firestore
+except Exception:
+    firestore = None
+
+from sms_ledger import STATE_DIR
+from scheduler import job_priority, job_user
+
+BACKENDS = ("firestore", "sqlite", "memory")
+DEFAULT_BACKEND = "firestore"
+DEFAULT_SQLITE_PATH = os.path.join(STATE_DIR, "storage.sqlite3")
+JOB_COLLECTION = os.environ.get("RPA_JOB_COLLECTION", "rpa_jobs")
+HISTORY_COLLECTION = os.environ.get("RPA_HISTORY_COLLECTION", "rpa_history")
+LEASE_SECONDS = int(os.environ.get("RPA_LEASE_SECONDS", "120"))
+MAX_ATTEMPTS = int(os.environ.get("RPA_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = int(os.environ.get("RPA_RETRY_BACKOFF_SECONDS", "30"))
+RETRY_BACKOFF_MAX_SECONDS = 3600
+JOB_TTL_SECONDS = int(os.environ.get("RPA_JOB_TTL_SECONDS", str(24 * 3600)))
+GC_PAGE_SIZE = int(os.environ.get("RPA_GC_PAGE_SIZE", "500"))
+# on_snapshot で監視する queued ジョブの先頭件数（新着の検知にのみ使う）
+WATCH_LIMIT = 50
+# 先頭の窓を占有しているユーザーを除外して読むときの上限（Firestore の not-in は最大 10 値）
+NOT_IN_MAX = 10
+
+Job = Tuple[str, dict]  # (job_id, data)
+Claim = Tuple[str, str, Optional[str]]  # (job_id, claimed_by, claim_token)
+
+
+def shard_of(key: str, shards: int) -> int:
+    """Stable shard number of a job id / worker id (crc32, same on every host)."""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+def prefer_shard(jobs: List[Job], shard: Optional[int], shards: int) -> List[Job]:
+    """Own-shard jobs first (keeping created_at order), then the rest so idle workers can still steal."""
+    if shard is None or shards <= 1:
+        return list(jobs)
+    mine = [j for j in jobs if shard_of(j[0], shards) == shard]
+    rest = [j for j in jobs if shard_of(j[0], shards) != shard]
+    return mine + rest
+
+
+def cap_per_user(jobs: List[Job], per_user: Optional[int], limit: int) -> List[Job]:
+    """Highest priority first (stable, so created_at order is kept), at most per_user jobs per user."""
+    out, seen = [], {}
+    for job in sorted(jobs, key=lambda j: -job_priority(j[1])):
+        user = job_user(job[1])
+        if per_user and seen.get(user, 0) >= per_user:
+            continue
+        seen[user] = seen.get(user, 0) + 1
+        out.append(job)
+        if len(out) >= limit:
+            break
+    return out
+
+
+def queued_doc(data: dict) -> dict:
+    """Document for a new queued job; fairKey (= scheduler.job_user) is stored so Firestore can
+    filter / index on the same per-user key that the scheduler groups by."""
+    return {"status": "queued", "created_at": now_iso(), **data, "fairKey": job_user(data)}
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def iso_after(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat().replace("+00:00", "Z")
+
+
+def expires_in(seconds: float = None) -> datetime:
+    """expires_at for a finished job: an aware datetime (a native Timestamp in Firestore, TTL-policy friendly)."""
+    return datetime.now(timezone.utc) + timedelta(seconds=JOB_TTL_SECONDS if seconds is None else seconds)
+
+
+def as_utc(v) -> Optional[datetime]:
+    """created_at / expires_at are ISO strings (Next.js enqueue, legacy rows) or Firestore timestamps (datetime subclass)."""
+    if isinstance(v, datetime):
+        return v if v.tzinfo else v.replace(tzinfo=timezone.utc)
+    if isinstance(v, str) and v:
+        try:
+            d = datetime.fromisoformat(v.replace("Z", "+00:00"))
+            return d if d.tzinfo else d.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+    return None
+
+
+def to_iso(v: datetime) -> str:
+    """Fixed-width UTC ISO string (microseconds always present) so string order == time order."""
+    return as_utc(v).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def claim_fields(hostname: str) -> dict:
+    """Fields written when a worker takes a job (status, owner, a fresh claim token and lease)."""
+    return {"status": "running", "claimed_by": hostname, "claim_token": uuid.uuid4().hex,
+            "started_at": now_iso(), "lease_expires_at": iso_after(LEASE_SECONDS)}
+
+
+def holds_claim(data: Optional[dict], hostname: str, token: Optional[str]) -> bool:
+    """True while the job is still running under this exact claim (not reaped / reclaimed since)."""
+    return bool(data) and data.get("status") == "running" and data.get("claimed_by") == hostname \
+        and data.get("claim_token") == token
+
+
+def reap_fields(data: dict, max_attempts: int = MAX_ATTEMPTS, backoff_seconds: int = RETRY_BACKOFF_SECONDS) -> dict:
+    """Update for a running job whose lease expired: back off then retry, or fail after max_attempts."""
+    attempts = int(data.get("attempts") or 0) + 1
+    reason = f"lease expired (claimed_by {data.get('claimed_by') or '?'})"
+    if attempts >= max_attempts:
+        return {"status": "failed", "attempts": attempts, "error": reason, "lease_expires_at": None,
+                "finished_at": now_iso(), "expires_at": expires_in()}
+    delay = min(RETRY_BACKOFF_MAX_SECONDS, backoff_seconds * (2 ** (attempts - 1)))
+    return {"status": "backoff", "attempts": attempts, "last_error": reason, "claimed_by": None,
+            "claim_token": None, "lease_expires_at": None, "not_before": iso_after(delay)}
+
+
+def backend_name(name: Optional[str] = None) -> str:
+    name = (name or os.environ.get("RPA_STORAGE_BACKEND") or DEFAULT_BACKEND).strip().lower()
+    if name not in BACKENDS:
+        raise ValueError(f"unknown RPA_STORAGE_BACKEND {name!r} (expected one of {', '.join(BACKENDS)})")
+    return name
+
+
+# ----------------- interfaces -----------------
+class JobQueue:
+    def next_queued(self, limit: int = 1) -> List[Job]:
+        """Oldest queued jobs (by created_at)."""
+        raise NotImplementedError
+
+    def claim(self, job_id: str, hostname: str) -> Optional[dict]:
+        """Atomically move job_id from queued to running; returns the claim_fields() written,
+        or None if someone else got it."""
+        raise NotImplementedError
+
+    def update(self, job_id: str, fields: dict):
+        raise NotImplementedError
+
+    def candidates(self, scan: int, per_user: Optional[int] = None) -> List[Job]:
+        """Queued jobs for the fair scheduler: priority DESC then created_at, at most per_user per user.
+
+        The default only looks at the oldest `scan` jobs; backends override it to also reach
+        prioritised jobs and users queued behind a large backlog.
+        """
+        return cap_per_user(self.next_queued(scan), per_user, scan)
+
+    def _pick(self, jobs: List[Job], k: int, shard: Optional[int], shards: int, picker) -> List[Job]:
+        jobs = prefer_shard(jobs, shard, shards)
+        return picker(jobs, k) if picker is not None else jobs
+
+    def claim_batch(self, hostname: str, k: int, scan: Optional[int] = None,
+                    shard: Optional[int] = None, shards: int = 1,
+                    picker=None, per_user: Optional[int] = None) -> List[Job]:
+        """Claim up to k of the oldest `scan` queued jobs, preferring jobs in `shard`.
+
+        With a picker (scheduler.make_picker), candidates() are used instead and the picker
+        decides which k jobs to take. Returns the claimed jobs (status already running, data
+        including claimed_by / claim_token) in the order they should run.
+        """
+        jobs = self.candidates(scan or k, per_user) if picker is not None else self.next_queued(scan or k)
+        out = []
+        for job_id, data in self._pick(jobs, k, shard, shards, picker):
+            if len(out) >= k:
+                break
+            fields = self.claim(job_id, hostname)
+            if fields:
+                out.append((job_id, {**data, **fields}))
+        return out
+
+    def release(self, job_id: str):
+        """Put a claimed-but-never-started job back in the queue."""
+        self.update(job_id, {"status": "queued", "claimed_by": None, "claim_token": None, "started_at": None,
+                             "lease_expires_at": None})
+
+    def heartbeat(self, claims: List[Claim], lease_expires_at: str) -> List[str]:
+        """Extend the lease of jobs this worker still holds; returns the job ids whose claim was
+        lost (reaped or reclaimed by someone else), which are left untouched."""
+        raise NotImplementedError
+
+    def finish(self, job_id: str, hostname: str, token: Optional[str], fields: dict) -> bool:
+        """Write the final status only if the job is still held under this claim; False = dropped."""
+        raise NotImplementedError
+
+    def reap_expired(self, now: str, max_attempts: int = MAX_ATTEMPTS,
+                     backoff_seconds: int = RETRY_BACKOFF_SECONDS, limit: int = 50) -> dict:
+        """Requeue (via `backoff`) or fail running jobs whose lease expired, and move
+        `backoff` jobs whose not_before has passed back to `queued`.
+
+        Returns {"backoff": n, "failed": n, "requeued": n}.
+        """
+        raise NotImplementedError
+
+    def enqueue(self, data: dict) -> str:
+        raise NotImplementedError
+
+    def cleanup_expired(self, cutoff: datetime, limit: int = 5000, page_size: int = GC_PAGE_SIZE) -> int:
+        """Delete up to `limit` done/failed jobs whose expires_at <= cutoff, page_size at a time.
+
+        Both native timestamps and legacy ISO-string expires_at are matched.
+        Returns the number deleted; a result equal to `limit` means more may be left.
+        """
+        raise NotImplementedError
+
+    def count(self, status: Optional[str] = None) -> Optional[int]:
+        """Number of jobs (optionally with `status`); None if the backend cannot count cheaply."""
+        return None
+
+    def watch_queued(self, on_new: Callable[[], None]) -> Optional[Callable[[], None]]:
+        """Call on_new() whenever a queued job appears; returns an unsubscribe function.
+
+        Returns None when the backend cannot push (callers keep polling).
+        """
+        return None
+
+
+class ConfigStore:
+    def get(self, doc_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def find(self, identifier: str) -> Optional[Tuple[str, dict]]:
+        """Resolve an auth uid / email / doc id to (doc_id, config)."""
+        data = self.get(identifier)
+        return (str(identifier), data) if data is not None else None
+
+    def put(self, doc_id: str, data: dict):
+        raise NotImplementedError
+
+
+class HistoryStore:
+    def append(self, uid: str, entries: List[dict]) -> int:
+        raise NotImplementedError
+
+    def count(self, uid: str) -> int:
+        raise NotImplementedError
+
+
+class Storage:
+    def __init__(self, name: str, jobs: JobQueue, configs: ConfigStore, history: HistoryStore):
+        self.name = name
+        self.jobs = jobs
+        self.configs = configs
+        self.history = history
+
+    def close(self):
+        for part in (self.jobs, self.configs, self.history):
+            close = getattr(part, "close", None)
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+
+# ----------------- firestore -----------------
+class FirestoreJobQueue(JobQueue):
+    def __init__(self, db, collection: str = JOB_COLLECTION):
+        self.db = db
+        self.coll = db.collection(collection)
+        self._warned = set()
+
+    def next_queued(self, limit: int = 1) -> List[Job]:
+        # use named args to avoid positional-arg deprecation warning from google-cloud-firestore
+        q = self.coll.where(field_path="status", op_string="==", value="queued").order_by("created_at").limit(limit)
+        return [(d.id, d.to_dict() or {}) for d in q.stream()]
+
+    def claim(self, job_id: str, hostname: str) -> Optional[dict]:
+        doc_ref = self.coll.document(job_id)
+
+        @firestore.transactional
+        def _claim(tx):
+            snap = doc_ref.get(transaction=tx)
+            data = snap.to_dict() or {}
+            if data.get("status") != "queued":
+                return None
+            fields = claim_fields(hostname)
+            tx.update(doc_ref, fields)
+            return fields
+
+        try:
+            return _claim(self.db.transaction())
+        except Exception:
+            return None
+
+    def _warn_once(self, what: str, err: Exception):
+        if what not in self._warned:
+            self._warned.add(what)
+            print(f"[{now_iso()}] Warning: {what} query failed (see firestore.indexes.json): {err}",
+                  file=sys.stderr, flush=True)
+
+    def candidates(self, scan: int, per_user: Optional[int] = None) -> List[Job]:
+        # 3 つのクエリを合わせる（インデックスは firestore.indexes.json）:
+        #   1) priority > 0 のジョブ（status, priority DESC, created_at）
+        #   2) 最も古い scan 件（status, created_at）
+        #   3) 2) の窓が少数のユーザーで埋まっている場合、そのユーザー以外の古い順（status, fairKey, created_at）
+        #      fairKey は enqueue 時に保存する job_user()（userDocId / userUid）。fairKey の無い旧ジョブは 3) には出ないが 2) で拾う
+        queued = self.coll.where(field_path="status", op_string="==", value="queued")
+        found = {}
+        try:
+            q = (queued.where(field_path="priority", op_string=">", value=0)
+                 .order_by("priority", direction=firestore.Query.DESCENDING).order_by("created_at").limit(scan))
+            for d in q.stream():
+                found.setdefault(d.id, d.to_dict() or {})
+        except Exception as e:
+            # インデックス未作成などでは優先度なし（FIFO の窓のみ）で続ける
+            self._warn_once("priority", e)
+        oldest = self.next_queued(scan)
+        for job_id, data in oldest:
+            found.setdefault(job_id, data)
+        if len(oldest) >= scan:
+            counts = Counter(job_user(data) for _, data in oldest if job_user(data))
+            heavy = [u for u, n in counts.most_common(NOT_IN_MAX) if n > (per_user or 1)]
+            if heavy:
+                try:
+                    q = (queued.where(field_path="fairKey", op_string="not-in", value=heavy)
+                         .order_by("fairKey").order_by("created_at").limit(scan))
+                    for d in q.stream():
+                        found.setdefault(d.id, d.to_dict() or {})
+                except Exception as e:
+                    self._warn_once("fair-share", e)
+        return cap_per_user(list(found.items()), per_user, scan)
+
+    def claim_batch(self, hostname: str, k: int, scan: Optional[int] = None,
+                    shard: Optional[int] = None, shards: int = 1,
+                    picker=None, per_user: Optional[int] = None) -> List[Job]:
+        # 候補はトランザクション外で読み、選んだ k 件だけをトランザクションで読み直して更新する
+        # （先頭 scan 件すべてを読むと他ワーカーの claim と衝突して再試行が増えるため）
+        jobs = self.candidates(scan or k, per_user) if picker is not None else self.next_queued(scan or k)
+        candidates = self._pick(jobs, k, shard, shards, picker)[:k]
+        if not candidates:
+            return []
+        refs = [self.coll.document(job_id) for job_id, _ in candidates]
+
+        @firestore.transactional
+        def _claim(tx):
+            fields = claim_fields(hostname)
+            got = []
+            for snap in tx.get_all(refs):
+                data = snap.to_dict() or {}
+                if not snap.exists or data.get("status") != "queued":
+                    continue
+                tx.update(snap.reference, fields)
+                got.append((snap.id, {**data, **fields}))
+            return got
+
+        try:
+            got = dict(_claim(self.db.transaction()))
+        except Exception:
+            return []
+        return [(job_id, got[job_id]) for job_id, _ in candidates if job_id in got]
+
+    def update(self, job_id: str, fields: dict):
+        self.coll.document(job_id).update(fields)
+
+    def heartbeat(self, claims: List[Claim], lease_expires_at: str) -> List[str]:
+        if not claims:
+            return []
+        refs = [self.coll.document(job_id) for job_id, _, _ in claims]
+        owner = {job_id: (hostname, token) for job_id, hostname, token in claims}
+
+        # 読んでから書くので、reaper が先に backoff にしたジョブのリースを延ばすことはない
+        @firestore.transactional
+        def _beat(tx):
+            lost = []
+            for snap in tx.get_all(refs):
+                if snap.exists and holds_claim(snap.to_dict(), *owner[snap.id]):
+                    tx.update(snap.reference, {"lease_expires_at": lease_expires_at})
+                else:
+                    lost.append(snap.id)
+            return lost
+
+        return _beat(self.db.transaction())
+
+    def finish(self, job_id: str, hostname: str, token: Optional[str], fields: dict) -> bool:
+        doc_ref = self.coll.document(job_id)
+
+        @firestore.transactional
+        def _finish(tx):
+            snap = doc_ref.get(transaction=tx)
+            if not snap.exists or not holds_claim(snap.to_dict(), hostname, token):
+                return False
+            tx.update(doc_ref, fields)
+            return True
+
+        return _finish(self.db.transaction())
+
+    def _reap_one(self, doc_ref, expect_status: str, due_field: str, now: str, fields_for) -> Optional[dict]:
+        # heartbeat / 完了書き込みと競合しないよう、期限切れをトランザクション内で再確認してから更新する
+        @firestore.transactional
+        def _tx(tx):
+            snap = doc_ref.get(transaction=tx)
+            data = snap.to_dict() or {}
+            due = data.get(due_field)
+            if not snap.exists or data.get("status") != expect_status or not due or str(due) > now:
+                return None
+            fields = fields_for(data)
+            tx.update(doc_ref, fields)
+            return fields
+
+        try:
+            return _tx(self.db.transaction())
+        except Exception:
+            return None
+
+    def reap_expired(self, now: str, max_attempts: int = MAX_ATTEMPTS,
+                     backoff_seconds: int = RETRY_BACKOFF_SECONDS, limit: int = 50) -> dict:
+        out = {"backoff": 0, "failed": 0, "requeued": 0}
+        expired = self.coll.where(field_path="status", op_string="==", value="running").where(
+            field_path="lease_expires_at", op_string="<=", value=now).limit(limit)
+        for d in expired.stream():
+            fields = self._reap_one(d.reference, "running", "lease_expires_at", now,
+                                    lambda data: reap_fields(data, max_attempts, backoff_seconds))
+            if fields:
+                out[fields["status"]] += 1
+        due = self.coll.where(field_path="status", op_string="==", value="backoff").where(
+            field_path="not_before", op_string="<=", value=now).limit(limit)
+        for d in due.stream():
+            if self._reap_one(d.reference, "backoff", "not_before", now,
+                              lambda data: {"status": "queued", "not_before": None}):
+                out["requeued"] += 1
+        return out
+
+    def watch_queued(self, on_new: Callable[[], None]) -> Optional[Callable[[], None]]:
+        q = self.coll.where(field_path="status", op_string="==", value="queued").order_by("created_at").limit(WATCH_LIMIT)
+
+        def _on_snapshot(docs, changes, read_time):
+            try:
+                if any(getattr(c.type, "name", "") == "ADDED" for c in changes):
+                    on_new()
+            except Exception:
+                pass
+
+        try:
+            watch = q.on_snapshot(_on_snapshot)
+        except Exception:
+            return None
+        return watch.unsubscribe
+
+    def enqueue(self, data: dict) -> str:
+        ref = self.coll.document()
+        ref.set(queued_doc(data))
+        return ref.id
+
+    def cleanup_expired(self, cutoff: datetime, limit: int = 5000, page_size: int = GC_PAGE_SIZE) -> int:
+        # 期限切れをカーソルでページングしながら BulkWriter に削除を積む（書き込みは並列・自動リトライ）。
+        # Timestamp と旧形式の ISO 文字列は Firestore では型ごとに並ぶので、範囲検索を型ごとに 2 回行う
+        cutoff = as_utc(cutoff)
+        failed = []
+
+        def _on_error(err, _bw) -> bool:
+            # True = 再試行。3 回失敗したら諦めて次の GC に回す
+            if err.attempts < 3:
+                return True
+            failed.append(err)
+            return False
+
+        bw = self.db.bulk_writer()
+        bw.on_write_error(_on_error)
+        deleted = 0
+        try:
+            for bound in (cutoff, cutoff.isoformat().replace("+00:00", "Z")):
+                last = None
+                while deleted < limit:
+                    n = min(page_size, limit - deleted)
+                    q = (self.coll.where(field_path="status", op_string="in", value=["done", "failed"])
+                         .where(field_path="expires_at", op_string="<=", value=bound)
+                         .order_by("expires_at").select(["expires_at"]).limit(n))
+                    if last is not None:
+                        q = q.start_after(last)
+                    docs = list(q.stream())
+                    for d in docs:
+                        bw.delete(d.reference)
+                    deleted += len(docs)
+                    if len(docs) < n:
+                        break
+                    last = docs[-1]
+        finally:
+            bw.close()
+        return deleted - len(failed)
+
+    def count(self, status: Optional[str] = None) -> Optional[int]:
+        # count() 集計（1,000 件のインデックスエントリごとに 1 読み取り）
+        q = self.coll if status is None else self.coll.where(field_path="status", op_string="==", value=status)
+        try:
+            return int(q.count().get()[0][0].value)
+        except Exception:
+            return None
+
+
+class FirestoreConfigStore(ConfigStore):
+    def __init__(self, db, get_config: Optional[Callable[[str], Optional[dict]]] = None,
+                 find_config: Optional[Callable[[str], Optional[Tuple[str, dict]]]] = None):
+        """get_config / find_config let the worker plug in its cache and alias resolution."""
+        self.db = db
+        self._get = get_config
+        self._find = find_config
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        if self._get:
+            return self._get(str(doc_id))
+        snap = self.db.collection("user_configs").document(str(doc_id)).get()
+        return (snap.to_dict() or {}) if snap.exists else None
+
+    def find(self, identifier: str):
+        if self._find:
+            return self._find(str(identifier))
+        return super().find(identifier)
+
+    def put(self, doc_id: str, data: dict):
+        self.db.collection("user_configs").document(str(doc_id)).set(data, merge=True)
+
+
+class FirestoreHistoryStore(HistoryStore):
+    def __init__(self, db, collection: str = HISTORY_COLLECTION):
+        self.db = db
+        self.collection = collection
+
+    def _entries(self, uid: str):
+        return self.db.collection(self.collection).document(str(uid)).collection("entries")
+
+    def append(self, uid: str, entries: List[dict]) -> int:
+        coll = self._entries(uid)
+        batch = self.db.batch()
+        for e in entries:
+            batch.set(coll.document(), e)
+        batch.commit()
+        return len(entries)
+
+    def count(self, uid: str) -> int:
+        res = self._entries(uid).count().get()
+        return int(res[0][0].value)
+
+
+# ----------------- memory -----------------
+class MemoryJobQueue(JobQueue):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._heap = []  # (created_at, seq, job_id) of jobs that were queued at push time
+        self._seq = 0
+        self._watchers = []
+
+    def _push(self, job_id: str, data: dict):
+        self._seq += 1
+        heapq.heappush(self._heap, (str(data.get("created_at") or ""), self._seq, job_id))
+        for cb in list(self._watchers):
+            try:
+                cb()
+            except Exception:
+                pass
+
+    def watch_queued(self, on_new: Callable[[], None]) -> Optional[Callable[[], None]]:
+        self._watchers.append(on_new)
+        return lambda: self._watchers.remove(on_new) if on_new in self._watchers else None
+
+    def next_queued(self, limit: int = 1) -> List[Job]:
+        out = []
+        with self._lock:
+            # 先頭から取り出し、queued でなくなったものは捨てる（再度 queued になれば push し直される）
+            keep = []
+            seen = set()
+            while self._heap and len(out) < limit:
+                item = heapq.heappop(self._heap)
+                data = self._jobs.get(item[2])
+                # queued に戻されたジョブは再 push されるので、古い方のエントリは捨てる
+                if item[2] in seen:
+                    continue
+                seen.add(item[2])
+                if data and data.get("status") == "queued":
+                    keep.append(item)
+                    out.append((item[2], dict(data)))
+            for item in keep:
+                heapq.heappush(self._heap, item)
+        return out
+
+    def claim(self, job_id: str, hostname: str) -> Optional[dict]:
+        with self._lock:
+            data = self._jobs.get(job_id)
+            if not data or data.get("status") != "queued":
+                return None
+            fields = claim_fields(hostname)
+            data.update(fields)
+            return fields
+
+    def candidates(self, scan: int, per_user: Optional[int] = None) -> List[Job]:
+        with self._lock:
+            queued = [(k, dict(d)) for k, d in self._jobs.items() if d.get("status") == "queued"]
+        queued.sort(key=lambda j: str(j[1].get("created_at") or ""))
+        return cap_per_user(queued, per_user, scan)
+
+    def claim_batch(self, hostname: str, k: int, scan: Optional[int] = None,
+                    shard: Optional[int] = None, shards: int = 1,
+                    picker=None, per_user: Optional[int] = None) -> List[Job]:
+        jobs = self.candidates(scan or k, per_user) if picker is not None else self.next_queued(scan or k)
+        candidates = self._pick(jobs, k, shard, shards, picker)
+        out = []
+        with self._lock:
+            fields = claim_fields(hostname)
+            for job_id, _ in candidates:
+                if len(out) >= k:
+                    break
+                data = self._jobs.get(job_id)
+                if not data or data.get("status") != "queued":
+                    continue
+                data.update(fields)
+                out.append((job_id, dict(data)))
+        return out
+
+    def update(self, job_id: str, fields: dict):
+        with self._lock:
+            data = self._jobs.setdefault(job_id, {})
+            was_queued = data.get("status") == "queued"
+            data.update(fields)
+            if data.get("status") == "queued" and not was_queued:
+                self._push(job_id, data)
+
+    def enqueue(self, data: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            doc = queued_doc(data)
+            self._jobs[job_id] = doc
+            self._push(job_id, doc)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            d = self._jobs.get(job_id)
+            return dict(d) if d else None
+
+    def heartbeat(self, claims: List[Claim], lease_expires_at: str) -> List[str]:
+        lost = []
+        with self._lock:
+            for job_id, hostname, token in claims:
+                data = self._jobs.get(job_id)
+                if holds_claim(data, hostname, token):
+                    data["lease_expires_at"] = lease_expires_at
+                else:
+                    lost.append(job_id)
+        return lost
+
+    def finish(self, job_id: str, hostname: str, token: Optional[str], fields: dict) -> bool:
+        with self._lock:
+            data = self._jobs.get(job_id)
+            if not holds_claim(data, hostname, token):
+                return False
+            data.update(fields)
+            return True
+
+    def reap_expired(self, now: str, max_attempts: int = MAX_ATTEMPTS,
+                     backoff_seconds: int = RETRY_BACKOFF_SECONDS, limit: int = 50) -> dict:
+        out = {"backoff": 0, "failed": 0, "requeued": 0}
+        for job_id, data in list(self._jobs.items()):
+            if data.get("status") == "running" and data.get("lease_expires_at") and str(data["lease_expires_at"]) <= now:
+                fields = reap_fields(data, max_attempts, backoff_seconds)
+                self.update(job_id, fields)
+                out[fields["status"]] += 1
+            elif data.get("status") == "backoff" and str(data.get("not_before") or "~") <= now:
+                self.update(job_id, {"status": "queued", "not_before": None})
+                out["requeued"] += 1
+        return out
+
+    def cleanup_expired(self, cutoff: datetime, limit: int = 5000, page_size: int = GC_PAGE_SIZE) -> int:
+        cutoff = as_utc(cutoff)
+        with self._lock:
+            victims = []
+            for k, d in self._jobs.items():
+                exp = as_utc(d.get("expires_at"))
+                if d.get("status") in ("done", "failed") and exp is not None and exp <= cutoff:
+                    victims.append(k)
+                    if len(victims) >= limit:
+                        break
+            for k in victims:
+                del self._jobs[k]
+        return len(victims)
+
+    def count(self, status: Optional[str] = None) -> Optional[int]:
+        with self._lock:
+            if status is None:
+                return len(self._jobs)
+            return sum(1 for d in self._jobs.values() if d.get("status") == status)
+
+
+class MemoryConfigStore(ConfigStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._configs = {}
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        with self._lock:
+            d = self._configs.get(str(doc_id))
+            return json.loads(json.dumps(d)) if d is not None else None
+
+    def find(self, identifier: str):
+        hit = super().find(identifier)
+        if hit:
+            return hit
+        with self._lock:
+            for doc_id, d in self._configs.items():
+                if any(d.get(f) == identifier for f in ("authUid", "uid", "email", "userUid")):
+                    return doc_id, json.loads(json.dumps(d))
+        return None
+
+    def put(self, doc_id: str, data: dict):
+        with self._lock:
+            self._configs.setdefault(str(doc_id), {}).update(json.loads(json.dumps(data, default=str)))
+
+
+class MemoryHistoryStore(HistoryStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def append(self, uid: str, entries: List[dict]) -> int:
+        with self._lock:
+            self._entries.setdefault(str(uid), []).extend(dict(e) for e in entries)
+        return len(entries)
+
+    def count(self, uid: str) -> int:
+        with self._lock:
+            return len(self._entries.get(str(uid), []))
+
+
+# ----------------- sqlite -----------------
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    expires_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_expiry ON jobs (status, expires_at);
+CREATE TABLE IF NOT EXISTS configs (
+    doc_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    created_at INTEGER,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_uid ON history (uid, created_at);
+"""
+
+
+def _json_default(v):
+    # datetime（expires_at など）は並び順が時刻順になる固定幅の ISO 文字列で保存する
+    return to_iso(v) if isinstance(v, datetime) else str(v)
+
+
+def _expiry_key(v) -> Optional[str]:
+    d = as_utc(v)
+    return to_iso(d) if d is not None else (str(v) if v is not None else None)
+
+
+class _SqliteDb:
+    def __init__(self, path: str):
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SQLITE_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+
+
+class SqliteJobQueue(JobQueue):
+    def __init__(self, sdb: _SqliteDb):
+        self.s = sdb
+
+    def _select_queued(self, limit: int) -> List[Job]:
+        rows = self.s.conn.execute(
+            "SELECT id, data FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT ?", (int(limit),)
+        ).fetchall()
+        return [(r["id"], json.loads(r["data"])) for r in rows]
+
+    def _select_candidates(self, scan: int, per_user: Optional[int]) -> List[Job]:
+        # ユーザーごとに先頭 per_user 件だけを残してから priority DESC, created_at で並べる
+        rows = self.s.conn.execute(
+            "SELECT id, data FROM ("
+            " SELECT id, data, created_at, prio, ROW_NUMBER() OVER ("
+            "  PARTITION BY COALESCE(NULLIF(json_extract(data, '$.fairKey'), ''), NULLIF(json_extract(data, '$.userDocId'), ''),"
+            "   json_extract(data, '$.userUid'), '')"
+            "  ORDER BY prio DESC, created_at) AS rn"
+            " FROM (SELECT id, data, created_at, COALESCE(CAST(json_extract(data, '$.priority') AS INTEGER), 0) AS prio"
+            "       FROM jobs WHERE status = 'queued'))"
+            " WHERE rn <= ? ORDER BY prio DESC, created_at LIMIT ?",
+            (int(per_user or scan), int(scan)),
+        ).fetchall()
+        return [(r["id"], json.loads(r["data"])) for r in rows]
+
+    def next_queued(self, limit: int = 1) -> List[Job]:
+        with self.s.lock:
+            return self._select_queued(limit)
+
+    def candidates(self, scan: int, per_user: Optional[int] = None) -> List[Job]:
+        with self.s.lock:
+            return self._select_candidates(scan, per_user)
+
+    def claim(self, job_id: str, hostname: str) -> Optional[dict]:
+        with self.s.lock:
+            f = claim_fields(hostname)
+            cur = self.s.conn.execute(
+                "UPDATE jobs SET status = 'running',"
+                " data = json_set(data, '$.status', 'running', '$.claimed_by', ?, '$.claim_token', ?,"
+                " '$.started_at', ?, '$.lease_expires_at', ?)"
+                " WHERE id = ? AND status = 'queued'",
+                (hostname, f["claim_token"], f["started_at"], f["lease_expires_at"], job_id),
+            )
+            return f if cur.rowcount == 1 else None
+
+    def claim_batch(self, hostname: str, k: int, scan: Optional[int] = None,
+                    shard: Optional[int] = None, shards: int = 1,
+                    picker=None, per_user: Optional[int] = None) -> List[Job]:
+        with self.s.lock:
+            # BEGIN IMMEDIATE で書き込みロックを先に取るので、読んだ queued 行はそのまま自分のもの
+            self.s.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if picker is not None:
+                    jobs = self._select_candidates(scan or k, per_user)
+                else:
+                    jobs = self._select_queued(scan or k)
+                picked = self._pick(jobs, k, shard, shards, picker)[:k]
+                fields = claim_fields(hostname)
+                for job_id, data in picked:
+                    data.update(fields)
+                    self._write(job_id, data)
+                self.s.conn.execute("COMMIT")
+            except Exception:
+                self.s.conn.execute("ROLLBACK")
+                raise
+        return picked
+
+    def update(self, job_id: str, fields: dict):
+        with self.s.lock:
+            self.s.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.s.conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                data = json.loads(row["data"]) if row else {}
+                data.update(json.loads(json.dumps(fields, default=_json_default)))
+                self._write(job_id, data)
+                self.s.conn.execute("COMMIT")
+            except Exception:
+                self.s.conn.execute("ROLLBACK")
+                raise
+
+    def _write(self, job_id: str, data: dict):
+        self.s.conn.execute(
+            "INSERT INTO jobs (id, status, created_at, expires_at, data) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (id) DO UPDATE SET status = excluded.status, created_at = excluded.created_at,"
+            " expires_at = excluded.expires_at, data = excluded.data",
+            (job_id, str(data.get("status") or ""), str(data.get("created_at") or ""),
+             _expiry_key(data.get("expires_at")),
+             json.dumps(data, ensure_ascii=False, default=_json_default)),
+        )
+
+    def enqueue(self, data: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self.s.lock:
+            self._write(job_id, queued_doc(data))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.s.lock:
+            row = self.s.conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def heartbeat(self, claims: List[Claim], lease_expires_at: str) -> List[str]:
+        lost = []
+        with self.s.lock:
+            for job_id, hostname, token in claims:
+                cur = self.s.conn.execute(
+                    "UPDATE jobs SET data = json_set(data, '$.lease_expires_at', ?) WHERE id = ? AND status = 'running'"
+                    " AND json_extract(data, '$.claimed_by') = ? AND json_extract(data, '$.claim_token') IS ?",
+                    (lease_expires_at, job_id, hostname, token),
+                )
+                if cur.rowcount != 1:
+                    lost.append(job_id)
+        return lost
+
+    def finish(self, job_id: str, hostname: str, token: Optional[str], fields: dict) -> bool:
+        with self.s.lock:
+            self.s.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.s.conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                data = json.loads(row["data"]) if row else None
+                if not holds_claim(data, hostname, token):
+                    self.s.conn.execute("ROLLBACK")
+                    return False
+                data.update(json.loads(json.dumps(fields, default=_json_default)))
+                self._write(job_id, data)
+                self.s.conn.execute("COMMIT")
+            except Exception:
+                self.s.conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def reap_expired(self, now: str, max_attempts: int = MAX_ATTEMPTS,
+                     backoff_seconds: int = RETRY_BACKOFF_SECONDS, limit: int = 50) -> dict:
+        out = {"backoff": 0, "failed": 0, "requeued": 0}
+        with self.s.lock:
+            self.s.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.s.conn.execute(
+                    "SELECT id, data FROM jobs WHERE status = 'running'"
+                    " AND json_extract(data, '$.lease_expires_at') <= ? LIMIT ?", (now, int(limit)),
+                ).fetchall()
+                for r in rows:
+                    data = json.loads(r["data"])
+                    fields = reap_fields(data, max_attempts, backoff_seconds)
+                    data.update(fields)
+                    self._write(r["id"], data)
+                    out[fields["status"]] += 1
+                rows = self.s.conn.execute(
+                    "SELECT id, data FROM jobs WHERE status = 'backoff'"
+                    " AND json_extract(data, '$.not_before') <= ? LIMIT ?", (now, int(limit)),
+                ).fetchall()
+                for r in rows:
+                    data = json.loads(r["data"])
+                    data.update({"status": "queued", "not_before": None})
+                    self._write(r["id"], data)
+                    out["requeued"] += 1
+                self.s.conn.execute("COMMIT")
+            except Exception:
+                self.s.conn.execute("ROLLBACK")
+                raise
+        return out
+
+    def cleanup_expired(self, cutoff: datetime, limit: int = 5000, page_size: int = GC_PAGE_SIZE) -> int:
+        cutoff_key = to_iso(cutoff)
+        deleted = 0
+        while deleted < limit:
+            n = min(page_size, limit - deleted)
+            # ページごとにロックを放し、claim / update を長く止めない
+            with self.s.lock:
+                cur = self.s.conn.execute(
+                    "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN ('done', 'failed')"
+                    " AND expires_at IS NOT NULL AND expires_at <= ? LIMIT ?)",
+                    (cutoff_key, n),
+                )
+            deleted += cur.rowcount
+            if cur.rowcount < n:
+                break
+        return deleted
+
+    def count(self, status: Optional[str] = None) -> Optional[int]:
+        with self.s.lock:
+            if status is None:
+                return self.s.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            return self.s.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+class SqliteConfigStore(ConfigStore):
+    def __init__(self, sdb: _SqliteDb):
+        self.s = sdb
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        with self.s.lock:
+            row = self.s.conn.execute("SELECT data FROM configs WHERE doc_id = ?", (str(doc_id),)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def find(self, identifier: str):
+        hit = super().find(identifier)
+        if hit:
+            return hit
+        with self.s.lock:
+            row = self.s.conn.execute(
+                "SELECT doc_id, data FROM configs WHERE json_extract(data, '$.authUid') = ?1"
+                " OR json_extract(data, '$.uid') = ?1 OR json_extract(data, '$.email') = ?1"
+                " OR json_extract(data, '$.userUid') = ?1 LIMIT 1",
+                (str(identifier),),
+            ).fetchone()
+        return (row["doc_id"], json.loads(row["data"])) if row else None
+
+    def put(self, doc_id: str, data: dict):
+        cur = self.get(doc_id) or {}
+        cur.update(data)
+        with self.s.lock:
+            self.s.conn.execute(
+                "INSERT INTO configs (doc_id, data) VALUES (?, ?) ON CONFLICT (doc_id) DO UPDATE SET data = excluded.data",
+                (str(doc_id), json.dumps(cur, ensure_ascii=False, default=str)),
+            )
+
+
+class SqliteHistoryStore(HistoryStore):
+    def __init__(self, sdb: _SqliteDb):
+        self.s = sdb
+
+    def append(self, uid: str, entries: List[dict]) -> int:
+        rows = [(str(uid), e.get("createdAt"), json.dumps(e, ensure_ascii=False, default=str)) for e in entries]
+        with self.s.lock:
+            self.s.conn.execute("BEGIN")
+            try:
+                self.s.conn.executemany("INSERT INTO history (uid, created_at, entry) VALUES (?, ?, ?)", rows)
+                self.s.conn.execute("COMMIT")
+            except Exception:
+                self.s.conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def count(self, uid: str) -> int:
+        with self.s.lock:
+            return self.s.conn.execute("SELECT COUNT(*) FROM history WHERE uid = ?", (str(uid),)).fetchone()[0]
+
+
+# ----------------- factory -----------------
+def open_storage(backend: Optional[str] = None, db=None, path: Optional[str] = None,
+                 get_config=None, find_config=None) -> Storage:
+    """Open the configured backend. The firestore backend needs db (a Firestore client)."""
+    name = backend_name(backend)
+    if name == "firestore":
+        if db is None:
+            raise RuntimeError("firestore backend requires a Firestore client")
+        return Storage(name, FirestoreJobQueue(db), FirestoreConfigStore(db, get_config, find_config),
+                       FirestoreHistoryStore(db))
+    if name == "sqlite":
+        sdb = _SqliteDb(path or os.environ.get("RPA_STORAGE_PATH") or DEFAULT_SQLITE_PATH)
+        st = Storage(name, SqliteJobQueue(sdb), SqliteConfigStore(sdb), SqliteHistoryStore(sdb))
+        st.close = sdb.close
+        return st
+    return Storage(name, MemoryJobQueue(), MemoryConfigStore(), MemoryHistoryStore())
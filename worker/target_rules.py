@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+target_rules（SMS 送信対象の判定ルール）のコンパイル済み評価器。
+
+- ルールは compile_rules() で一度だけ解析し、CompiledRules に固める
+- 1 件ずつの評価: CompiledRules.evaluate(info) -> True / False / None
+  （None = 対象ルール未設定、呼び出し側に判断を委ねる。旧 evaluate_sms_target と同じ三値）
+- 一括評価: 応募者を列（年齢 / 性別コード / 氏名の文字種ビットマスク / 電話番号桁数）に
+  変換し、evaluate_columns() でまとめて判定する。numpy があればベクトル化、無ければ純 Python
+- 履歴の再判定（ルール変更時）やバックログ処理向け
+
+Usage:
+    from target_rules import compiled_rules_for, extract_columns
+    rules = compiled_rules_for(cfg.get("target_rules"))
+    rules.evaluate(info)
+    target, decided = rules.evaluate_columns(**extract_columns(records))
+
+Benchmark / equivalence check:
+    python target_rules.py --bench [--records 20000]
+"""
+
+import re
+import copy
+from typing import Optional
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+# 氏名の文字種ビット
+SCRIPT_KANJI = 1
+SCRIPT_KATAKANA = 2
+SCRIPT_HIRAGANA = 4
+SCRIPT_ALPHABET = 8
+_NAME_CHECK_BITS = (
+    ("kanji", SCRIPT_KANJI),
+    ("katakana", SCRIPT_KATAKANA),
+    ("hiragana", SCRIPT_HIRAGANA),
+    ("alphabet", SCRIPT_ALPHABET),
+)
+
+# 性別コード
+GENDER_UNKNOWN = 0
+GENDER_MALE = 1
+GENDER_FEMALE = 2
+_GENDER_KEYS = ((GENDER_MALE, "male"), (GENDER_FEMALE, "female"))
+
+# 年齢不明を表す番兵（負の年齢も int() で解析できるため -1 は使わない）
+AGE_UNKNOWN = -(2 ** 31)
+
+_PAREN_RE = re.compile(r"[（(][^）)]*[）)]")
+_NON_DIGIT_RE = re.compile(r"[^0-9]")
+
+
+def _char_script(ch: str) -> int:
+    o = ord(ch)
+    if 0x4E00 <= o <= 0x9FFF:
+        return SCRIPT_KANJI
+    if 0x30A0 <= o <= 0x30FF:
+        return SCRIPT_KATAKANA
+    if 0x3040 <= o <= 0x309F:
+        return SCRIPT_HIRAGANA
+    if ("A" <= ch <= "Z") or ("a" <= ch <= "z"):
+        return SCRIPT_ALPHABET
+    return 0
+
+
+def name_script_mask(raw_name) -> int:
+    """Bitmask of the scripts present in the name with any (ふりがな) part removed."""
+    name = _PAREN_RE.sub("", str(raw_name or "")).strip()
+    mask = 0
+    for ch in name:
+        mask |= _char_script(ch)
+        if mask == 15:
+            break
+    return mask
+
+
+def parse_gender(raw) -> int:
+    raw = str(raw or "")
+    # 旧実装と同じ判定順（"male" を先に見る）
+    if "男" in raw or "male" in raw.lower():
+        return GENDER_MALE
+    if "女" in raw or "female" in raw.lower():
+        return GENDER_FEMALE
+    return GENDER_UNKNOWN
+
+
+def parse_age(info: dict) -> int:
+    a = info.get("__標準_年齢__") or info.get("age") or info.get("年齢")
+    try:
+        return int(str(a)) if a else AGE_UNKNOWN
+    except Exception:
+        return AGE_UNKNOWN
+
+
+def phone_digit_count(info: dict) -> int:
+    phone = info.get("__標準_電話番号__") or info.get("電話番号") or info.get("phone") or ""
+    return len(_NON_DIGIT_RE.sub("", str(phone)))
+
+
+def record_features(info: dict):
+    """(age, gender_code, name_mask, phone_len) for one applicant record."""
+    return (
+        parse_age(info),
+        parse_gender(info.get("性別") or info.get("gender") or ""),
+        name_script_mask(info.get("姓名（ふりがな）") or info.get("name") or ""),
+        phone_digit_count(info),
+    )
+
+
+def extract_columns(records) -> dict:
+    """Convert applicant dicts into the columnar arrays evaluate_columns() expects."""
+    ages, genders, masks, phones = [], [], [], []
+    for info in records:
+        a, g, m, p = record_features(info or {})
+        ages.append(a)
+        genders.append(g)
+        masks.append(m)
+        phones.append(p)
+    if np is not None:
+        return {
+            "age": np.asarray(ages, dtype=np.int64),
+            "gender": np.asarray(genders, dtype=np.int8),
+            "name_mask": np.asarray(masks, dtype=np.int8),
+            "phone_len": np.asarray(phones, dtype=np.int32),
+        }
+    return {"age": ages, "gender": genders, "name_mask": masks, "phone_len": phones}
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float))
+
+
+class _GenderRule:
+    """Compiled target_rules.age.{male|female}."""
+    __slots__ = ("present", "error", "excluded", "lo", "hi", "has_bounds")
+
+    def __init__(self):
+        self.present = False      # ルールが truthy（“設定済み” 判定に使われる）
+        self.error = False        # 旧実装で例外になる形（-> False）
+        self.excluded = False     # include=False / skip=True
+        self.lo = None
+        self.hi = None
+        self.has_bounds = False
+
+
+class CompiledRules:
+    def __init__(self, target_rules):
+        self.default_mode = not target_rules
+        self.all_false = False
+        self.name_bits = 0
+        self.name_error = False
+        self.gender = {GENDER_UNKNOWN: _GenderRule(), GENDER_MALE: _GenderRule(), GENDER_FEMALE: _GenderRule()}
+        if self.default_mode:
+            return
+        if not isinstance(target_rules, dict):
+            self.all_false = True
+            return
+
+        name_checks = target_rules.get("nameChecks", {})
+        if isinstance(name_checks, dict):
+            for key, bit in _NAME_CHECK_BITS:
+                if name_checks.get(key):
+                    self.name_bits |= bit
+        else:
+            self.all_false = True
+            return
+
+        age_rules = target_rules.get("age", {})
+        for code, key in _GENDER_KEYS:
+            gr = self.gender[code]
+            if not isinstance(age_rules, dict):
+                gr.error = True
+                continue
+            rule = age_rules.get(key)
+            if not rule:
+                continue
+            gr.present = True
+            if not isinstance(rule, dict):
+                gr.error = True
+                continue
+            lo, hi = rule.get("min"), rule.get("max")
+            if isinstance(rule.get("include"), bool):
+                gr.excluded = rule["include"] is False
+            elif isinstance(rule.get("skip"), bool):
+                gr.excluded = rule["skip"] is True
+            if lo is not None or hi is not None:
+                if (lo is not None and not _is_number(lo)) or (hi is not None and not _is_number(hi)):
+                    gr.error = True
+                    continue
+                gr.has_bounds = True
+                gr.lo, gr.hi = lo, hi
+
+    # ----------------- per record -----------------
+    def decide(self, age: int, gender: int, name_mask: int, phone_len: int) -> Optional[bool]:
+        if self.default_mode:
+            return phone_len >= 7 and (age == AGE_UNKNOWN or age >= 18)
+        if self.all_false:
+            return False
+        gr = self.gender.get(gender) or self.gender[GENDER_UNKNOWN]
+        if gr.error:
+            return False
+        if not (self.name_bits or gr.present):
+            return None
+        if not (name_mask & self.name_bits):
+            return False
+        if gr.excluded:
+            return False
+        if gr.has_bounds:
+            if age == AGE_UNKNOWN:
+                return False
+            if gr.lo is not None and age < gr.lo:
+                return False
+            if gr.hi is not None and age > gr.hi:
+                return False
+        return True
+
+    def evaluate(self, info: dict) -> Optional[bool]:
+        return self.decide(*record_features(info or {}))
+
+    def evaluate_records(self, records) -> list:
+        """Tri-state results (True / False / None) for a list of applicant dicts."""
+        target, decided = self.evaluate_columns(**extract_columns(records))
+        return [bool(t) if d else None for t, d in zip(target, decided)]
+
+    # ----------------- batch -----------------
+    def evaluate_columns(self, age, gender, name_mask, phone_len):
+        """Return (target, decided) boolean masks; decided=False where evaluate() would be None."""
+        if np is not None:
+            return self._evaluate_numpy(np.asarray(age), np.asarray(gender), np.asarray(name_mask), np.asarray(phone_len))
+        decided, target = [], []
+        for row in zip(age, gender, name_mask, phone_len):
+            r = self.decide(*row)
+            decided.append(r is not None)
+            target.append(bool(r))
+        return target, decided
+
+    def _evaluate_numpy(self, age, gender, name_mask, phone_len):
+        n = len(age)
+        if self.default_mode:
+            target = (phone_len >= 7) & ((age == AGE_UNKNOWN) | (age >= 18))
+            return target, np.ones(n, dtype=bool)
+        if self.all_false:
+            return np.zeros(n, dtype=bool), np.ones(n, dtype=bool)
+
+        # 性別コード 0/1/2 -> ルール表（長さ 3）を引く
+        rules = [self.gender[c] for c in (GENDER_UNKNOWN, GENDER_MALE, GENDER_FEMALE)]
+        g = np.clip(gender.astype(np.int64), 0, 2)
+        present = np.array([r.present for r in rules])[g]
+        error = np.array([r.error for r in rules])[g]
+        excluded = np.array([r.excluded for r in rules])[g]
+        has_bounds = np.array([r.has_bounds for r in rules])[g]
+        lo = np.array([-np.inf if r.lo is None else float(r.lo) for r in rules])[g]
+        hi = np.array([np.inf if r.hi is None else float(r.hi) for r in rules])[g]
+
+        unknown = age == AGE_UNKNOWN
+        out_of_range = has_bounds & (unknown | (age < lo) | (age > hi))
+        name_pass = (name_mask.astype(np.int64) & self.name_bits) != 0
+        decided = error | present | bool(self.name_bits)
+        target = ~error & name_pass & ~excluded & ~out_of_range
+        return target & decided, decided
+
+
+_LAST = {"rules": None, "compiled": None}
+
+
+def compiled_rules_for(target_rules) -> CompiledRules:
+    """Compile target_rules, reusing the previous result while the rules are unchanged."""
+    last = _LAST["compiled"]
+    if last is not None and (target_rules is _LAST["rules"] or target_rules == _LAST["rules"]):
+        return last
+    compiled = CompiledRules(target_rules)
+    try:
+        _LAST["rules"] = copy.deepcopy(target_rules)
+    except Exception:
+        _LAST["rules"] = target_rules
+    _LAST["compiled"] = compiled
+    return compiled
+
+
+# ----------------- benchmark / equivalence -----------------
+def _reference_evaluate(target_rules, info):
+    """旧 evaluate_sms_target のロジックをそのまま残した比較用の実装。"""
+    try:
+        if not target_rules:
+            phone = (info.get("__標準_電話番号__") or info.get("電話番号") or info.get("phone") or "")
+            pd = re.sub(r"[^0-9]", "", str(phone))
+            if not pd or len(pd) < 7:
+                return False
+            a = (info.get("__標準_年齢__") or info.get("age") or info.get("年齢"))
+            try:
+                age = int(str(a)) if a else None
+            except Exception:
+                age = None
+            return age is None or age >= 18
+
+        raw_name = info.get("姓名（ふりがな）") or info.get("name") or ""
+        name = re.sub(r"[（(][^）)]*[）)]", "", raw_name).strip()
+        name_checks = target_rules.get("nameChecks", {})
+        name_configured = any([name_checks.get("kanji"), name_checks.get("katakana"),
+                               name_checks.get("hiragana"), name_checks.get("alphabet")])
+        name_pass = False
+        if name_configured:
+            if name_checks.get("kanji") and re.search(r'[\u4e00-\u9fff]', name):
+                name_pass = True
+            if name_checks.get("katakana") and re.search(r'[\u30a0-\u30ff]', name):
+                name_pass = True
+            if name_checks.get("hiragana") and re.search(r'[\u3040-\u309f]', name):
+                name_pass = True
+            if name_checks.get("alphabet") and re.search(r'[A-Za-z]', name):
+                name_pass = True
+
+        gender_raw = info.get("性別") or info.get("gender") or ""
+        gender = None
+        if "男" in gender_raw or "male" in gender_raw.lower():
+            gender = "male"
+        elif "女" in gender_raw or "female" in gender_raw.lower():
+            gender = "female"
+
+        a = (info.get("__標準_年齢__") or info.get("age") or info.get("年齢"))
+        try:
+            age = int(str(a)) if a else None
+        except Exception:
+            age = None
+
+        gender_pass = True
+        age_rules = target_rules.get("age", {})
+        if gender and age_rules.get(gender):
+            gender_rule = age_rules[gender]
+            gender_configured = bool(
+                isinstance(gender_rule.get("include"), bool) or isinstance(gender_rule.get("skip"), bool) or
+                gender_rule.get("min") is not None or gender_rule.get("max") is not None
+            )
+            if gender_configured:
+                include_flag = None
+                if isinstance(gender_rule.get("include"), bool):
+                    include_flag = gender_rule["include"]
+                elif isinstance(gender_rule.get("skip"), bool):
+                    include_flag = not gender_rule["skip"]
+                if include_flag is False:
+                    gender_pass = False
+                min_age = gender_rule.get("min")
+                max_age = gender_rule.get("max")
+                if min_age is not None or max_age is not None:
+                    if age is None:
+                        gender_pass = False
+                    elif min_age is not None and age < min_age:
+                        gender_pass = False
+                    elif max_age is not None and age > max_age:
+                        gender_pass = False
+
+        any_rule_configured = name_configured or (gender and age_rules.get(gender))
+        if not any_rule_configured:
+            return None
+        if not name_pass:
+            return False
+        if not gender_pass:
+            return False
+        return True
+    except Exception:
+        return False
+
+
+def _random_records(rng, n):
+    names = ["山田 太郎（やまだ たろう）", "ヤマダ タロウ", "やまだ", "John Smith", "李 明 (リ ミン)",
+             "田中Ａｌｉｃｅ", "", "(テスト)", "さとう花子", "Ｘ"]
+    genders = ["男性", "女性", "male", "Female", "", "その他"]
+    ages = ["25", "17", "", "４０", " 33 ", "abc", "-3", "18", "65", None, 0]
+    phones = ["090-1234-5678", "0312345", "", "+81 90 1111 2222", "12345", None]
+    for _ in range(n):
+        yield {
+            "姓名（ふりがな）": rng.choice(names),
+            "性別": rng.choice(genders),
+            "__標準_年齢__": rng.choice(ages),
+            "__標準_電話番号__": rng.choice(phones),
+        }
+
+
+def _random_rules(rng):
+    if rng.random() < 0.1:
+        return rng.choice([{}, None])
+
+    def bound():
+        return rng.choice([None, None, 18, 20, 30, 45.5, 60])
+
+    def gender_rule():
+        r = {}
+        if rng.random() < 0.5:
+            r[rng.choice(["include", "skip"])] = rng.random() < 0.5
+        r["min"], r["max"] = bound(), bound()
+        return rng.choice([r, r, {}, None])
+
+    return {
+        "nameChecks": {k: rng.random() < 0.4 for k, _ in _NAME_CHECK_BITS},
+        "age": {"male": gender_rule(), "female": gender_rule()},
+    }
+
+
+def _bench(n_records: int, n_rulesets: int = 50):
+    import random
+    import time
+
+    rng = random.Random(1234)
+    records = list(_random_records(rng, n_records))
+    rulesets = [_random_rules(rng) for _ in range(n_rulesets)]
+
+    # equivalence: compiled per-record and batch must match the reference for every rule set
+    sample = records[:2000]
+    for rules in rulesets:
+        compiled = CompiledRules(rules)
+        expected = [_reference_evaluate(rules, r) for r in sample]
+        assert [compiled.evaluate(r) for r in sample] == expected, rules
+        assert compiled.evaluate_records(sample) == expected, rules
+    print(f"equivalence: {n_rulesets} rule sets x {len(sample)} records match the reference")
+
+    rules = {"nameChecks": {"kanji": True, "katakana": True}, "age": {"male": {"min": 20, "max": 45}, "female": {"include": True, "min": 18}}}
+    compiled = CompiledRules(rules)
+
+    t0 = time.perf_counter()
+    for r in records:
+        _reference_evaluate(rules, r)
+    t_ref = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for r in records:
+        compiled.evaluate(r)
+    t_one = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    cols = extract_columns(records)
+    t_extract = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    compiled.evaluate_columns(**cols)
+    t_cols = time.perf_counter() - t0
+
+    backend = "numpy" if np is not None else "pure python"
+    for label, dt in (("reference per-record", t_ref), ("compiled per-record", t_one),
+                      ("extract columns", t_extract), (f"batch ({backend})", t_cols)):
+        print(f"{label:22s}: {n_records} records in {dt * 1000:.1f} ms ({dt / n_records * 1e6:.2f} us/record)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="target_rules evaluator benchmark / equivalence check")
+    p.add_argument("--bench", action="store_true", help="Compare against the per-record reference and time it")
+    p.add_argument("--records", type=int, default=20000)
+    args = p.parse_args()
+    if args.bench:
+        _bench(args.records)
+    else:
+        p.print_help()
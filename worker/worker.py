@@ -10,12 +10,30 @@ Usage (Windows):
 - Run: python worker.py  （常驻轮询）
 - 或:  python worker.py --once             （处理一条就退出）
 - 或:  python worker.py --max-runtime 60   （最多运行60分钟后退出）
+- 或:  python worker.py --concurrency 8    （最多并行 8 个任务）
+- 或:  python worker.py --runner pool      （在常驻预热的子进程中执行，省去每个任务的启动时间）
 
 Env:
-- RPA_WORKER_POLL_SECONDS (default 5)
+- RPA_WORKER_POLL_SECONDS (default 5; 队列监听不可用时的轮询间隔)
+- RPA_WORKER_SAFETY_POLL_SECONDS (default 60; 队列监听生效时的兜底轮询间隔)
+- RPA_WORKER_LISTEN (default 1; 0 = 不使用 on_snapshot，仅轮询)
 - RPA_JOB_COLLECTION (default rpa_jobs)
 - RPA_HISTORY_COLLECTION (default rpa_history)
 - RPA_SCRIPT_PATH (optional absolute path)
+- RPA_STORAGE_BACKEND (firestore | sqlite | memory; default firestore, see storage.py)
+- RPA_WORKER_CONCURRENCY (default 1; same as --concurrency)
+- RPA_JOB_TIMEOUT_SECONDS (default 600; same as --job-timeout)
+- RPA_CLAIM_BATCH (default 0 = 与并行数相同; 一次事务领取的任务数, same as --claim-batch)
+- RPA_LEASE_SECONDS / RPA_MAX_ATTEMPTS / RPA_RETRY_BACKOFF_SECONDS (任务租约与重试, see storage.py)
+- RPA_REAPER_SECONDS (default 30; 回收过期租约的间隔)
+- RPA_GC_SECONDS (default 300; 后台清理过期任务的间隔, 0 = 仅依赖 Firestore TTL; RPA_JOB_TTL_SECONDS see storage.py)
+- RPA_STATE_DIR (default worker/rpa_state; 并行时每个槽位 × 用户的 Chrome 配置目录放在 chrome_profiles/ 下)
+- RPA_SMS_FLUSH_SECONDS (default 60; 检查本机 SMS 台账中到期的保留 SMS 并启动仅发送的子进程, 0 = 只在任务中发送)
+- RPA_CLAIM_SHARDS (default 1; >1 时各 worker 优先领取自己分片的任务, same as --claim-shards)
+- RPA_SCHEDULER (fair | fifo; default fair, same as --scheduler; 按用户公平轮转 + priority, see scheduler.py)
+- RPA_WORKER_RUNNER (subprocess | pool; default subprocess, same as --runner; see rpa_pool.py)
+- RPA_EVENTS (default 1; 子进程经专用管道逐条发送 NDJSON 事件, 0 = 结束时解析 stdout)
+- RPA_PROGRESS_SECONDS (default 2; rpa_jobs.progress 的最小更新间隔)
 - RPA_SCRIPT_URL  (optional,当本地没脚本时自动下载)
 - SERVICE_ACCOUNT_PATH (作为 GOOGLE_APPLICATION_CREDENTIALS 的备选)
 
@@ -32,6 +50,8 @@ os.environ.setdefault("GRPC_VERBOSITY", "ERROR")
 os.environ.setdefault("GRPC_TRACE", "")
 os.environ.setdefault("GLOG_minloglevel", "2")
 import json
+import base64
+import hashlib
 import socket
 import tempfile
 import subprocess
@@ -39,27 +59,22 @@ import re
 from datetime import datetime, timedelta, timezone
 import getpass
 import urllib.request
+import urllib.parse
 import shutil
 import signal
+import threading
 from typing import Optional
+from collections import OrderedDict, deque
 import traceback
 
 # ----------------- Third-party -----------------
-try:
-    from google.cloud import firestore
-except Exception as e:
-    def _eprint(*a, **k): print(*a, **k, file=sys.stderr)
-    _eprint("依存関係が不足しています: google-cloud-firestore をインストールしてください（pip install -r requirements.txt）")
-    # 仅在交互式终端暂停，避免服务模式“关不掉”
-    if sys.stdin.isatty():
-        try: input("続行するには Enter を押してください...")
-        except EOFError: pass
-    raise
+import storage
+import scheduler
 
-try:
-    from google.oauth2 import service_account as oauth_service_account
-except Exception:
-    oauth_service_account = None
+import firestore_provider
+from firestore_provider import resolve_service_account_path
+from config_cache import ConfigCache
+from rpa_pool import chrome_profile_dir
 
 try:
     import firebase_admin
@@ -72,14 +87,46 @@ try:
     from cryptography.fernet import Fernet
 except Exception:
     Fernet = None
+
+try:
+    from google.protobuf.timestamp_pb2 import Timestamp as _PbTimestamp
+except Exception:
+    _PbTimestamp = None
 # ------------------------------------------------
 
 POLL_INTERVAL = int(os.environ.get("RPA_WORKER_POLL_SECONDS", "5"))
+# 队列监听（on_snapshot）生效时的兜底轮询间隔
+SAFETY_POLL_INTERVAL = int(os.environ.get("RPA_WORKER_SAFETY_POLL_SECONDS", "60"))
 JOB_COLLECTION = os.environ.get("RPA_JOB_COLLECTION", "rpa_jobs")
 HISTORY_COLLECTION = os.environ.get("RPA_HISTORY_COLLECTION", "rpa_history")
+# uid_aliases/{alias} -> {userDocId}: authUid / uid / email 到 user_configs 文档 ID 的索引
+ALIAS_COLLECTION = os.environ.get("RPA_ALIAS_COLLECTION", "uid_aliases")
+ALIAS_LRU_SIZE = 1024
+ALIAS_FIELDS = ("authUid", "uid", "email", "userUid")  # find_user_config 的字段查询顺序
 RPA_SCRIPT = os.environ.get("RPA_SCRIPT_PATH", None)  # optional override
+# 一次事务领取的任务数（0 = 与并行数相同）与分片数（按 worker id 哈希分片，1 = 不分片）
+CLAIM_BATCH = int(os.environ.get("RPA_CLAIM_BATCH", "0"))
+CLAIM_SHARDS = int(os.environ.get("RPA_CLAIM_SHARDS", "1"))
+CLAIM_SCAN_MAX = 100
+# 子进程事件通道（NDJSON 管道；0 = 旧方式，结束时解析 stdout）与任务进度的最小写入间隔
+EVENTS_ENABLED = os.environ.get("RPA_EVENTS", "1") != "0"
+PROGRESS_MIN_INTERVAL = float(os.environ.get("RPA_PROGRESS_SECONDS", "2"))
+# RPA 执行方式：subprocess（每个任务一个新进程）| pool（常驻预热子进程）
+RUNNER_KIND = os.environ.get("RPA_WORKER_RUNNER", "subprocess")
+# 过期租约回收（reaper）的执行间隔（秒）
+REAPER_INTERVAL = int(os.environ.get("RPA_REAPER_SECONDS", "30"))
+# 过期任务清理（GC）的执行间隔（秒，0 = 不清理，仅依赖 Firestore TTL 策略）与每轮最多删除数
+GC_INTERVAL = int(os.environ.get("RPA_GC_SECONDS", "300"))
+GC_MAX_PER_PASS = 5000
+# 保留 SMS（quiet hours / 592）的定期发送检查间隔（秒，0 = 不检查，只在该用户的任务中发送）与子进程超时
+SMS_FLUSH_INTERVAL = int(os.environ.get("RPA_SMS_FLUSH_SECONDS", "60"))
+SMS_FLUSH_TIMEOUT_SECONDS = 300
+# 非监控任务的子进程超时（秒）
+JOB_TIMEOUT_SECONDS = int(os.environ.get("RPA_JOB_TIMEOUT_SECONDS", str(60 * 10)))
 
 STOP = False  # 信号控制
+# 空闲等待的唤醒事件：队列监听（新任务）与停止信号都会 set
+WAKE = threading.Event()
 START_TIME = datetime.now(timezone.utc)
 
 def now_iso() -> str:
@@ -96,8 +143,14 @@ def pause_if_tty(msg="続行するには Enter を押してください..."):
 
 def handle_signal(signum, frame):
     global STOP
+    if STOP:
+        # 第二次信号：不再等待运行中的任务
+        print(f"[{now_iso()}] Got signal {signum} again, terminating running jobs...", flush=True)
+        terminate_children()
+        return
     STOP = True
-    print(f"[{now_iso()}] Got signal {signum}, preparing to stop...", flush=True)
+    WAKE.set()
+    print(f"[{now_iso()}] Got signal {signum}, preparing to stop (running jobs will finish)...", flush=True)
 
 # 注册信号（Windows 也支持 SIGBREAK）
 for s in (getattr(signal, "SIGINT", None),
@@ -118,17 +171,28 @@ def parse_args():
     p.add_argument("--max-runtime", type=int, default=0, help="Max runtime in minutes (0 = unlimited)")
     p.add_argument("--log-stdout", action="store_true", help="Print child stdout even if it is JSON")
     p.add_argument("--script", dest="script", help="Override RPA script path")
+    p.add_argument("--concurrency", type=int, default=int(os.environ.get("RPA_WORKER_CONCURRENCY", "1")),
+                   help="Run up to N jobs in parallel (default 1)")
+    p.add_argument("--job-timeout", type=int, default=None,
+                   help="Per-job timeout in seconds for non-monitor jobs (default RPA_JOB_TIMEOUT_SECONDS or 600)")
+    p.add_argument("--claim-batch", type=int, default=None,
+                   help="Jobs claimed per transaction into a local buffer (default RPA_CLAIM_BATCH or --concurrency)")
+    p.add_argument("--claim-shards", type=int, default=None,
+                   help="Number of shards; each worker prefers jobs hashed to its own shard (default 1)")
+    p.add_argument("--scheduler", choices=list(scheduler.POLICIES), default=None,
+                   help="fair: round-robin across users within priority tiers (default); fifo: oldest first")
+    p.add_argument("--runner", choices=["subprocess", "pool"], default=None,
+                   help="subprocess: new Python per job (default); pool: pre-warmed long-lived children (rpa_pool.py)")
+    p.add_argument("--bench", type=int, default=0, metavar="N",
+                   help="Benchmark N synthetic jobs through the queue with a stub runner, then exit")
+    p.add_argument("--bench-backends", default="memory,sqlite",
+                   help="Comma-separated backends for --bench (firestore uses FIRESTORE_EMULATOR_HOST if set)")
+    p.add_argument("--bench-sanitize", type=int, default=0, metavar="N",
+                   help="Benchmark _sanitize_for_firestore on a job result with N applicant entries, then exit")
+    p.add_argument("--bench-workers", type=int, default=1,
+                   help="Competing claim loops for --bench (use with --claim-batch / --claim-shards)")
     return p.parse_args()
 
-def resolve_service_account_path(cli_path: Optional[str]) -> Optional[str]:
-    if cli_path and os.path.exists(cli_path):
-        return cli_path
-    for key in ("GOOGLE_APPLICATION_CREDENTIALS", "SERVICE_ACCOUNT_PATH"):
-        v = os.environ.get(key)
-        if v and os.path.exists(v):
-            return v
-    return None
-
 def find_rpa_script(cli_override: Optional[str]) -> str:
     # 只引用 worker 目录下的 rpa_gmail_indeed_test.py
     here = os.path.dirname(os.path.abspath(__file__))
@@ -138,168 +202,275 @@ def find_rpa_script(cli_override: Optional[str]) -> str:
     raise FileNotFoundError("worker/rpa_gmail_indeed_test.py not found; 请确保脚本在 worker 目录下")
 
 def firestore_client(sa_path: Optional[str]):
-    if oauth_service_account and sa_path:
+    # 进程内共享（与 rpa_gmail_indeed_test.py 使用同一个 provider）
+    # google-cloud-firestore 只在真正需要 Firestore 时检查：离线后端 / --bench memory,sqlite 不依赖它
+    if firestore_provider.firestore is None:
+        raise RuntimeError("依存関係が不足しています: google-cloud-firestore をインストールしてください（pip install -r requirements.txt）")
+    return firestore_provider.get_client(sa_path)
+
+def open_worker_storage(sa_path: Optional[str] = None, backend: Optional[str] = None) -> storage.Storage:
+    """Open the job/config/history backend selected by RPA_STORAGE_BACKEND (default firestore)."""
+    name = storage.backend_name(backend)
+    if name != "firestore":
+        return storage.open_storage(name)
+    db = firestore_client(sa_path)
+    return storage.open_storage(
+        name, db=db,
+        get_config=lambda doc_id: get_config_cache(db).get(doc_id),
+        find_config=lambda ident: find_user_config(db, ident),
+    )
+
+# 运行中的子进程（第二次 SIGTERM / SIGINT 时统一终止）
+_CHILDREN = set()
+_CHILDREN_LOCK = threading.Lock()
+# --runner pool 时的常驻子进程池（rpa_pool.WarmRunner）
+_WARM_RUNNER = None
+
+
+def _signal_child_group(proc, sig) -> bool:
+    """Signal the child's whole process group (chromedriver / Chrome included).
+
+    The child is started as a group leader by _run_child, so pgid == pid.
+    On Windows the tree is killed with taskkill /T (sig is ignored there).
+    """
+    if os.name == "nt":
         try:
-            creds = oauth_service_account.Credentials.from_service_account_file(sa_path)
-            return firestore.Client(credentials=creds, project=creds.project_id)
-        except Exception as e:
-            eprint("Failed to init Firestore with SA credentials; fallback to default:", e)
-    return firestore.Client()
-
-def claim_job_transactional(db, doc_ref, hostname):
-    @firestore.transactional
-    def _claim(tx):
-        snap = doc_ref.get(transaction=tx)
-        data = snap.to_dict() or {}
-        if data.get("status") != "queued":
+            r = subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+            return r.returncode == 0
+        except Exception:
             return False
-        tx.update(doc_ref, {
-            "status": "running",
-            "claimed_by": hostname,
-            "started_at": now_iso(),
-        })
+    if not hasattr(os, "killpg"):
+        return False
+    try:
+        os.killpg(proc.pid, sig)
         return True
+    except OSError:
+        return False
 
-    tx = db.transaction()
+
+def _run_child(cmd, popen_kwargs: dict, capture: bool, timeout: Optional[int], input_text: Optional[str] = None):
+    """Run cmd to completion; returns (returncode, stdout, stderr, timed_out).
+
+    input_text (if given) is written to the child's stdin pipe, which is then closed.
+    The child is registered in _CHILDREN while it runs; on timeout its whole process
+    group is killed so Chrome does not keep the slot's profile locked.
+    """
+    kwargs = dict(popen_kwargs)
+    # 独立的进程组：超时时整组 kill，且终端的 Ctrl+C 只到 worker（第一次信号＝等待任务结束）
+    if os.name == "nt":
+        kwargs['creationflags'] = kwargs.get('creationflags', 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+    else:
+        kwargs['start_new_session'] = True
+    if capture:
+        kwargs.update({'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE})
+    if input_text is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    proc = subprocess.Popen(cmd, **kwargs)
+    with _CHILDREN_LOCK:
+        _CHILDREN.add(proc)
     try:
-        return _claim(tx)
-    except Exception:
-        return False
+        try:
+            out, err = proc.communicate(input=input_text, timeout=timeout)
+            return proc.returncode, out, err, False
+        except subprocess.TimeoutExpired:
+            if not _signal_child_group(proc, signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM):
+                proc.kill()
+            out, err = proc.communicate()
+            return proc.returncode, out, err, True
+    finally:
+        with _CHILDREN_LOCK:
+            _CHILDREN.discard(proc)
+
 
-def run_rpa_script(rpa_script, cfg_json, log_stdout=False, extra_env: Optional[dict] = None, timeout_seconds: Optional[int] = 60 * 10):
-    cmd = [sys.executable, rpa_script]
-    tmpf = None
+def terminate_children():
+    if _WARM_RUNNER is not None:
+        _WARM_RUNNER.terminate()
+    with _CHILDREN_LOCK:
+        procs = list(_CHILDREN)
+    for proc in procs:
+        if _signal_child_group(proc, signal.SIGTERM):
+            continue
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+
+
+class _EventReader:
+    """Read the child's NDJSON event pipe on a thread; builds the final result incrementally.
+
+    Only the structured results are kept (not the child's stdout), so long monitor
+    jobs do not buffer their whole output in the worker.
+    """
+
+    def __init__(self, rfd: int, on_event=None):
+        self.on_event = on_event
+        self.results = []
+        self.batches = 0
+        self.items = 0
+        self.bad_lines = 0
+        self._f = os.fdopen(rfd, "r", encoding="utf-8", errors="replace")
+        self._thread = threading.Thread(target=self._run, name="rpa-events", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for line in self._f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    evt = json.loads(line)
+                except Exception:
+                    self.bad_lines += 1
+                    continue
+                if evt.get("type") == "item":
+                    self.items += 1
+                    if evt.get("ok") and isinstance(evt.get("entry"), dict):
+                        self.results.append(evt["entry"])
+                elif evt.get("type") == "batch":
+                    self.batches += 1
+                if self.on_event:
+                    try:
+                        self.on_event(evt)
+                    except Exception as e:
+                        eprint("Warning: job event handler failed:", e)
+        finally:
+            try:
+                self._f.close()
+            except Exception:
+                pass
+
+    def join(self, timeout: float = 10):
+        self._thread.join(timeout)
+
+    def result(self) -> dict:
+        return {"success": True, "timestamp": int(time.time() * 1000), "results": self.results,
+                "streamed": True, "batches": self.batches, "items": self.items}
+
+
+def _event_channel(popen_kwargs: dict, env: dict):
+    """Create the event pipe and wire its write end into the child; returns (read_fd, write_fd) or None."""
+    if not EVENTS_ENABLED:
+        return None
+    try:
+        rfd, wfd = os.pipe()
+        if sys.platform.startswith("win"):
+            import msvcrt
+            os.set_handle_inheritable(msvcrt.get_osfhandle(wfd), True)
+            handle = msvcrt.get_osfhandle(wfd)
+            si = subprocess.STARTUPINFO()
+            si.lpAttributeList = {"handle_list": [handle]}
+            popen_kwargs["startupinfo"] = si
+            env["RPA_EVENT_HANDLE"] = str(handle)
+        else:
+            popen_kwargs["pass_fds"] = (wfd,)
+            env["RPA_EVENT_FD"] = str(wfd)
+        return rfd, wfd
+    except Exception as e:
+        eprint("Warning: event channel unavailable, falling back to stdout JSON:", e)
+        return None
+
+
+def run_rpa_script(rpa_script, cfg_json, log_stdout=False, extra_env: Optional[dict] = None,
+                   timeout_seconds: Optional[int] = 60 * 10, on_event=None):
+    """Run the RPA script in a new Python process; returns (ok, result).
+
+    With the event channel (default) results arrive as NDJSON lines on a dedicated
+    pipe and on_event(evt) is called for each one while the child runs; otherwise
+    the single JSON batch on stdout is parsed at exit.
+    """
+    # 配置（含 IMAP / SMS 凭据）经 stdin 管道交给子进程：不写临时文件，子进程也无需再读 Firestore。
+    # 没有配置时也发送 {}，子进程不会继承 worker 的 stdin（非 TTY 时 stdin.read() 会一直阻塞）
+    cmd = [sys.executable, rpa_script, "--cfg-stdin"]
+    safe_cfg = {}
     if cfg_json:
-        tmpf = tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".json", encoding="utf-8")
         # Ensure cfg_json is JSON-serializable (convert Firestore timestamps etc.)
         try:
             safe_cfg = _sanitize_for_firestore(cfg_json)
         except Exception:
             safe_cfg = cfg_json
-        json.dump(safe_cfg, tmpf, ensure_ascii=False)
-        tmpf.close()
-        cmd += ["--cfg-file", tmpf.name]
+    cfg_text = json.dumps({"config": safe_cfg}, ensure_ascii=False, default=str)
 
     print(f"[{now_iso()}] 実行: {' '.join(cmd)}", flush=True)
-    try:
-        # Prepare environment for subprocess: merge current env with extra_env
-        env = os.environ.copy()
-        if extra_env and isinstance(extra_env, dict):
-            for k, v in extra_env.items():
-                if v is None:
-                    env.pop(k, None)
-                else:
-                    env[str(k)] = str(v)
-
-        stream_mode = timeout_seconds is None
-        run_kwargs = {
-            'text': True,
-            'encoding': 'utf-8',
-            'errors': 'replace',
-            'env': env,
-        }
-
-        if stream_mode:
-            # Long-running monitor mode: let child inherit stdio so console shows live output.
-            # subprocess.run will block until child exits (which is desired for monitor jobs).
-            res = subprocess.run(cmd, **run_kwargs)
-            stdout = None
-            stderr = None
-        else:
-            run_kwargs.update({'capture_output': True, 'timeout': int(timeout_seconds)})
-            res = subprocess.run(cmd, **run_kwargs)
-            stdout = (res.stdout or "").strip()
-            stderr = (res.stderr or "").strip()
-
-        print(f"[{now_iso()}] RPA 終了コード: {res.returncode}", flush=True)
-        # Only surface child stderr/stdout when explicitly requested by the user
-        # (log_stdout) or when DEBUG_JSON is enabled for machine-readable output.
-        debug_json = os.environ.get('DEBUG_JSON')
-        if stderr and (log_stdout or (debug_json and debug_json != '0')):
-            eprint(f"[{now_iso()}] RPA stderr:\n{stderr}")
-
-        if stdout and (log_stdout or (debug_json and debug_json != '0')):
-            print(f"[{now_iso()}] RPA stdout:\n{stdout}", flush=True)
+    reader = None
+    # Prepare environment for subprocess: merge current env with extra_env
+    env = os.environ.copy()
+    if extra_env and isinstance(extra_env, dict):
+        for k, v in extra_env.items():
+            if v is None:
+                env.pop(k, None)
+            else:
+                env[str(k)] = str(v)
+
+    stream_mode = timeout_seconds is None
+    run_kwargs = {
+        'text': True,
+        'encoding': 'utf-8',
+        'errors': 'replace',
+        'env': env,
+    }
+    channel = _event_channel(run_kwargs, env)
 
-    finally:
-        if tmpf:
-            try: os.unlink(tmpf.name)
-            except Exception:
-                pass
+    if channel:
+        # 结果经事件管道逐条到达；stdout/stderr 不再缓存在内存里
+        rfd, wfd = channel
+        if not stream_mode and not log_stdout:
+            run_kwargs.update({'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL})
+        try:
+            reader = _EventReader(rfd, on_event)
+            returncode, _, _, timed_out = _run_child(cmd, run_kwargs, capture=False,
+                                                     timeout=None if stream_mode else int(timeout_seconds),
+                                                     input_text=cfg_text)
+        finally:
+            os.close(wfd)
+        stdout = stderr = None
+    elif stream_mode:
+        # Long-running monitor mode: let child inherit stdio so console shows live output.
+        # We block until child exits (which is desired for monitor jobs).
+        returncode, _, _, timed_out = _run_child(cmd, run_kwargs, capture=False, timeout=None, input_text=cfg_text)
+        stdout = None
+        stderr = None
+    else:
+        returncode, stdout, stderr, timed_out = _run_child(cmd, run_kwargs, capture=True, timeout=int(timeout_seconds),
+                                                           input_text=cfg_text)
+        stdout = (stdout or "").strip()
+        stderr = (stderr or "").strip()
+
+    if timed_out:
+        eprint(f"[{now_iso()}] RPA タイムアウト（{timeout_seconds}s）: 子プロセスを終了しました")
+        out = {"success": False, "timeout": True, "timeout_seconds": timeout_seconds, "exit_code": returncode}
+        if reader is not None:
+            reader.join()
+            out["results"] = reader.results
+        return False, out
+
+    print(f"[{now_iso()}] RPA 終了コード: {returncode}", flush=True)
+    # Only surface child stderr/stdout when explicitly requested by the user
+    # (log_stdout) or when DEBUG_JSON is enabled for machine-readable output.
+    debug_json = os.environ.get('DEBUG_JSON')
+    if stderr and (log_stdout or (debug_json and debug_json != '0')):
+        eprint(f"[{now_iso()}] RPA stderr:\n{stderr}")
+
+    if stdout and (log_stdout or (debug_json and debug_json != '0')):
+        print(f"[{now_iso()}] RPA stdout:\n{stdout}", flush=True)
+
+    if reader is not None:
+        reader.join()
+        # 至少收到一个 batch 事件才算成功（与旧的“stdout 能解析为 JSON”一致）
+        if reader.batches:
+            return True, reader.result()
+        return False, {"success": False, "exit_code": returncode, "results": reader.results, "streamed": True}
 
     # 优先解析 JSON（如果 child 输出被捕获）
     try:
         if stdout is not None:
             return True, json.loads(stdout)
         else:
-            return (res.returncode == 0), {"success": (res.returncode == 0), "exit_code": res.returncode}
+            return (returncode == 0), {"success": (returncode == 0), "exit_code": returncode}
     except Exception:
-        return False, {"success": False, "raw_stdout": stdout, "exit_code": res.returncode}
-
-def write_history_entry(db, user_uid, entry):
-    """写入历史记录，确保数据格式与前端表格兼容"""
-    coll = db.collection(HISTORY_COLLECTION).document(user_uid).collection("entries")
-    
-    # 安全的对象判断：确保entry是字典且有results数组（包括空数组）
-    if isinstance(entry, dict) and "results" in entry and isinstance(entry.get("results"), list):
-        # 这是带有results数组的RPA输出
-        results = entry.get("results", [])
-        
-        # 如果results为空，不写入任何历史记录（避免产生无意义的记录）
-        if not results:
-            print(f"[{now_iso()}] Skipping history write for empty results")
-            return
-            
-        now = int(time.time() * 1000)
-        
-        for i, result in enumerate(results):
-            # 确保result也是字典类型
-            if not isinstance(result, dict):
-                continue
-                
-            # 转换单个结果为前端表格期望的格式
-            history_entry = {
-                "createdAt": now + i,  # 每个结果略微错开时间戳避免冲突
-                "name": result.get("name") or result.get("姓名（ふりがな）") or "",
-                "phone": result.get("phone") or result.get("電話番号") or "", 
-                "gender": result.get("gender") or result.get("性別") or "",
-                "birth": result.get("birth") or result.get("生年月日") or "",
-                "age": result.get("age") or result.get("__標準_年齢__") or "",
-                "source_url": result.get("source_url") or "",
-                "is_sms_target": bool(result.get("should_send_sms", False)),
-                "sms_sent": result.get("sms_sent"),  # 可能是None, True, False
-                "sms_response": result.get("sms_response"),  # SMS响应详情
-                "level": "success" if result else "info",
-                "_written_at": now_iso(),
-                "_worker_version": "1.0"
-            }
-            
-            # 提取ふりがな信息
-            raw_name = result.get("name") or result.get("姓名（ふりがな）") or ""
-            if raw_name:
-                furigana_match = re.search(r'(?:\(|\（)\s*([^\)\）]+?)\s*(?:\)|\）)\s*$', str(raw_name))
-                if furigana_match:
-                    history_entry["furigana"] = furigana_match.group(1).strip()
-                    history_entry["name"] = re.sub(r'\（.*?\）|\(.*?\)', '', str(raw_name)).strip()
-            
-            try:
-                coll.add(_sanitize_for_firestore(history_entry))
-                print(f"[{now_iso()}] Added history entry for {history_entry['name'] or 'unknown'}")
-            except Exception as e:
-                print(f"[{now_iso()}] Failed to write history entry: {e}")
-    else:
-        # 原始格式，直接写入（保持向后兼容）
-        # 但跳过明显的RPA状态消息
-        if isinstance(entry, dict) and entry.get("message") in ["no_unread"]:
-            print(f"[{now_iso()}] Skipping status message: {entry.get('message')}")
-            return
-            
-        entry_copy = dict(entry) if isinstance(entry, dict) else {"raw": entry}
-        entry_copy["_written_at"] = now_iso()
-        try:
-            coll.add(_sanitize_for_firestore(entry_copy))
-        except Exception as e:
-            print(f"[{now_iso()}] Failed to write raw history entry: {e}")
+        return False, {"success": False, "raw_stdout": stdout, "exit_code": returncode}
 
 def should_stop_for_runtime(max_minutes: int) -> bool:
     if max_minutes <= 0:
@@ -308,93 +479,175 @@ def should_stop_for_runtime(max_minutes: int) -> bool:
     return datetime.now(timezone.utc) >= deadline
 
 
-def _sanitize_for_firestore(obj):
-    """Recursively convert Firestore-specific types (e.g., DatetimeWithNanoseconds)
-    and other non-JSON-friendly values into JSON-serializable Python types.
-    """
-    try:
-        # builtin simple types
-        if obj is None or isinstance(obj, (bool, int, float, str)):
-            return obj
-        # datetime -> ISO
-        if isinstance(obj, datetime):
-            return obj.isoformat().replace('+00:00', 'Z') if obj.tzinfo else obj.isoformat() + 'Z'
-        # bytes -> base64
-        if isinstance(obj, (bytes, bytearray)):
-            try:
-                import base64
+def _iso_z(dt: datetime) -> str:
+    return dt.isoformat().replace('+00:00', 'Z') if dt.tzinfo else dt.isoformat() + 'Z'
 
-                return base64.b64encode(bytes(obj)).decode('ascii')
-            except Exception:
-                return str(obj)
-        # mapping
-        if isinstance(obj, dict):
-            return {k: _sanitize_for_firestore(v) for k, v in obj.items()}
-        # list/tuple
-        if isinstance(obj, (list, tuple)):
-            return [_sanitize_for_firestore(v) for v in obj]
-
-        # Firestore timestamp types: google.protobuf.Timestamp, or
-        # google.cloud.firestore_v1._helpers.DatetimeWithNanoseconds
-        try:
-            from google.protobuf.timestamp_pb2 import Timestamp as _Ts
-
-            if isinstance(obj, _Ts):
-                # convert to RFC3339
-                return datetime.fromtimestamp(obj.seconds, timezone.utc).isoformat().replace('+00:00', 'Z')
-        except Exception:
-            pass
 
-        try:
-            # DatetimeWithNanoseconds is sometimes provided by google.api_core
-            from google.api_core.datetime_helpers import DatetimeWithNanoseconds as _DTWN
-            if isinstance(obj, _DTWN):
-                try:
-                    if obj.tzinfo:
-                        return obj.isoformat().replace('+00:00', 'Z')
-                    else:
-                        return obj.isoformat() + 'Z'
-                except Exception:
-                    return str(obj)
-        except Exception:
-            pass
+def _b64(b) -> str:
+    return base64.b64encode(bytes(b)).decode('ascii')
+
 
-        # Duck-typing: some firestore/protobuf timestamp-like objects expose seconds/nanos
+def _pb_timestamp(ts) -> str:
+    # google.protobuf.Timestamp -> RFC3339（秒精度）
+    return datetime.fromtimestamp(ts.seconds, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def _sanitize_other(obj):
+    """Non-builtin values: timestamp-like objects (seconds/nanos, to_datetime/ToDatetime), else str."""
+    if hasattr(obj, 'seconds') and hasattr(obj, 'nanos'):
         try:
-            if hasattr(obj, 'seconds') and hasattr(obj, 'nanos'):
-                try:
-                    secs = int(getattr(obj, 'seconds'))
-                    nanos = int(getattr(obj, 'nanos'))
-                    ts = secs + (nanos / 1_000_000_000)
-                    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace('+00:00', 'Z')
-                except Exception:
-                    return str(obj)
+            ts = int(obj.seconds) + int(obj.nanos) / 1_000_000_000
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace('+00:00', 'Z')
         except Exception:
-            pass
+            return str(obj)
+    for name in ('to_datetime', 'ToDatetime'):
+        conv = getattr(obj, name, None)
+        if callable(conv):
+            try:
+                return _sanitize_for_firestore(conv())
+            except Exception:
+                pass
+    return str(obj)
+
+
+def _identity(obj):
+    return obj
+
+
+# 容器的标记（由 _sanitize_for_firestore 迭代展开）
+_SANITIZE_DICT = object()
+_SANITIZE_LIST = object()
+# 超过此嵌套深度的容器截断为 "{...}" / "[...]"（同时防止循环引用无限展开）
+_SANITIZE_MAX_DEPTH = 1000
+
+# type -> converter；常见类型预先登记，其余类型首次出现时按 isinstance 顺序解析后缓存
+_SANITIZE_DISPATCH = {
+    type(None): _identity, bool: _identity, int: _identity, float: _identity, str: _identity,
+    datetime: _iso_z, bytes: _b64, bytearray: _b64,
+    dict: _SANITIZE_DICT, OrderedDict: _SANITIZE_DICT, list: _SANITIZE_LIST, tuple: _SANITIZE_LIST,
+}
+if _PbTimestamp is not None:
+    _SANITIZE_DISPATCH[_PbTimestamp] = _pb_timestamp
+
+
+def _sanitize_converter(tp):
+    conv = _SANITIZE_DISPATCH.get(tp)
+    if conv is not None:
+        return conv
+    # 子类（DatetimeWithNanoseconds 是 datetime 的子类、IntEnum 等）：与旧实现相同的判定顺序
+    if issubclass(tp, (bool, int, float, str)):
+        conv = _identity
+    elif issubclass(tp, datetime):
+        conv = _iso_z
+    elif issubclass(tp, (bytes, bytearray)):
+        conv = _b64
+    elif issubclass(tp, dict):
+        conv = _SANITIZE_DICT
+    elif issubclass(tp, (list, tuple)):
+        conv = _SANITIZE_LIST
+    elif _PbTimestamp is not None and issubclass(tp, _PbTimestamp):
+        conv = _pb_timestamp
+    else:
+        conv = _sanitize_other
+    _SANITIZE_DISPATCH[tp] = conv
+    return conv
+
+
+def _sanitize_for_firestore(obj):
+    """Convert Firestore-specific types (e.g., DatetimeWithNanoseconds) and other
+    non-JSON-friendly values into JSON-serializable Python types.
 
-        # If object provides conversion helpers, try them
+    Leaf converters come from a type-keyed table (_SANITIZE_DISPATCH); dicts and
+    lists are expanded with an explicit stack, so deep results do not recurse.
+    """
+    conv = _sanitize_converter(type(obj))
+    if conv is not _SANITIZE_DICT and conv is not _SANITIZE_LIST:
         try:
-            to_dt = getattr(obj, 'to_datetime', None)
-            if callable(to_dt):
-                try:
-                    dt = to_dt()
-                    return _sanitize_for_firestore(dt)
-                except Exception:
-                    pass
-            ToDt = getattr(obj, 'ToDatetime', None)
-            if callable(ToDt):
-                try:
-                    dt = ToDt()
-                    return _sanitize_for_firestore(dt)
-                except Exception:
-                    pass
+            return conv(obj)
         except Exception:
-            pass
+            return str(obj)
+
+    root = [None]
+    # (元の容器, 書き込み先, キー/添字, 深さ)
+    stack = [(obj, conv, root, 0, 0)]
+    lookup = _SANITIZE_DISPATCH.get
+    while stack:
+        src, kind, dst, key, depth = stack.pop()
+        if kind is _SANITIZE_DICT:
+            out = {}
+            items = src.items()
+        else:
+            out = [None] * len(src)
+            items = enumerate(src)
+        dst[key] = out
+        for k, v in items:
+            c = lookup(type(v)) or _sanitize_converter(type(v))
+            if c is _identity:
+                out[k] = v
+                continue
+            if c is _SANITIZE_DICT or c is _SANITIZE_LIST:
+                if depth + 1 >= _SANITIZE_MAX_DEPTH:
+                    out[k] = "{...}" if c is _SANITIZE_DICT else "[...]"
+                else:
+                    out[k] = None
+                    stack.append((v, c, out, k, depth + 1))
+                continue
+            try:
+                out[k] = c(v)
+            except Exception:
+                out[k] = str(v)
+    return root[0]
 
-        # Fallback to str
-        return str(obj)
-    except Exception:
-        return str(obj)
+
+_CONFIG_CACHE = None
+
+
+def get_config_cache(db) -> ConfigCache:
+    """user_configs 的进程内缓存（on_snapshot 监听 + TTL 兜底），整个 worker 共用一个。"""
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = ConfigCache(lambda: db)
+    return _CONFIG_CACHE
+
+
+_ALIAS_LRU = OrderedDict()  # identifier -> user_configs doc id
+
+
+def alias_doc_id(identifier: str) -> str:
+    """uid_aliases 的文档 ID（'/' 等不可用字符做 URL 编码，'.' 也编码以避开 '.' / '..'）。"""
+    return urllib.parse.quote(str(identifier).strip(), safe="@+-_~").replace(".", "%2E")
+
+
+def _remember_alias(identifier: str, doc_id: str):
+    _ALIAS_LRU[str(identifier)] = doc_id
+    _ALIAS_LRU.move_to_end(str(identifier))
+    if len(_ALIAS_LRU) > ALIAS_LRU_SIZE:
+        _ALIAS_LRU.popitem(last=False)
+
+
+def _alias_matches(data: dict, identifier: str) -> bool:
+    """配置文档里是否仍有某个字段等于 identifier（别名是懒写入的缓存，读时校验防止指向旧文档）。"""
+    ident = str(identifier).strip()
+    for f in ALIAS_FIELDS:
+        v = (data or {}).get(f)
+        if v is not None and str(v).strip() == ident:
+            return True
+    return False
+
+
+def write_uid_aliases(db, doc_id: str, identifiers, field: Optional[str] = None):
+    """Point uid_aliases/{identifier} at user_configs/{doc_id} (one batch)."""
+    idents = [str(i).strip() for i in identifiers if i and str(i).strip() and str(i).strip() != str(doc_id)]
+    if not idents:
+        return
+    batch = db.batch()
+    for ident in idents:
+        payload = {"userDocId": str(doc_id), "alias": ident, "updated_at": now_iso()}
+        if field:
+            payload["field"] = field
+        batch.set(db.collection(ALIAS_COLLECTION).document(alias_doc_id(ident)), payload)
+        _remember_alias(ident, str(doc_id))
+    batch.commit()
 
 
 def find_user_config(db, user_identifier: str):
@@ -402,76 +655,557 @@ def find_user_config(db, user_identifier: str):
 
     Returns (doc_id, data_dict) if found, otherwise None.
     Strategy:
-    1. Try document with id == user_identifier
-    2. Query user_configs where common fields match (authUid, uid, email)
+    0. In-process LRU of identifier -> doc id
+    1. Try document with id == user_identifier (served from the config cache)
+    2. uid_aliases/{user_identifier} point read
+    3. Query user_configs where common fields match (authUid, uid, email);
+       a match is written back to uid_aliases so the next lookup stops at 2
+
+    uid_aliases is only a lazily written cache: nothing rewrites it when the
+    web UI edits user_configs.  Hits from 0 and 2 are therefore accepted only
+    if the target document still carries the identifier in one of
+    ALIAS_FIELDS; otherwise the stale mapping is dropped and 3 re-resolves it.
     """
     coll = db.collection("user_configs")
+    cache = get_config_cache(db)
+    ident = str(user_identifier)
+
+    # 0) LRU
+    cached_id = _ALIAS_LRU.get(ident)
+    if cached_id:
+        try:
+            data = cache.get(cached_id)
+            if data is not None and _alias_matches(data, ident):
+                _ALIAS_LRU.move_to_end(ident)
+                return cached_id, data
+        except Exception:
+            pass
+        _ALIAS_LRU.pop(ident, None)
+
     # 1) direct doc id
     try:
-        snap = coll.document(str(user_identifier)).get()
-        if snap.exists:
-            return snap.id, snap.to_dict() or {}
+        data = cache.get(ident)
+        if data is not None:
+            return ident, data
+    except Exception:
+        pass
+
+    # 2) alias index
+    try:
+        alias_ref = db.collection(ALIAS_COLLECTION).document(alias_doc_id(ident))
+        alias = alias_ref.get()
+        if alias.exists:
+            target = (alias.to_dict() or {}).get("userDocId")
+            if target:
+                data = cache.get(str(target))
+                if data is not None and _alias_matches(data, ident):
+                    _remember_alias(ident, str(target))
+                    return str(target), data
+            # 指向的文档已不存在或字段已改到别的文档：删掉旧别名，交给 3) 重新解析
+            try:
+                alias_ref.delete()
+            except Exception as e:
+                eprint("Warning: failed to delete stale uid alias:", e)
     except Exception:
         pass
 
-    # 2) try common fields
-    fields = ["authUid", "uid", "email", "userUid"]
-    for f in fields:
+    # 3) try common fields
+    for f in ALIAS_FIELDS:
         try:
             q = coll.where(field_path=f, op_string="==", value=user_identifier).limit(1)
             docs = list(q.stream())
             if docs:
                 d = docs[0]
-                return d.id, d.to_dict() or {}
+                data = d.to_dict() or {}
+                cache.put(d.id, data)
+                try:
+                    write_uid_aliases(db, d.id, [ident], field=f)
+                except Exception as e:
+                    eprint("Warning: failed to write uid alias:", e)
+                    _remember_alias(ident, d.id)
+                return d.id, data
         except Exception:
             # ignore and continue
             continue
 
     return None
 
-def cleanup_expired_jobs(db):
-    """清理过期的已完成任务，减少数据冗余"""
+class LatencyStats:
+    """Sliding window (last `window` samples) of enqueue-to-claim latency in ms."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._samples = []
+        self._window = window
+        self.count = 0
+
+    def add(self, ms: float):
+        with self._lock:
+            self.count += 1
+            self._samples.append(ms)
+            if len(self._samples) > self._window:
+                del self._samples[: len(self._samples) - self._window]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            xs = sorted(self._samples)
+        if not xs:
+            return {"count": self.count}
+        pick = lambda q: round(xs[min(len(xs) - 1, int(q * (len(xs) - 1)))], 1)
+        return {"count": self.count, "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": round(xs[-1], 1)}
+
+
+QUEUE_WAIT = LatencyStats()
+
+
+class LeaseKeeper:
+    """Keep the leases of jobs held by this worker alive and reap other workers' expired leases.
+
+    One background thread: every LEASE_SECONDS/3 it extends lease_expires_at for
+    every held job (claimed, buffered or running) that still carries our claim
+    (claimed_by + claim_token; jobs reclaimed meanwhile are dropped), and every REAPER_INTERVAL it
+    moves expired `running` jobs to `backoff` (or `failed` after MAX_ATTEMPTS)
+    and due `backoff` jobs back to `queued`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = {}  # job_id -> (claimed_by, claim_token)
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"heartbeats": 0, "heartbeat_errors": 0, "lost": 0, "backoff": 0, "failed": 0, "requeued": 0}
+
+    def hold(self, jobs):
+        """jobs: (job_id, data) pairs as returned by claim / claim_batch."""
+        with self._lock:
+            for job_id, data in jobs:
+                self._held[job_id] = (data.get("claimed_by"), data.get("claim_token"))
+
+    def drop(self, job_id: str):
+        with self._lock:
+            self._held.pop(job_id, None)
+
+    def held(self) -> list:
+        with self._lock:
+            return [(job_id, owner, token) for job_id, (owner, token) in self._held.items()]
+
+    def heartbeat(self, store: storage.Storage):
+        claims = self.held()
+        if not claims:
+            return
+        try:
+            lost = store.jobs.heartbeat(claims, storage.iso_after(storage.LEASE_SECONDS))
+            self.stats["heartbeats"] += 1
+            for job_id in lost:
+                # 期限切れで reaper に回収された / 他の worker が再 claim した：以後リースも結果も書かない
+                self.drop(job_id)
+                self.stats["lost"] += 1
+                eprint(f"[{now_iso()}] Lost the claim on job {job_id} (reclaimed); its result will be dropped")
+        except Exception as e:
+            self.stats["heartbeat_errors"] += 1
+            eprint("Warning: lease heartbeat failed:", e)
+
+    def reap(self, store: storage.Storage) -> dict:
+        try:
+            counts = store.jobs.reap_expired(now_iso())
+        except Exception as e:
+            eprint("Warning: lease reaper failed:", e)
+            return {}
+        for k, v in counts.items():
+            self.stats[k] = self.stats.get(k, 0) + v
+        if counts.get("backoff") or counts.get("failed"):
+            print(f"[{now_iso()}] Reclaimed expired leases: {json.dumps(counts)}", flush=True)
+        return counts
+
+    def start(self, store: storage.Storage, reap_interval: int = None):
+        if self._thread is not None:
+            return
+        reap_interval = reap_interval or REAPER_INTERVAL
+        beat = max(1.0, storage.LEASE_SECONDS / 3)
+
+        def _loop():
+            last_beat = last_reap = 0.0
+            while not self._stop.is_set():
+                if time.monotonic() - last_beat >= beat:
+                    self.heartbeat(store)
+                    last_beat = time.monotonic()
+                if time.monotonic() - last_reap >= reap_interval:
+                    self.reap(store)
+                    last_reap = time.monotonic()
+                self._stop.wait(min(beat, reap_interval))
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=_loop, name="rpa-lease", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+LEASES = LeaseKeeper()
+
+
+class JobGC:
+    """Background garbage collection of expired done/failed jobs.
+
+    Every GC_INTERVAL seconds it deletes jobs whose expires_at has passed, in pages
+    (Firestore: BulkWriter), and keeps going while each pass hits GC_MAX_PER_PASS,
+    i.e. until the backlog is drained. Tracks collection size and deletion rate.
+    With a Firestore TTL policy on expires_at this only speeds up what TTL does anyway.
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"passes": 0, "deleted": 0, "errors": 0, "last_deleted": 0, "last_ms": 0.0,
+                      "last_rate_per_s": 0.0, "collection_size": None, "queued": None}
+
+    def collect(self, store: storage.Storage) -> int:
+        """Drain expired jobs (one or more passes); returns the number deleted."""
+        t0 = time.monotonic()
+        total = 0
+        try:
+            while not self._stop.is_set():
+                n = store.jobs.cleanup_expired(datetime.now(timezone.utc), limit=GC_MAX_PER_PASS)
+                self.stats["passes"] += 1
+                total += n
+                if n < GC_MAX_PER_PASS:
+                    break
+        except Exception as e:
+            self.stats["errors"] += 1
+            eprint("Warning: failed to cleanup expired jobs:", e)
+        elapsed = time.monotonic() - t0
+        self.stats["deleted"] += total
+        self.stats["last_deleted"] = total
+        self.stats["last_ms"] = round(elapsed * 1000, 1)
+        self.stats["last_rate_per_s"] = round(total / elapsed, 1) if total and elapsed > 0 else 0.0
+        try:
+            self.stats["collection_size"] = store.jobs.count()
+            self.stats["queued"] = store.jobs.count("queued")
+        except Exception as e:
+            eprint("Warning: failed to count jobs:", e)
+        if total:
+            print(f"[{now_iso()}] Cleaned up {total} expired jobs: {json.dumps(self.stats)}", flush=True)
+        return total
+
+    def start(self, store: storage.Storage, interval: int = None):
+        interval = GC_INTERVAL if interval is None else interval
+        if self._thread is not None or interval <= 0:
+            return
+
+        def _loop():
+            # 起動時に 1 回、以後 interval ごと
+            while not self._stop.is_set():
+                self.collect(store)
+                self._stop.wait(interval)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=_loop, name="rpa-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+
+GC = JobGC()
+
+
+class SmsFlusher:
+    """Sends deferred SMS when they come due, even if the user has no job running.
+
+    Deferred sends live in this host's SMS ledger (sms_ledger.py, under RPA_STATE_DIR). Every
+    SMS_FLUSH_INTERVAL seconds the uids with due rows (SmsLedger.due_uids) each get a short
+    flush-only RPA run (RPA_SMS_FLUSH_ONLY=1: no mailbox, no browser) through the normal runner.
+    The child claims rows with SmsLedger.claim_due, so a job running for the same uid never
+    sends them twice. The wait until the next pass is shortened to SmsLedger.next_due_at().
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"passes": 0, "runs": 0, "errors": 0}
+
+    def flush(self, store: storage.Storage, ledger, rpa_script, runner=None) -> int:
+        """One pass: run a flush for every uid with due rows; returns the number of runs."""
+        runner = runner or run_rpa_script
+        self.stats["passes"] += 1
+        try:
+            uids = ledger.due_uids()
+        except Exception as e:
+            self.stats["errors"] += 1
+            eprint("Warning: failed to read SMS ledger:", e)
+            return 0
+        runs = 0
+        for uid in uids:
+            if self._stop.is_set():
+                break
+            cfg = None
+            try:
+                cfg = store.configs.get(uid)
+                if cfg is None:
+                    found = store.configs.find(uid)
+                    cfg = found[1] if found else None
+            except Exception as e:
+                eprint("Error resolving user config:", e)
+            extra_env = {'USER_UID': uid, 'RPA_SMS_FLUSH_ONLY': '1'}
+            sa_env = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+            if sa_env:
+                extra_env['GOOGLE_APPLICATION_CREDENTIALS'] = sa_env
+            print(f"[{now_iso()}] Flushing deferred SMS for {uid}", flush=True)
+            try:
+                ok, result = runner(rpa_script, cfg, log_stdout=False, extra_env=extra_env,
+                                    timeout_seconds=SMS_FLUSH_TIMEOUT_SECONDS)
+            except Exception as e:
+                ok, result = False, {"error": str(e)}
+            runs += 1
+            if not ok:
+                self.stats["errors"] += 1
+                eprint(f"Warning: deferred SMS flush for {uid} failed:", result)
+        self.stats["runs"] += runs
+        return runs
+
+    def start(self, store: storage.Storage, rpa_script, runner=None, interval: int = None):
+        interval = SMS_FLUSH_INTERVAL if interval is None else interval
+        if self._thread is not None or interval <= 0:
+            return
+        try:
+            from sms_ledger import SmsLedger
+            ledger = SmsLedger()
+        except Exception as e:
+            eprint("Warning: SMS ledger unavailable, deferred SMS are only sent during jobs:", e)
+            return
+
+        def _loop():
+            while not self._stop.is_set():
+                self.flush(store, ledger, rpa_script, runner=runner)
+                wait = interval
+                try:
+                    due = ledger.next_due_at()
+                    if due is not None:
+                        wait = min(interval, max(1.0, due / 1000 - time.time()))
+                except Exception:
+                    pass
+                self._stop.wait(wait)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=_loop, name="rpa-sms-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=SMS_FLUSH_TIMEOUT_SECONDS + 10)
+            self._thread = None
+
+
+SMS_FLUSHER = SmsFlusher()
+
+
+class ClaimBuffer:
+    """Local prefetch of jobs claimed in batches (one transaction per batch).
+
+    Workers hash their id into one of `shards` shards and prefer jobs whose id
+    hashes to the same shard, so concurrent workers mostly claim disjoint jobs.
+    Buffered jobs are already `running`; release_all() puts them back on exit.
+    With a picker (scheduler.make_picker) the batch is chosen fairly across users
+    from JobQueue.candidates() instead of strictly oldest-first.
+    """
+
+    def __init__(self, store: storage.Storage, hostname: str, batch: int = 1, shards: int = 1,
+                 worker_id: Optional[str] = None, picker=None):
+        self.store = store
+        self.hostname = hostname
+        self.batch = max(1, int(batch))
+        self.shards = max(1, int(shards))
+        self.worker_id = worker_id or f"{hostname}:{os.getpid()}"
+        self.shard = storage.shard_of(self.worker_id, self.shards)
+        # 自分のシャード分を拾えるだけ先頭を広めに読む
+        self.scan = min(CLAIM_SCAN_MAX, self.batch * self.shards * 2) if self.shards > 1 else self.batch
+        self.picker = picker
+        if picker is not None:
+            # 公平に選ぶには複数ユーザーの候補が要る（1 ユーザーあたり最大 batch 件）
+            self.scan = min(CLAIM_SCAN_MAX, max(self.scan, self.batch * 8, 20))
+        self._lock = threading.Lock()
+        self._buf = deque()
+        self.stats = {"batches": 0, "claimed": 0, "empty_batches": 0, "released": 0}
+
+    def next(self):
+        """(doc_id, doc_data), False if the queue is empty, None if every candidate was taken by others."""
+        with self._lock:
+            if self._buf:
+                return self._buf.popleft()
+            got = self.store.jobs.claim_batch(self.hostname, self.batch, scan=self.scan,
+                                              shard=self.shard, shards=self.shards,
+                                              picker=self.picker, per_user=self.batch)
+            self.stats["batches"] += 1
+            self.stats["claimed"] += len(got)
+            LEASES.hold(got)
+            if not got:
+                self.stats["empty_batches"] += 1
+                # 候補がまだ残っていれば競合負け（すぐ再試行）、無ければ空
+                return None if self.store.jobs.next_queued(1) else False
+            self._buf.extend(got)
+            return self._buf.popleft()
+
+    def release_all(self) -> int:
+        with self._lock:
+            pending, self._buf = list(self._buf), deque()
+        for doc_id, _ in pending:
+            LEASES.drop(doc_id)
+            try:
+                self.store.jobs.release(doc_id)
+                self.stats["released"] += 1
+            except Exception as e:
+                eprint(f"Warning: failed to release prefetched job {doc_id}:", e)
+        return len(pending)
+
+
+def claim_next_job(store: storage.Storage, hostname, buffer: Optional[ClaimBuffer] = None):
+    """Return (doc_id, doc_data) of a job we claimed, False if the queue is empty, None if we lost the race."""
+    if buffer is not None:
+        claimed = buffer.next()
+        if not claimed:
+            return claimed
+        doc_id, doc_data = claimed
+    else:
+        jobs = store.jobs.next_queued(1)
+        if not jobs:
+            return False
+
+        doc_id, doc_data = jobs[0]
+
+        # transactional claim
+        fields = store.jobs.claim(doc_id, hostname)
+        if not fields:
+            return None  # 有任务但被别人抢了
+        doc_data = {**doc_data, **fields}
+        LEASES.hold([(doc_id, doc_data)])
+
+    created = storage.as_utc(doc_data.get("created_at"))
+    wait_ms = None
+    if created is not None:
+        wait_ms = max(0.0, (datetime.now(timezone.utc) - created).total_seconds() * 1000)
+        QUEUE_WAIT.add(wait_ms)
+    wait_txt = f", waited {wait_ms / 1000:.1f}s" if wait_ms is not None else ""
+    print(f"[{now_iso()}] Claimed job: {doc_id} (user: {doc_data.get('userUid')}{wait_txt})", flush=True)
+    return doc_id, doc_data
+
+
+def start_queue_listener(store: storage.Storage, wake: threading.Event):
+    """Subscribe to new queued jobs; returns an unsubscribe function or None (polling only)."""
+    if os.environ.get("RPA_WORKER_LISTEN", "1") == "0":
+        return None
     try:
-        # 删除24小时前完成的任务
-        cutoff_time = datetime.now(timezone.utc) - timedelta(hours=24)
-        cutoff_iso = cutoff_time.isoformat().replace('+00:00', 'Z')
-        
-        # 查询过期的已完成任务
-        expired_query = db.collection(JOB_COLLECTION).where(
-            field_path="status", op_string="in", value=["done", "failed"]
-        ).where(
-            field_path="expires_at", op_string="<=", value=cutoff_iso
-        ).limit(50)  # 每次最多清理50个
-        
-        docs = list(expired_query.stream())
-        if docs:
-            batch = db.batch()
-            for doc in docs:
-                batch.delete(doc.reference)
-            batch.commit()
-            print(f"[{now_iso()}] Cleaned up {len(docs)} expired jobs", flush=True)
-            
+        return store.jobs.watch_queued(wake.set)
     except Exception as e:
-        eprint("Warning: failed to cleanup expired jobs:", e)
-
-def process_one_job(db, hostname, rpa_script) -> bool:
-    """返回是否处理到一条任务（True=处理了/更新了状态，False=队列为空）"""
-    # use named args to avoid positional-arg deprecation warning from google-cloud-firestore
-    q = db.collection(JOB_COLLECTION).where(field_path="status", op_string="==", value="queued").order_by("created_at").limit(1)
-    docs = list(q.stream())
-    if not docs:
+        eprint("Warning: queue listener unavailable, polling only:", e)
+        return None
+
+
+def process_one_job(store: storage.Storage, hostname, rpa_script, runner=None,
+                    buffer: Optional[ClaimBuffer] = None) -> bool:
+    """返回是否处理到一条任务（True=处理了/更新了状态，False=队列为空）
+
+    runner(rpa_script, cfg, log_stdout, extra_env, timeout_seconds, on_event) -> (ok, result)
+    defaults to run_rpa_script (the benchmark plugs in a stub).
+    """
+    claimed = claim_next_job(store, hostname, buffer)
+    if claimed is False:
         return False
+    if claimed is None:
+        return True
+    execute_job(store, claimed[0], claimed[1], rpa_script, runner)
+    return True
 
-    doc = docs[0]
-    doc_ref = doc.reference
-    doc_id = doc.id
-    doc_data = doc.to_dict() or {}
 
-    # transactional claim
-    if not claim_job_transactional(db, doc_ref, hostname):
-        return True  # 有任务但被别人抢了
+class JobProgress:
+    """on_event sink: folds the child's events into rpa_jobs/{id}.progress (throttled writes)."""
+
+    def __init__(self, store: storage.Storage, doc_id: str, min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.store = store
+        self.doc_id = doc_id
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+        self._dirty = False
+        self.progress = {"found": 0, "processed": 0, "succeeded": 0, "sms_sent": 0, "sms_targets": 0, "batches": 0}
+
+    def __call__(self, evt: dict):
+        kind = evt.get("type")
+        with self._lock:
+            p = self.progress
+            if kind == "found":
+                p["found"] += int(evt.get("count") or 0)
+            elif kind == "item":
+                p["processed"] += 1
+                entry = evt.get("entry") if isinstance(evt.get("entry"), dict) else None
+                if evt.get("ok") and entry is not None:
+                    p["succeeded"] += 1
+                    if entry.get("should_send_sms"):
+                        p["sms_targets"] += 1
+                    if entry.get("sms_sent"):
+                        p["sms_sent"] += 1
+                    if entry.get("name"):
+                        p["last_name"] = str(entry.get("name"))[:100]
+                if evt.get("history_id"):
+                    p["last_history_id"] = str(evt["history_id"])
+            elif kind == "batch":
+                p["batches"] += 1
+            else:
+                return
+            self._dirty = True
+            due = kind == "batch" or time.monotonic() - self._last_write >= self.min_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = {"progress": {**self.progress, "updated_at": now_iso()}}
+            self._dirty = False
+            self._last_write = time.monotonic()
+        try:
+            self.store.jobs.update(self.doc_id, payload)
+        except Exception as e:
+            eprint(f"Warning: failed to update progress of job {self.doc_id}:", e)
+
+
+def finish_job(store: storage.Storage, doc_id: str, doc_data: dict, fields: dict) -> bool:
+    """Write a job's final status under the claim we took (claimed_by + claim_token, one transaction).
 
-    print(f"[{now_iso()}] Claimed job: {doc_id} (user: {doc_data.get('userUid')})", flush=True)
+    If the lease expired and the job was reaped or claimed again meanwhile, the write is
+    dropped (the other attempt owns the job now) and False is returned.
+    """
+    if store.jobs.finish(doc_id, doc_data.get("claimed_by"), doc_data.get("claim_token"), fields):
+        return True
+    print(f"[{now_iso()}] Job {doc_id} was reclaimed after our lease expired; dropping its {fields.get('status')} result",
+          flush=True)
+    return False
+
+
+def execute_job(store: storage.Storage, doc_id: str, doc_data: dict, rpa_script, runner=None,
+                slot: Optional[int] = None) -> str:
+    """Run one claimed job and write its final status; returns that status.
+
+    slot (JobPool) selects a per-slot Chrome profile; None = the single shared chrome_user_data.
+    """
+    try:
+        return _execute_job(store, doc_id, doc_data, rpa_script, runner, slot=slot)
+    finally:
+        # 结果写入后不再续租（reaper 只回收 running 状态）
+        LEASES.drop(doc_id)
+
+
+def _execute_job(store: storage.Storage, doc_id: str, doc_data: dict, rpa_script, runner=None,
+                 slot: Optional[int] = None) -> str:
+    runner = runner or run_rpa_script
 
     user_uid = doc_data.get("userUid")
     cfg = doc_data.get("cfg")
@@ -482,16 +1216,16 @@ def process_one_job(db, hostname, rpa_script) -> bool:
     # Prefer an explicit userDocId written by the enqueueing server
     if doc_data.get("userDocId"):
         try:
-            snap = db.collection("user_configs").document(str(doc_data.get("userDocId"))).get()
-            if snap.exists:
-                resolved_user_doc_id = snap.id
-                resolved_cfg = snap.to_dict() or {}
+            data = store.configs.get(str(doc_data.get("userDocId")))
+            if data is not None:
+                resolved_user_doc_id = str(doc_data.get("userDocId"))
+                resolved_cfg = data
         except Exception:
             pass
 
     if not resolved_user_doc_id and user_uid:
         try:
-            resolved_doc = find_user_config(db, user_uid)
+            resolved_doc = store.configs.find(user_uid)
             if resolved_doc:
                 resolved_user_doc_id, resolved_cfg = resolved_doc
         except Exception as e:
@@ -511,6 +1245,9 @@ def process_one_job(db, hostname, rpa_script) -> bool:
         extra_env['USER_UID'] = resolved_user_doc_id
     elif user_uid:
         extra_env['USER_UID'] = user_uid
+    if slot is not None:
+        # 并行执行时各任务的 Chrome 用户配置目录（槽位 × 用户，互不共享；并行数 1 时沿用 chrome_user_data）
+        extra_env['RPA_CHROME_PROFILE_DIR'] = chrome_profile_dir(f"slot{slot}", extra_env.get('USER_UID'))
 
     # If job cfg requests monitor mode, run child script without timeout and stream output
     monitor_mode = False
@@ -520,11 +1257,16 @@ def process_one_job(db, hostname, rpa_script) -> bool:
     except Exception:
         monitor_mode = False
 
+    # 子进程每处理完一个应募者就通过事件通道通知，实时写入任务的 progress
+    progress = JobProgress(store, doc_id)
     if monitor_mode:
         print(f"[{now_iso()}] Starting RPA in monitor mode for job {doc_id}", flush=True)
-        ok, result = run_rpa_script(rpa_script, cfg, log_stdout=False, extra_env=extra_env, timeout_seconds=None)
+        ok, result = runner(rpa_script, cfg, log_stdout=False, extra_env=extra_env, timeout_seconds=None,
+                            on_event=progress)
     else:
-        ok, result = run_rpa_script(rpa_script, cfg, log_stdout=False, extra_env=extra_env)
+        ok, result = runner(rpa_script, cfg, log_stdout=False, extra_env=extra_env, timeout_seconds=JOB_TIMEOUT_SECONDS,
+                            on_event=progress)
+    progress.flush()
 
     # 检测是否需要人工
     needs_human = False
@@ -549,9 +1291,10 @@ def process_one_job(db, hostname, rpa_script) -> bool:
     if needs_human:
         update_payload["status"] = "needs_human"
         if targets: update_payload["targets"] = targets
-        doc_ref.update(update_payload)
+        if not finish_job(store, doc_id, doc_data, update_payload):
+            return "lost"
         print(f"[{now_iso()}] Job {doc_id} requires human intervention.", flush=True)
-        return True
+        return "needs_human"
 
     # 检查是否因缺少凭据失败（exitcode 2 是 rpa 脚本的凭据错误码）
     if not ok and isinstance(result, dict) and result.get("exit_code") == 2:
@@ -561,27 +1304,185 @@ def process_one_job(db, hostname, rpa_script) -> bool:
             update_payload["suggested_user_doc_id"] = resolved_user_doc_id
         elif user_uid:
             update_payload["suggested_user_uid"] = user_uid
-        doc_ref.update(update_payload)
+        if not finish_job(store, doc_id, doc_data, update_payload):
+            return "lost"
         print(f"[{now_iso()}] Job {doc_id} needs user setup (missing email credentials)", flush=True)
-        return True
+        return "needs_setup"
 
     # 正常完成 - 标记为 done/failed 并设置过期时间
     update_payload["status"] = "done" if ok else "failed"
     update_payload["completed_at"] = now_iso()
-    # 设置24小时后过期，便于后续清理
-    import datetime
-    expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=24)
-    update_payload["expires_at"] = expire_time.isoformat().replace('+00:00', 'Z')
-    doc_ref.update(update_payload)
+    # 设置过期时间（默认24小时，Firestore 中为原生 Timestamp，可直接用于 TTL 策略），由 GC 清理
+    update_payload["expires_at"] = storage.expires_in()
+    if not finish_job(store, doc_id, doc_data, update_payload):
+        return "lost"
 
     if user_uid:
         # Always skip worker-side history write: child script performs a single immediate write.
         # This avoids duplicate records (parent+child) and centralizes normalization/idempotency.
         print(f"[{now_iso()}] Skipping worker-side history write (child script writes immediately)", flush=True)
 
-    return True
+    return update_payload["status"]
+
+class PoolMetrics:
+    """Throughput counters for the concurrent dispatcher."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.claimed = 0
+        self.finished = 0
+        self.failed = 0
+        self.errors = 0
+        self.lost_races = 0
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.by_status = {}
+
+    def job_started(self):
+        with self._lock:
+            self.claimed += 1
+            self.busy += 1
+
+    def job_finished(self, status: str, seconds: float):
+        with self._lock:
+            self.busy -= 1
+            self.finished += 1
+            self.busy_seconds += seconds
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+            if status in ("failed", "error"):
+                self.failed += 1
+            if status == "error":
+                self.errors += 1
+
+    def lost_race(self):
+        with self._lock:
+            self.lost_races += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = max(1e-9, time.monotonic() - self.started_at)
+            return {
+                "concurrency": self.size,
+                "busy": self.busy,
+                "claimed": self.claimed,
+                "finished": self.finished,
+                "failed": self.failed,
+                "lost_races": self.lost_races,
+                "jobs_per_minute": round(self.finished / elapsed * 60, 2),
+                "avg_job_seconds": round(self.busy_seconds / self.finished, 2) if self.finished else None,
+                "utilization": round(self.busy_seconds / (elapsed * self.size), 3),
+                "by_status": dict(self.by_status),
+            }
 
-def main_loop(once=False, max_runtime_minutes=0, sa_path=None, script_override=None):
+
+class JobPool:
+    """Claim and run up to `size` jobs at once.
+
+    One dispatcher thread claims jobs only while a slot is free; each claimed job
+    runs on a pool thread that blocks on its own child process (per-job timeout
+    from run_rpa_script). On STOP the dispatcher stops claiming and running jobs
+    are drained; a second signal terminates the children (see handle_signal).
+    """
+
+    METRICS_INTERVAL = 60
+
+    def __init__(self, store: storage.Storage, hostname: str, rpa_script: str, size: int, runner=None,
+                 wake: Optional[threading.Event] = None, idle_wait: float = POLL_INTERVAL,
+                 buffer: Optional[ClaimBuffer] = None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.store = store
+        self.hostname = hostname
+        self.rpa_script = rpa_script
+        self.size = max(1, int(size))
+        self.runner = runner
+        self.idle_wait = idle_wait
+        self.buffer = buffer
+        self.metrics = PoolMetrics(self.size)
+        self._slots = threading.BoundedSemaphore(self.size)
+        # 空闲槽位编号（决定 Chrome 配置目录）；取得信号量后必有一个
+        self._free = deque(range(self.size))
+        self._wake = wake or threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="rpa-job")
+
+    def wake(self):
+        """Skip the idle sleep (e.g. a new job was enqueued)."""
+        self._wake.set()
+
+    def _run(self, doc_id: str, doc_data: dict, slot: int):
+        t0 = time.monotonic()
+        status = "error"
+        try:
+            status = execute_job(self.store, doc_id, doc_data, self.rpa_script, self.runner, slot=slot)
+        except Exception as e:
+            eprint(f"[{now_iso()}] Job {doc_id} crashed:", e)
+            try:
+                finish_job(self.store, doc_id, doc_data,
+                           {"status": "failed", "finished_at": now_iso(), "error": str(e)[:1000]})
+            except Exception:
+                pass
+        finally:
+            self.metrics.job_finished(status, time.monotonic() - t0)
+            self._free.append(slot)
+            self._slots.release()
+            self._wake.set()
+
+    def run(self, should_stop) -> dict:
+        last_report = time.monotonic()
+        try:
+            while not STOP and not should_stop():
+                if time.monotonic() - last_report >= self.METRICS_INTERVAL:
+                    print(f"[{now_iso()}] Pool metrics: {json.dumps(self.metrics.snapshot())}", flush=True)
+                    print(f"[{now_iso()}] Queue wait: {json.dumps(QUEUE_WAIT.snapshot())}", flush=True)
+                    last_report = time.monotonic()
+
+                # 等待空闲槽位（定期醒来检查 STOP）
+                if not self._slots.acquire(timeout=1.0):
+                    continue
+                try:
+                    claimed = claim_next_job(self.store, self.hostname, self.buffer)
+                except Exception as e:
+                    eprint("ワーカーでエラーが発生しました:", e)
+                    claimed = False
+                if not claimed:
+                    self._slots.release()
+                    if claimed is None:
+                        self.metrics.lost_race()
+                        continue
+                    self._wake.wait(self.idle_wait)
+                    self._wake.clear()
+                    continue
+                self.metrics.job_started()
+                self._executor.submit(self._run, claimed[0], claimed[1], self._free.popleft())
+        finally:
+            if self.buffer is not None:
+                n = self.buffer.release_all()
+                if n:
+                    print(f"[{now_iso()}] Released {n} prefetched job(s) back to the queue", flush=True)
+            busy = self.metrics.snapshot()["busy"]
+            if busy:
+                print(f"[{now_iso()}] Draining {busy} running job(s)...", flush=True)
+            self._executor.shutdown(wait=True)
+        return self.metrics.snapshot()
+
+
+def make_runner(kind: Optional[str], rpa_script: str, size: int):
+    """subprocess（默认，每个任务启动一次 Python）或 pool（常驻预热子进程，see rpa_pool.py）。"""
+    global _WARM_RUNNER
+    kind = (kind or RUNNER_KIND or "subprocess").strip().lower()
+    if kind == "subprocess":
+        return None
+    if kind != "pool":
+        raise ValueError(f"unknown runner {kind!r} (expected subprocess or pool)")
+    from rpa_pool import WarmRunner
+    _WARM_RUNNER = WarmRunner(rpa_script, size=size)
+    print(f"[{now_iso()}] RPA runner: {size} 個の常駐子プロセス（最大 {_WARM_RUNNER.max_tasks} 件で入れ替え）", flush=True)
+    return _WARM_RUNNER
+
+
+def main_loop(once=False, max_runtime_minutes=0, sa_path=None, script_override=None, store=None, concurrency=1,
+              claim_batch=None, claim_shards=None, runner_kind=None, scheduler_policy=None):
     if sa_path and not os.path.exists(sa_path):
         eprint("ERROR: service account JSON not found:", sa_path)
         sys.exit(1)
@@ -594,35 +1495,65 @@ def main_loop(once=False, max_runtime_minutes=0, sa_path=None, script_override=N
         except Exception:
             pass
 
-    db = firestore_client(sa_path)
+    store = store or open_worker_storage(sa_path)
     hostname = socket.gethostname()
     rpa_script = find_rpa_script(script_override)
 
-    print(f"[{now_iso()}] ワーカー起動: {hostname}（{JOB_COLLECTION} を {POLL_INTERVAL}s ごとに確認）", flush=True)
+    runner = make_runner(runner_kind, rpa_script, max(1, concurrency))
 
-    # 定期清理过期的任务（每处理100个任务或启动时执行一次）
-    cleanup_counter = 0
+    # 持有任务的租约续期 + 回收其他 worker 过期的租约（崩溃的 worker 留下的 running 任务）
+    LEASES.start(store)
 
     if once:
-        processed = process_one_job(db, hostname, rpa_script)
+        print(f"[{now_iso()}] ワーカー起動: {hostname}（backend={store.name}）", flush=True)
+        try:
+            processed = process_one_job(store, hostname, rpa_script, runner=runner)
+        finally:
+            LEASES.stop()
+            if runner is not None:
+                runner.close()
         if not processed:
             print(f"[{now_iso()}] No queued jobs.", flush=True)
         return
 
-    while not STOP:
+    # 后台分页清理过期的已完成任务（启动时执行一次，之后每 RPA_GC_SECONDS 秒）
+    GC.start(store)
+    # 到期的保留 SMS 由 worker 定期发送（不必等该用户的下一个任务）
+    SMS_FLUSHER.start(store, rpa_script, runner=runner)
+
+    # 新任务由 on_snapshot 推送唤醒；轮询只作为监听断开时的兜底
+    wake = WAKE
+    unsubscribe = start_queue_listener(store, wake)
+    idle_wait = SAFETY_POLL_INTERVAL if unsubscribe else POLL_INTERVAL
+    mode = "listener" if unsubscribe else "polling"
+    print(f"[{now_iso()}] ワーカー起動: {hostname}（{JOB_COLLECTION} を {mode} で監視, 空き時の確認間隔 {idle_wait}s, backend={store.name}）", flush=True)
+
+    # 批量领取：一次事务领取 K 个放入本地缓冲（默认 K = 并行数）
+    batch = claim_batch or CLAIM_BATCH or max(1, concurrency)
+    shards = claim_shards or CLAIM_SHARDS
+    # 公平スケジューリング（fair）ではバッチ 1 でも候補から選ぶため常にバッファを使う
+    picker = scheduler.make_picker(scheduler_policy)
+    buffer = None
+    if batch > 1 or shards > 1 or picker is not None:
+        buffer = ClaimBuffer(store, hostname, batch=batch, shards=shards, picker=picker)
+        policy = "fair" if picker is not None else "fifo"
+        print(f"[{now_iso()}] Batch claim: {batch} job(s) per transaction, shard {buffer.shard}/{buffer.shards},"
+              f" scheduler {policy}", flush=True)
+
+    if concurrency > 1:
+        print(f"[{now_iso()}] 並列実行: 最大 {concurrency} ジョブ", flush=True)
+        pool = JobPool(store, hostname, rpa_script, concurrency, runner=runner, wake=wake, idle_wait=idle_wait,
+                       buffer=buffer)
+        summary = pool.run(lambda: should_stop_for_runtime(max_runtime_minutes))
+        print(f"[{now_iso()}] Pool metrics: {json.dumps(summary)}", flush=True)
+
+    while not STOP and concurrency <= 1:
         if should_stop_for_runtime(max_runtime_minutes):
             print(f"[{now_iso()}] Reached max runtime, exiting.", flush=True)
             break
 
         try:
-            processed = process_one_job(db, hostname, rpa_script)
-            
-            # 每处理100个任务清理一次过期任务
-            cleanup_counter += 1
-            if cleanup_counter >= 100:
-                cleanup_expired_jobs(db)
-                cleanup_counter = 0
-                
+            processed = process_one_job(store, hostname, rpa_script, runner=runner, buffer=buffer)
         except Exception as e:
             # Print full traceback to help diagnose serialization / type errors
             try:
@@ -632,20 +1563,168 @@ def main_loop(once=False, max_runtime_minutes=0, sa_path=None, script_override=N
             eprint("ワーカーでエラーが発生しました:", e)
             processed = True  # 避免紧密轮询
 
-        # 没任务就睡一会
+        # 没任务就等待（新任务推送或兜底轮询间隔，先到者为准）
         if not processed:
-            time.sleep(POLL_INTERVAL)
+            wake.wait(idle_wait)
+            wake.clear()
 
-
-def run_once_for_uid(db, hostname, rpa_script, uid: str):
+    if unsubscribe:
+        try:
+            unsubscribe()
+        except Exception:
+            pass
+    if buffer is not None:
+        n = buffer.release_all()
+        if n:
+            print(f"[{now_iso()}] Released {n} prefetched job(s) back to the queue", flush=True)
+        print(f"[{now_iso()}] Batch claim: {json.dumps(buffer.stats)}", flush=True)
+    LEASES.stop()
+    print(f"[{now_iso()}] Leases: {json.dumps(LEASES.stats)}", flush=True)
+    GC.stop()
+    print(f"[{now_iso()}] Job GC: {json.dumps(GC.stats)}", flush=True)
+    SMS_FLUSHER.stop()
+    print(f"[{now_iso()}] SMS flush: {json.dumps(SMS_FLUSHER.stats)}", flush=True)
+    if runner is not None:
+        print(f"[{now_iso()}] RPA runner: {json.dumps(runner.stats)}", flush=True)
+        runner.close()
+    print(f"[{now_iso()}] Queue wait: {json.dumps(QUEUE_WAIT.snapshot())}", flush=True)
+    print(f"[{now_iso()}] Firestore client: {json.dumps(firestore_provider.metrics())}", flush=True)
+    if _CONFIG_CACHE is not None:
+        print(f"[{now_iso()}] Config cache: {json.dumps(_CONFIG_CACHE.stats)}", flush=True)
+        _CONFIG_CACHE.close()
+
+
+def _bench_runner(rpa_script, cfg, log_stdout=False, extra_env=None, timeout_seconds=None, on_event=None):
+    return True, {"results": [], "message": "no_unread"}
+
+
+def run_benchmark(n_jobs: int, backends, workers: int = 1, claim_batch: int = 1, claim_shards: int = 1,
+                  scheduler_policy: Optional[str] = "fifo"):
+    """Push n_jobs synthetic jobs through `workers` competing claim loops per backend (child process stubbed out)."""
+    hostname = socket.gethostname()
+    for name in backends:
+        if name == "sqlite":
+            path = os.path.join(tempfile.mkdtemp(prefix="rpa_bench_"), "storage.sqlite3")
+            store = storage.open_storage(name, path=path)
+        else:
+            store = open_worker_storage(backend=name)
+        try:
+            store.configs.put("bench-user", {"email_config": {"address": "bench@example.com"}})
+            t0 = time.perf_counter()
+            for i in range(n_jobs):
+                store.jobs.enqueue({"userUid": "bench-user", "userDocId": "bench-user", "cfg": {"bench": i}})
+            t_enqueue = time.perf_counter() - t0
+
+            counts = {"done": 0, "lost_races": 0, "transactions": 0}
+            counts_lock = threading.Lock()
+
+            def _worker(i):
+                buffer = None
+                picker = scheduler.make_picker(scheduler_policy)
+                if claim_batch > 1 or claim_shards > 1 or picker is not None:
+                    buffer = ClaimBuffer(store, hostname, batch=claim_batch, shards=claim_shards,
+                                         worker_id=f"{hostname}:bench{i}", picker=picker)
+                done = lost = 0
+                while True:
+                    claimed = claim_next_job(store, hostname, buffer)
+                    if claimed is False:
+                        break
+                    if claimed is None:
+                        lost += 1
+                        continue
+                    execute_job(store, claimed[0], claimed[1], "bench", _bench_runner)
+                    done += 1
+                with counts_lock:
+                    counts["done"] += done
+                    counts["lost_races"] += lost
+                    counts["transactions"] += buffer.stats["batches"] if buffer else done + lost
+
+            t0 = time.perf_counter()
+            threads = [threading.Thread(target=_worker, args=(i,)) for i in range(max(1, workers))]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            t_process = time.perf_counter() - t0
+            done = counts["done"]
+            print(json.dumps({
+                "backend": name,
+                "workers": max(1, workers),
+                "claim_batch": claim_batch,
+                "claim_shards": claim_shards,
+                "scheduler": scheduler_policy or scheduler.DEFAULT_POLICY,
+                "jobs": done,
+                "lost_races": counts["lost_races"],
+                "claim_transactions": counts["transactions"],
+                "enqueue_ms": round(t_enqueue * 1000, 1),
+                "process_ms": round(t_process * 1000, 1),
+                "jobs_per_minute": round(done / t_process * 60) if t_process > 0 else None,
+                "per_job_ms": round(t_process / done * 1000, 3) if done else None,
+            }, ensure_ascii=False), flush=True)
+        finally:
+            store.close()
+
+
+def _bench_job_result(n_results: int) -> dict:
+    """A result_summary shaped like a real batch (applicant entries with timestamps and SMS responses)."""
+    now = datetime.now(timezone.utc)
+    results = []
+    for i in range(n_results):
+        results.append({
+            "name": f"応募者 {i}", "furigana": "おうぼしゃ", "phone": f"090-{i:04d}-5678",
+            "gender": "女性" if i % 2 else "男性", "birth": "1995-04-01", "age": 20 + i % 40,
+            "source_url": f"https://jp.indeed.com/applicant/{i}", "should_send_sms": bool(i % 3),
+            "sms_sent": bool(i % 3), "received_at": now - timedelta(minutes=i),
+            "sms_response": {"status": 200, "body": {"result": "ok", "id": f"sms-{i}"}, "raw": b"\x00\x01ok"},
+            "steps": [{"step": name, "ok": True, "ms": 120 + i} for name in ("open", "parse", "sms", "history")],
+            "history_id": f"h{i:08x}",
+        })
+    return {"success": True, "timestamp": int(now.timestamp() * 1000), "results": results,
+            "streamed": True, "batches": 1, "items": n_results}
+
+
+def run_sanitize_benchmark(n_results: int, rounds: int = 50):
+    """Time _sanitize_for_firestore on a realistic job result (n_results applicant entries)."""
+    payload = _bench_job_result(n_results)
+    nodes = 0
+    stack = [payload]
+    while stack:
+        v = stack.pop()
+        nodes += 1
+        if isinstance(v, dict):
+            stack.extend(v.values())
+        elif isinstance(v, (list, tuple)):
+            stack.extend(v)
+    _sanitize_for_firestore(payload)  # 类型表预热
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        out = _sanitize_for_firestore(payload)
+    elapsed = time.perf_counter() - t0
+    json.dumps(out, ensure_ascii=False)  # 结果必须可 JSON 序列化
+    deep = {"v": datetime.now(timezone.utc)}
+    # 递归实现在约 500 层时就会触发 RecursionError
+    for _ in range(800):
+        deep = {"child": deep}
+    t1 = time.perf_counter()
+    _sanitize_for_firestore(deep)
+    print(json.dumps({
+        "results": n_results,
+        "nodes": nodes,
+        "rounds": rounds,
+        "per_payload_ms": round(elapsed / rounds * 1000, 3),
+        "nodes_per_s": round(nodes * rounds / elapsed) if elapsed > 0 else None,
+        "deep_800_ms": round((time.perf_counter() - t1) * 1000, 3),
+    }, ensure_ascii=False), flush=True)
+
+
+def run_once_for_uid(store: storage.Storage, hostname, rpa_script, uid: str):
     """Run RPA once for a specific user UID (helper for manual UID paste flow)."""
     try:
         print(f"[{now_iso()}] Running one-off job for UID: {uid}", flush=True)
-        snap = db.collection("user_configs").document(str(uid)).get()
-        if not snap.exists:
+        cfg = store.configs.get(str(uid))
+        if cfg is None:
             eprint("User config not found for UID:", uid)
             return False
-        cfg = snap.to_dict() or {}
         extra_env = {}
         sa_env = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
         if sa_env:
@@ -681,7 +1760,12 @@ if __name__ == "__main__":
             fb_cred = fb_credentials.Certificate(sa_path)
             firebase_admin.initialize_app(fb_cred)
 
-        db = firestore_client(sa_path)
+        try:
+            db = firestore_client(sa_path)
+        except Exception as e:
+            eprint("Failed to initialize Firestore client:", e)
+            pause_if_tty()
+            sys.exit(1)
         hostname = socket.gethostname()
 
         print("--- ワーカー登録モード ---")
@@ -705,6 +1789,7 @@ if __name__ == "__main__":
         extra_note = input("任意メモ（Enterでスキップ）: ").strip()
 
         data = {
+            "email": app_email,  # uid_aliases の読み取り時検証に使う
             "imap": {"email": imap_email},
             "registered_at": now_iso(),
             "registered_on": hostname,
@@ -736,6 +1821,12 @@ if __name__ == "__main__":
             pause_if_tty()
             sys.exit(1)
 
+        # find_user_config がメールアドレスからも 1 回の読み取りで解決できるように
+        try:
+            write_uid_aliases(db, uid, [app_email], field="email")
+        except Exception as e:
+            eprint("Warning: uid_aliases の書き込みに失敗しました:", e)
+
         sys.exit(0)
 
     # --- 常驻/一次性 执行 ---
@@ -750,9 +1841,22 @@ if __name__ == "__main__":
             except Exception:
                 pass
 
+        if args.job_timeout:
+            JOB_TIMEOUT_SECONDS = args.job_timeout
+
+        if args.bench_sanitize:
+            run_sanitize_benchmark(args.bench_sanitize)
+            sys.exit(0)
+
+        if args.bench:
+            run_benchmark(args.bench, [b.strip() for b in args.bench_backends.split(",") if b.strip()],
+                          workers=args.bench_workers, claim_batch=args.claim_batch or 1,
+                          claim_shards=args.claim_shards or 1, scheduler_policy=args.scheduler or "fifo")
+            sys.exit(0)
+
         # Create Firestore client early so we can prompt the user while connected.
         try:
-            db = firestore_client(sa_path)
+            store = open_worker_storage(sa_path)
         except Exception as e:
             eprint("Failed to initialize Firestore client:", e)
             pause_if_tty()
@@ -796,7 +1900,7 @@ if __name__ == "__main__":
                 except EOFError:
                     uid = ""
             if uid:
-                run_once_for_uid(db, hostname, rpa_script, uid)
+                run_once_for_uid(store, hostname, rpa_script, uid)
             else:
                 eprint("No UID provided; exiting.")
         else:
@@ -805,6 +1909,12 @@ if __name__ == "__main__":
                 max_runtime_minutes=args.max_runtime,
                 sa_path=sa_path,
                 script_override=args.script,
+                store=store,
+                concurrency=args.concurrency,
+                claim_batch=args.claim_batch,
+                claim_shards=args.claim_shards,
+                runner_kind=args.runner,
+                scheduler_policy=args.scheduler,
             )
     except KeyboardInterrupt:
         print("Worker stopped by user", flush=True)